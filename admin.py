@@ -1,57 +1,133 @@
-
 import logging
-import json
-import os
-from datetime import datetime
+import time
+from datetime import date
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import ContextTypes
 
-# Bot token from environment
-BOT_TOKEN = os.environ.get('YOUR_BOT_TOKEN')
+import config
+import gamelog
+import storage
+from locks import user_lock, user_locks
+from router import CallbackRouter
+from sender import PAYOUT, outbox
+from stats import game_stats
 
-# Admin chat ID
-ADMIN_ID = 58573285
+# Admin handlers are registered by main.py, which runs the single bot process
 
-# Enable logging
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
-logger = logging.getLogger(__name__)
+# context.user_data keys that mean an admin text reply is expected
+ADMIN_INPUT_KEYS = ('editing_user_balance', 'searching_user', 'changing_win_rate', 'changing_lose_rate', 'filtering_requests')
 
-# JSON file paths
-USER_DB = "user.json"
-GAME_DB = "game.json"
-DEPOSIT_DB = "deposit.json"
-WITHDRAWAL_DB = "withdrawal.json"
-LOGIC_DB = "logic.json"
-WALLET_DB = "wallet.json"
+# Admin user browser
+USERS_PAGE_SIZE = 10
+REQUESTS_PAGE_SIZE = 5
+USER_SORT_TITLES = {"id": "شناسه", "balance": "موجودی", "active": "آخرین فعالیت"}
 
-def load_json(file_path):
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return []
+# Deposit/withdrawal review. Bulk actions resolve the selected requests, or
+# the requests a filter matched in its preview, in one commit.
+REQUEST_TABLES = {
+    "deposits": {"title": "واریز", "review": "review_deposit", "queue": storage.deposit_queue,
+                 "pending": storage.pending_deposits, "find": storage.find_deposits,
+                 "Accept": storage.accept_deposits, "Reject": storage.reject_deposits},
+    "withdrawals": {"title": "برداشت", "review": "review_withdrawal", "queue": storage.withdrawal_queue,
+                    "pending": storage.pending_withdrawals, "find": storage.find_withdrawals,
+                    "Accept": storage.accept_withdrawals, "Reject": storage.reject_withdrawals},
+}
+REVIEW_TITLES = {"Accept": "تأیید", "Reject": "رد"}
+REVIEW_NOTICES = {
+    ("deposits", "Accept"): "واریز {amount} تومانی شما تأیید شد و به موجودی شما اضافه گردید.",
+    ("deposits", "Reject"): "درخواست واریز {amount} تومانی شما رد شد.",
+    ("withdrawals", "Accept"): "برداشت {amount} تومانی شما تأیید و پرداخت شد.",
+    ("withdrawals", "Reject"): "درخواست برداشت {amount} تومانی شما رد شد و مبلغ به موجودی شما برگشت.",
+}
+REQUEST_FILTER_HELP = (
+    "فیلتر را به این شکل وارد کنید (هر بخش اختیاری است):\n\n"
+    "side=TRC20 amount=100-500 user=@username\n\n"
+    "side: روش (POL، TRC20، Utopia)\n"
+    "amount: بازه مبلغ، مثل 100-500، 100- یا -500\n"
+    "user: نام کاربری یا آیدی تلگرام"
+)
+
+# Game statistics
+STATS_TITLES = {"daily": "امروز", "weekly": "این هفته", "all": "همه زمان‌ها"}
+BET_KIND_TITLES = {"even": "زوج", "odd": "فرد", "number": "عدد", "unknown": "نامشخص"}
 
-def save_json(file_path, data):
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+logger = logging.getLogger(__name__)
 
 def is_admin(user_id):
-    return user_id == ADMIN_ID
+    # The admin's ID comes from the settings (config.py)
+    return user_id == config.get().admin_id
+
+def awaiting_admin_input(user_id, user_data):
+    return is_admin(user_id) and any(user_data.get(key) for key in ADMIN_INPUT_KEYS)
+
+# Static keyboards, built once
+ADMIN_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("مدیریت کاربران", callback_data="admin_users")],
+    [InlineKeyboardButton("تغییر منطق بازی", callback_data="admin_logic")],
+    [InlineKeyboardButton("درخواست‌های واریز", callback_data="admin_deposits")],
+    [InlineKeyboardButton("درخواست‌های برداشت", callback_data="admin_withdrawals")],
+    [InlineKeyboardButton("آمار بازی‌ها", callback_data="admin_stats")],
+    [InlineKeyboardButton("بازشماری آمار کل", callback_data="admin_recount")]
+])
+LOGIC_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("تغییر درصد برد", callback_data="change_win")],
+    [InlineKeyboardButton("تغییر درصد باخت", callback_data="change_lose")],
+    [InlineKeyboardButton("تغییر حالت تصادفی", callback_data="toggle_random")],
+    [InlineKeyboardButton("برگشت", callback_data="admin_back")]
+])
+STATS_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton(title, callback_data=f"admin_stats_{name}") for name, title in STATS_TITLES.items()],
+    [InlineKeyboardButton("برگشت", callback_data="admin_back")]
+])
+ADMIN_BACK_MENU = InlineKeyboardMarkup([[InlineKeyboardButton("برگشت", callback_data="admin_back")]])
+USER_SORT_ROW = [InlineKeyboardButton(title, callback_data=f"users_{name}") for name, title in USER_SORT_TITLES.items()]
+
+# Admin callbacks; main.py sends a callback here when callbacks.matches()
+# accepts its data, everything else goes to the user-side button_handler
+callbacks = CallbackRouter()
 
 async def admin_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("شما دسترسی ادمین ندارید.")
         return
+    
+    await update.message.reply_text(admin_header(), reply_markup=ADMIN_MENU)
 
-    keyboard = [
-        [InlineKeyboardButton("مدیریت کاربران", callback_data="admin_users")],
-        [InlineKeyboardButton("تغییر منطق بازی", callback_data="admin_logic")],
-        [InlineKeyboardButton("درخواست‌های واریز", callback_data="admin_deposits")],
-        [InlineKeyboardButton("درخواست‌های برداشت", callback_data="admin_withdrawals")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+def admin_header():
+    # Live totals: the counters table (kept by triggers) plus today's games
+    # still in the journal, a few key lookups whatever the data size
+    counters = storage.get_counters()
+    today = date.today().isoformat()
+    games, volume = storage.get_daily_volume(today)
+    journal_games, journal_volume = gamelog.journal_volume(today)
+    return (
+        "پنل ادمین:\n\n"
+        f"کاربران: {counters.get('users', 0):,}\n"
+        f"موجودی کل کاربران: {counters.get('balance', 0):,} تومان\n"
+        f"واریز در انتظار: {counters.get('pending_deposits', 0)} | برداشت در انتظار: {counters.get('pending_withdrawals', 0)}\n"
+        f"حجم شرط امروز: {volume + journal_volume:,} تومان ({games + journal_games:,} بازی)"
+    )
+
+async def reload_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /reload: read config.json and wallet.json again right away
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("شما دسترسی ادمین ندارید.")
+        return
     
-    await update.message.reply_text("پنل ادمین:", reply_markup=reply_markup)
+    try:
+        config.reload(force=True)
+    except (OSError, ValueError, TypeError, KeyError, IndexError) as e:
+        await update.message.reply_text(f"خطا در خواندن تنظیمات، تنظیمات قبلی باقی ماند:\n{e}")
+        return
+    settings = config.get()
+    await update.message.reply_text(
+        "تنظیمات دوباره بارگذاری شد.\n\n"
+        f"کانال‌ها: {'، '.join(settings.required_channels)}\n"
+        f"حداقل شرط: {settings.min_bet}\n"
+        f"حداقل واریز: {settings.min_deposit:,}\n"
+        f"حداقل برداشت: {settings.min_withdrawal:,}\n"
+        f"کیف پول‌ها: {', '.join(settings.wallets) or '-'}"
+    )
 
 async def admin_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -61,263 +137,418 @@ async def admin_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.edit_message_text("شما دسترسی ادمین ندارید.")
         return
 
-    if query.data == "admin_users":
-        users = load_json(USER_DB)
-        if not users:
-            await query.edit_message_text("کاربری یافت نشد.")
-            return
-            
-        text = "کاربران:\n\n"
-        keyboard = []
-        
-        for user in users[:10]:  # Show first 10 users
-            text += f"ID: {user['ID']} | @{user['Username']} | موجودی: {user['Balance']} | وضعیت: {user['Status']}\n"
-            keyboard.append([InlineKeyboardButton(f"ویرایش {user['Username']}", callback_data=f"edit_user_{user['ID']}")])
-        
-        keyboard.append([InlineKeyboardButton("برگشت", callback_data="admin_back")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(text, reply_markup=reply_markup)
-        
-    elif query.data == "admin_logic":
-        logic = load_json(LOGIC_DB)[0]
-        text = f"منطق فعلی بازی:\n\nدرصد برد: {logic['win']}%\nدرصد باخت: {logic['lose']}%\nتصادفی: {'بله' if logic['random'] else 'خیر'}"
-        
-        keyboard = [
-            [InlineKeyboardButton("تغییر درصد برد", callback_data="change_win")],
-            [InlineKeyboardButton("تغییر درصد باخت", callback_data="change_lose")],
-            [InlineKeyboardButton("تغییر حالت تصادفی", callback_data="toggle_random")],
-            [InlineKeyboardButton("برگشت", callback_data="admin_back")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(text, reply_markup=reply_markup)
-        
-    elif query.data == "admin_deposits":
-        deposits = load_json(DEPOSIT_DB)
-        pending_deposits = [d for d in deposits if d['status'] == 'Pending']
-        
-        if not pending_deposits:
-            keyboard = [[InlineKeyboardButton("برگشت", callback_data="admin_back")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("درخواست واریز در انتظاری وجود ندارد.", reply_markup=reply_markup)
-            return
-        
-        text = "درخواست‌های واریز در انتظار:\n\n"
-        keyboard = []
-        
-        for deposit in pending_deposits[:5]:  # Show first 5 pending
-            text += f"ID: {deposit['ID']} | @{deposit['Username']} | مبلغ: {deposit['amount']} | روش: {deposit['side']}\n"
-            keyboard.append([InlineKeyboardButton(f"بررسی {deposit['ID']}", callback_data=f"review_deposit_{deposit['ID']}")])
-        
-        keyboard.append([InlineKeyboardButton("برگشت", callback_data="admin_back")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(text, reply_markup=reply_markup)
-        
-    elif query.data == "admin_withdrawals":
-        withdrawals = load_json(WITHDRAWAL_DB)
-        pending_withdrawals = [w for w in withdrawals if w['status'] == 'Pending']
-        
-        if not pending_withdrawals:
-            keyboard = [[InlineKeyboardButton("برگشت", callback_data="admin_back")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("درخواست برداشت در انتظاری وجود ندارد.", reply_markup=reply_markup)
-            return
-        
-        text = "درخواست‌های برداشت در انتظار:\n\n"
-        keyboard = []
-        
-        for withdrawal in pending_withdrawals[:5]:  # Show first 5 pending
-            text += f"ID: {withdrawal['ID']} | @{withdrawal['Username']} | مبلغ: {withdrawal['amount']} | روش: {withdrawal['side']}\n"
-            keyboard.append([InlineKeyboardButton(f"بررسی {withdrawal['ID']}", callback_data=f"review_withdrawal_{withdrawal['ID']}")])
-        
-        keyboard.append([InlineKeyboardButton("برگشت", callback_data="admin_back")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(text, reply_markup=reply_markup)
-        
-    elif query.data.startswith("edit_user_"):
-        user_id = int(query.data.split("_")[2])
-        users = load_json(USER_DB)
-        user = next((u for u in users if u['ID'] == user_id), None)
-        
-        if not user:
-            await query.edit_message_text("کاربر یافت نشد.")
-            return
-        
-        text = f"ویرایش کاربر:\n\nID: {user['ID']}\nنام کاربری: @{user['Username']}\nموجودی: {user['Balance']}\nوضعیت: {user['Status']}\nتوضیحات: {user['Description']}"
-        
-        keyboard = [
-            [InlineKeyboardButton("تغییر موجودی", callback_data=f"change_balance_{user_id}")],
-            [InlineKeyboardButton("تغییر وضعیت", callback_data=f"change_status_{user_id}")],
-            [InlineKeyboardButton("برگشت", callback_data="admin_users")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(text, reply_markup=reply_markup)
-        
-    elif query.data.startswith("review_deposit_"):
-        deposit_id = int(query.data.split("_")[2])
-        deposits = load_json(DEPOSIT_DB)
-        deposit = next((d for d in deposits if d['ID'] == deposit_id), None)
-        
-        if not deposit:
-            await query.edit_message_text("درخواست یافت نشد.")
-            return
-        
-        text = f"بررسی درخواست واریز:\n\nID: {deposit['ID']}\nکاربر: @{deposit['Username']}\nمبلغ: {deposit['amount']}\nروش: {deposit['side']}\nاطلاعات: {deposit['information']}"
-        
-        keyboard = [
-            [InlineKeyboardButton("تأیید", callback_data=f"accept_deposit_{deposit_id}"),
-             InlineKeyboardButton("رد", callback_data=f"reject_deposit_{deposit_id}")],
-            [InlineKeyboardButton("برگشت", callback_data="admin_deposits")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(text, reply_markup=reply_markup)
-        
-    elif query.data.startswith("review_withdrawal_"):
-        withdrawal_id = int(query.data.split("_")[2])
-        withdrawals = load_json(WITHDRAWAL_DB)
-        withdrawal = next((w for w in withdrawals if w['ID'] == withdrawal_id), None)
-        
-        if not withdrawal:
-            await query.edit_message_text("درخواست یافت نشد.")
+    await callbacks.dispatch(query, context)
+
+@callbacks.route("admin_users")
+async def on_users(query, context):
+    await show_user_page(query, "id")
+
+@callbacks.route("users_")
+async def on_user_page(query, context, sort, direction=None, value=None, user_id=None):
+    if sort not in USER_SORT_TITLES:
+        return
+    if direction is None:
+        await show_user_page(query, sort)
+    else:
+        await show_user_page(query, sort, (int(value), int(user_id)), direction == "p")
+
+@callbacks.route("search_users")
+async def on_search_users(query, context):
+    context.user_data['searching_user'] = True
+    await query.edit_message_text("نام کاربری یا آیدی تلگرام را وارد کنید:")
+
+@callbacks.route("admin_logic")
+async def on_logic(query, context):
+    logic = storage.get_logic()
+    text = f"منطق فعلی بازی:\n\nدرصد برد: {logic['win']}%\nدرصد باخت: {logic['lose']}%\nتصادفی: {'بله' if logic['random'] else 'خیر'}"
+    
+    await query.edit_message_text(text, reply_markup=LOGIC_MENU)
+
+@callbacks.route("admin_stats")
+@callbacks.route("admin_stats_")
+async def on_stats(query, context, window="daily"):
+    if window not in STATS_TITLES:
+        return
+    started = time.perf_counter()
+    report = game_stats.report(window)
+    elapsed = (time.perf_counter() - started) * 1000
+    
+    text = f"آمار بازی‌ها ({STATS_TITLES[window]}):\n\n"
+    text += f"تعداد بازی: {report['games']} | بازیکنان: {report['players']}\n"
+    text += f"حجم شرط: {report['volume']} تومان\n"
+    text += f"سود/زیان سایت: {report['house']} تومان\n"
+    text += f"درصد برد بازیکنان: {report['win_rate']:.1f}%\n\n"
+    
+    text += "حجم بر اساس نوع شرط:\n"
+    text += " | ".join(f"{BET_KIND_TITLES[kind]}: {volume}" for kind, volume in report['volume_by_kind'].items()) + "\n"
+    
+    if report['daily_house']:
+        text += "\nسود/زیان روزانه سایت:\n"
+        for day, house in report['daily_house']:
+            text += f"{day}: {house}\n"
+    
+    if report['top_losers']:
+        text += "\nبیشترین ضرر:\n"
+        for rank, (username, loss) in enumerate(report['top_losers'], 1):
+            text += f"{rank}. @{username} | ضرر: {loss}\n"
+    
+    text += f"\n(محاسبه در {elapsed:.1f} میلی‌ثانیه)"
+    await query.edit_message_text(text, reply_markup=STATS_MENU)
+
+@callbacks.route("admin_deposits")
+@callbacks.route("admin_deposits_", int)
+async def on_deposits(query, context, after_id=0):
+    await show_requests(query, context, "deposits", after_id)
+
+@callbacks.route("admin_withdrawals")
+@callbacks.route("admin_withdrawals_", int)
+async def on_withdrawals(query, context, after_id=0):
+    await show_requests(query, context, "withdrawals", after_id)
+
+@callbacks.route("select_", str, int, int)
+async def on_select_request(query, context, table, request_id, after_id):
+    if table not in REQUEST_TABLES:
+        return
+    selected = context.user_data.setdefault(f'selected_{table}', [])
+    if request_id in selected:
+        selected.remove(request_id)
+    else:
+        selected.append(request_id)
+    await show_requests(query, context, table, after_id)
+
+@callbacks.route("filter_")
+async def on_filter_requests(query, context, table):
+    if table not in REQUEST_TABLES:
+        return
+    context.user_data['filtering_requests'] = table
+    await query.edit_message_text(REQUEST_FILTER_HELP)
+
+@callbacks.route("bulk_")
+async def on_bulk_review(query, context, table, status, source):
+    if table not in REQUEST_TABLES or status not in REVIEW_TITLES:
+        return
+    requests = REQUEST_TABLES[table]
+    back = InlineKeyboardMarkup([[InlineKeyboardButton("برگشت", callback_data=f"admin_{table}")]])
+    
+    if source == "selected":
+        request_ids = context.user_data.pop(f'selected_{table}', [])
+    elif source == "filter":
+        saved = context.user_data.pop('request_filter', None)
+        if not saved or saved['table'] != table:
+            await query.edit_message_text("فیلتر منقضی شده است، دوباره فیلتر کنید.", reply_markup=back)
             return
-        
-        text = f"بررسی درخواست برداشت:\n\nID: {withdrawal['ID']}\nکاربر: @{withdrawal['Username']}\nمبلغ: {withdrawal['amount']}\nروش: {withdrawal['side']}\nکیف پول: {withdrawal['wallet-code']}"
-        
-        keyboard = [
-            [InlineKeyboardButton("تأیید", callback_data=f"accept_withdrawal_{withdrawal_id}"),
-             InlineKeyboardButton("رد", callback_data=f"reject_withdrawal_{withdrawal_id}")],
-            [InlineKeyboardButton("برگشت", callback_data="admin_withdrawals")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(text, reply_markup=reply_markup)
-        
-    elif query.data.startswith("accept_deposit_"):
-        deposit_id = int(query.data.split("_")[2])
-        deposits = load_json(DEPOSIT_DB)
-        
-        for deposit in deposits:
-            if deposit['ID'] == deposit_id:
-                deposit['status'] = 'Accept'
-                
-                # Update user balance
-                users = load_json(USER_DB)
-                for user in users:
-                    if user['ID-Telegram'] == deposit['ID-Telegram']:
-                        user['Balance'] += deposit['amount']
-                        break
-                save_json(USER_DB, users)
-                break
-        
-        save_json(DEPOSIT_DB, deposits)
-        await query.edit_message_text("درخواست واریز تأیید شد و موجودی کاربر بروزرسانی شد.")
-        
-    elif query.data.startswith("reject_deposit_"):
-        deposit_id = int(query.data.split("_")[2])
-        deposits = load_json(DEPOSIT_DB)
-        
-        for deposit in deposits:
-            if deposit['ID'] == deposit_id:
-                deposit['status'] = 'Reject'
-                break
-        
-        save_json(DEPOSIT_DB, deposits)
-        await query.edit_message_text("درخواست واریز رد شد.")
-        
-    elif query.data.startswith("accept_withdrawal_"):
-        withdrawal_id = int(query.data.split("_")[2])
-        withdrawals = load_json(WITHDRAWAL_DB)
-        
-        for withdrawal in withdrawals:
-            if withdrawal['ID'] == withdrawal_id:
-                withdrawal['status'] = 'Accept'
-                break
-        
-        save_json(WITHDRAWAL_DB, withdrawals)
-        await query.edit_message_text("درخواست برداشت تأیید شد.")
-        
-    elif query.data.startswith("reject_withdrawal_"):
-        withdrawal_id = int(query.data.split("_")[2])
-        withdrawals = load_json(WITHDRAWAL_DB)
-        
-        for withdrawal in withdrawals:
-            if withdrawal['ID'] == withdrawal_id:
-                withdrawal['status'] = 'Reject'
-                
-                # Return balance to user
-                users = load_json(USER_DB)
-                for user in users:
-                    if user['ID-Telegram'] == withdrawal['ID-Telegram']:
-                        user['Balance'] += withdrawal['amount']
-                        break
-                save_json(USER_DB, users)
-                break
-        
-        save_json(WITHDRAWAL_DB, withdrawals)
-        await query.edit_message_text("درخواست برداشت رد شد و موجودی به کاربر برگردانده شد.")
-        
-    elif query.data.startswith("change_balance_"):
-        user_id = int(query.data.split("_")[2])
-        context.user_data['editing_user_balance'] = user_id
-        await query.edit_message_text("موجودی جدید را وارد کنید:")
-        
-    elif query.data.startswith("change_status_"):
-        user_id = int(query.data.split("_")[2])
-        keyboard = [
-            [InlineKeyboardButton("فعال", callback_data=f"set_status_{user_id}_Active")],
-            [InlineKeyboardButton("غیرفعال", callback_data=f"set_status_{user_id}_Inactive")],
-            [InlineKeyboardButton("مسدود", callback_data=f"set_status_{user_id}_Blocked")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("وضعیت جدید را انتخاب کنید:", reply_markup=reply_markup)
-        
-    elif query.data.startswith("set_status_"):
-        parts = query.data.split("_")
-        user_id = int(parts[2])
-        new_status = parts[3]
-        
-        users = load_json(USER_DB)
-        for user in users:
-            if user['ID'] == user_id:
-                user['Status'] = new_status
-                break
-        save_json(USER_DB, users)
-        
-        await query.edit_message_text(f"وضعیت کاربر به {new_status} تغییر یافت.")
-        
-    elif query.data == "change_win":
-        context.user_data['changing_win_rate'] = True
-        await query.edit_message_text("درصد برد جدید را وارد کنید (0-100):")
-        
-    elif query.data == "change_lose":
-        context.user_data['changing_lose_rate'] = True
-        await query.edit_message_text("درصد باخت جدید را وارد کنید (0-100):")
-        
-    elif query.data == "toggle_random":
-        logic = load_json(LOGIC_DB)
-        logic[0]['random'] = not logic[0]['random']
-        save_json(LOGIC_DB, logic)
-        
-        status = "فعال" if logic[0]['random'] else "غیرفعال"
-        await query.edit_message_text(f"حالت تصادفی {status} شد.")
-        
-    elif query.data == "admin_back":
-        await admin_start_menu(query)
+        # Only the requests the admin saw in the preview; any resolved since
+        # are skipped and counted below
+        request_ids = saved['request_ids']
+    else:
+        return
+    
+    telegram_ids = {request['ID-Telegram'] for request in map(requests["queue"].get, request_ids) if request}
+    if not telegram_ids:
+        await query.edit_message_text("درخواست در انتظاری برای بررسی وجود ندارد.", reply_markup=back)
+        return
+    
+    # All status changes and balance credits/refunds in one transaction
+    async with user_locks(telegram_ids):
+        resolved = await requests[status](request_ids)
+    
+    for request in resolved:
+        outbox.send_text(request['ID-Telegram'], REVIEW_NOTICES[table, status].format(amount=request['amount']), PAYOUT)
+    
+    text = f"{len(resolved)} درخواست {requests['title']} {REVIEW_TITLES[status]} شد.\n"
+    text += f"مجموع مبلغ: {sum(request['amount'] for request in resolved)} تومان\n"
+    text += f"کاربران: {len({request['ID-Telegram'] for request in resolved})}"
+    skipped = sorted(set(request_ids) - {request['ID'] for request in resolved})
+    if skipped:
+        text += f"\n{len(skipped)} درخواست قبلا بررسی شده بود: {', '.join(f'#{request_id}' for request_id in skipped)}"
+    await query.edit_message_text(text, reply_markup=back)
 
-async def admin_start_menu(query):
+@callbacks.route("edit_user_", int)
+async def on_edit_user(query, context, user_id):
+    user = storage.get_user_by_id(user_id)
+    
+    if not user:
+        await query.edit_message_text("کاربر یافت نشد.")
+        return
+    
+    text = f"ویرایش کاربر:\n\nID: {user['ID']}\nنام کاربری: @{user['Username']}\nموجودی: {user['Balance']}\nوضعیت: {user['Status']}\nتوضیحات: {user['Description']}"
+    
+    keyboard = [
+        [InlineKeyboardButton("تغییر موجودی", callback_data=f"change_balance_{user_id}")],
+        [InlineKeyboardButton("تغییر وضعیت", callback_data=f"change_status_{user_id}")],
+        [InlineKeyboardButton("برگشت", callback_data="admin_users")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+@callbacks.route("review_deposit_", int)
+async def on_review_deposit(query, context, deposit_id):
+    deposit = storage.get_deposit(deposit_id)
+    
+    if not deposit:
+        await query.edit_message_text("درخواست یافت نشد.")
+        return
+    
+    text = f"بررسی درخواست واریز:\n\nID: {deposit['ID']}\nکاربر: @{deposit['Username']}\nمبلغ: {deposit['amount']}\nروش: {deposit['side']}\nاطلاعات: {deposit['information']}"
+    
+    keyboard = [
+        [InlineKeyboardButton("تأیید", callback_data=f"accept_deposit_{deposit_id}"),
+         InlineKeyboardButton("رد", callback_data=f"reject_deposit_{deposit_id}")],
+        [InlineKeyboardButton("برگشت", callback_data="admin_deposits")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+@callbacks.route("review_withdrawal_", int)
+async def on_review_withdrawal(query, context, withdrawal_id):
+    withdrawal = storage.get_withdrawal(withdrawal_id)
+    
+    if not withdrawal:
+        await query.edit_message_text("درخواست یافت نشد.")
+        return
+    
+    text = f"بررسی درخواست برداشت:\n\nID: {withdrawal['ID']}\nکاربر: @{withdrawal['Username']}\nمبلغ: {withdrawal['amount']}\nروش: {withdrawal['side']}\nکیف پول: {withdrawal['wallet-code']}"
+    
     keyboard = [
-        [InlineKeyboardButton("مدیریت کاربران", callback_data="admin_users")],
-        [InlineKeyboardButton("تغییر منطق بازی", callback_data="admin_logic")],
-        [InlineKeyboardButton("درخواست‌های واریز", callback_data="admin_deposits")],
-        [InlineKeyboardButton("درخواست‌های برداشت", callback_data="admin_withdrawals")]
+        [InlineKeyboardButton("تأیید", callback_data=f"accept_withdrawal_{withdrawal_id}"),
+         InlineKeyboardButton("رد", callback_data=f"reject_withdrawal_{withdrawal_id}")],
+        [InlineKeyboardButton("برگشت", callback_data="admin_withdrawals")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("پنل ادمین:", reply_markup=reply_markup)
+    
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+@callbacks.route("accept_deposit_", int)
+async def on_accept_deposit(query, context, deposit_id):
+    deposit = storage.get_deposit(deposit_id)
+    
+    if not deposit:
+        await query.edit_message_text("درخواست یافت نشد.")
+        return
+    
+    # Flip status and credit the user in one transaction
+    async with user_lock(deposit['ID-Telegram']):
+        deposit = await storage.accept_deposit(deposit_id)
+    
+    if not deposit:
+        await query.edit_message_text("این درخواست قبلا بررسی شده است.")
+        return
+    
+    outbox.send_text(deposit['ID-Telegram'], REVIEW_NOTICES["deposits", "Accept"].format(amount=deposit['amount']), PAYOUT)
+    await query.edit_message_text("درخواست واریز تأیید شد و موجودی کاربر بروزرسانی شد.")
+
+@callbacks.route("reject_deposit_", int)
+async def on_reject_deposit(query, context, deposit_id):
+    deposit = await storage.reject_deposit(deposit_id)
+    
+    if not deposit:
+        await query.edit_message_text("این درخواست قبلا بررسی شده است.")
+        return
+    
+    outbox.send_text(deposit['ID-Telegram'], REVIEW_NOTICES["deposits", "Reject"].format(amount=deposit['amount']), PAYOUT)
+    await query.edit_message_text("درخواست واریز رد شد.")
+
+@callbacks.route("accept_withdrawal_", int)
+async def on_accept_withdrawal(query, context, withdrawal_id):
+    withdrawal = await storage.accept_withdrawal(withdrawal_id)
+    
+    if not withdrawal:
+        await query.edit_message_text("این درخواست قبلا بررسی شده است.")
+        return
+    
+    outbox.send_text(withdrawal['ID-Telegram'], REVIEW_NOTICES["withdrawals", "Accept"].format(amount=withdrawal['amount']), PAYOUT)
+    await query.edit_message_text("درخواست برداشت تأیید شد.")
+
+@callbacks.route("reject_withdrawal_", int)
+async def on_reject_withdrawal(query, context, withdrawal_id):
+    withdrawal = storage.get_withdrawal(withdrawal_id)
+    
+    if not withdrawal:
+        await query.edit_message_text("درخواست یافت نشد.")
+        return
+    
+    # Flip status and return balance to user in one transaction
+    async with user_lock(withdrawal['ID-Telegram']):
+        withdrawal = await storage.reject_withdrawal(withdrawal_id)
+    
+    if not withdrawal:
+        await query.edit_message_text("این درخواست قبلا بررسی شده است.")
+        return
+    
+    outbox.send_text(withdrawal['ID-Telegram'], REVIEW_NOTICES["withdrawals", "Reject"].format(amount=withdrawal['amount']), PAYOUT)
+    await query.edit_message_text("درخواست برداشت رد شد و موجودی به کاربر برگردانده شد.")
+
+@callbacks.route("change_balance_", int)
+async def on_change_balance(query, context, user_id):
+    context.user_data['editing_user_balance'] = user_id
+    await query.edit_message_text("موجودی جدید را وارد کنید:")
+
+@callbacks.route("change_status_", int)
+async def on_change_status(query, context, user_id):
+    keyboard = [
+        [InlineKeyboardButton("فعال", callback_data=f"set_status_{user_id}_Active")],
+        [InlineKeyboardButton("غیرفعال", callback_data=f"set_status_{user_id}_Inactive")],
+        [InlineKeyboardButton("مسدود", callback_data=f"set_status_{user_id}_Blocked")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text("وضعیت جدید را انتخاب کنید:", reply_markup=reply_markup)
+
+@callbacks.route("set_status_", int)
+async def on_set_status(query, context, user_id, new_status):
+    storage.set_user_status(user_id, new_status)
+    
+    await query.edit_message_text(f"وضعیت کاربر به {new_status} تغییر یافت.")
+
+@callbacks.route("change_win")
+async def on_change_win(query, context):
+    context.user_data['changing_win_rate'] = True
+    await query.edit_message_text("درصد برد جدید را وارد کنید (0-100):")
+
+@callbacks.route("change_lose")
+async def on_change_lose(query, context):
+    context.user_data['changing_lose_rate'] = True
+    await query.edit_message_text("درصد باخت جدید را وارد کنید (0-100):")
+
+@callbacks.route("toggle_random")
+async def on_toggle_random(query, context):
+    logic = storage.get_logic()
+    logic['random'] = not logic['random']
+    await storage.set_logic(**logic)
+    
+    status = "فعال" if logic['random'] else "غیرفعال"
+    await query.edit_message_text(f"حالت تصادفی {status} شد.")
+
+@callbacks.route("admin_back")
+async def on_admin_back(query, context):
+    await admin_start_menu(query)
+
+@callbacks.route("admin_recount")
+async def on_admin_recount(query, context):
+    # Recomputes the header totals from the tables
+    await storage.rebuild_counters()
+    await query.edit_message_text("آمار کل از نو شمرده شد.\n\n" + admin_header(), reply_markup=ADMIN_MENU)
+
+def queue_counts(queue):
+    counts = queue.counts
+    return f"در انتظار: {counts.get('Pending', 0)} | تأیید شده: {counts.get('Accept', 0)} | رد شده: {counts.get('Reject', 0)}"
+
+def queue_navigation(prefix, queue, after_id, page):
+    navigation = []
+    if after_id:
+        navigation.append(InlineKeyboardButton("ابتدای صف", callback_data=prefix))
+    if page and queue.has_after(page[-1]['ID']):
+        navigation.append(InlineKeyboardButton("بعدی", callback_data=f"{prefix}_{page[-1]['ID']}"))
+    return [navigation] if navigation else []
+
+def request_line(request):
+    return f"ID: {request['ID']} | @{request['Username']} | مبلغ: {request['amount']} | روش: {request['side']}\n"
+
+async def show_requests(query, context, table, after_id=0):
+    requests = REQUEST_TABLES[table]
+    storage.sync_requests()
+    page = requests["pending"](after_id, REQUESTS_PAGE_SIZE)
+    
+    if not page:
+        await query.edit_message_text(f"درخواست {requests['title']} در انتظاری وجود ندارد.", reply_markup=ADMIN_BACK_MENU)
+        return
+    
+    # Requests resolved elsewhere drop out of the selection
+    selected = [request_id for request_id in context.user_data.get(f'selected_{table}', []) if requests["queue"].get(request_id)]
+    if selected:
+        context.user_data[f'selected_{table}'] = selected
+    else:
+        context.user_data.pop(f'selected_{table}', None)
+    
+    text = f"درخواست‌های {requests['title']} در انتظار:\n{queue_counts(requests['queue'])}\n\n"
+    keyboard = []
+    
+    for request in page:  # Oldest first
+        text += request_line(request)
+        mark = "☑" if request['ID'] in selected else "☐"
+        keyboard.append([
+            InlineKeyboardButton(f"بررسی {request['ID']}", callback_data=f"{requests['review']}_{request['ID']}"),
+            InlineKeyboardButton(f"{mark} انتخاب", callback_data=f"select_{table}_{request['ID']}_{after_id}")
+        ])
+    
+    keyboard.extend(queue_navigation(f"admin_{table}", requests["queue"], after_id, page))
+    if selected:
+        text += f"\nانتخاب شده: {len(selected)} درخواست"
+        keyboard.append([InlineKeyboardButton(f"{title} انتخاب‌شده‌ها", callback_data=f"bulk_{table}_{status}_selected")
+                         for status, title in REVIEW_TITLES.items()])
+    keyboard.append([InlineKeyboardButton("فیلتر و بررسی گروهی", callback_data=f"filter_{table}")])
+    keyboard.append([InlineKeyboardButton("برگشت", callback_data="admin_back")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+def parse_request_filter(text):
+    # "side=TRC20 amount=100-500 user=@name" -> keyword filters for
+    # storage.find_*; None if the text is not a valid filter
+    filters = {}
+    for part in text.split():
+        key, _, value = part.partition("=")
+        key = key.lower()
+        if not value:
+            return None
+        if key == "side":
+            filters['side'] = value
+        elif key == "amount":
+            low, dash, high = value.partition("-")
+            if not dash:
+                high = low
+            if not (low or high) or not all(bound.isdigit() for bound in (low, high) if bound):
+                return None
+            if low:
+                filters['min_amount'] = int(low)
+            if high:
+                filters['max_amount'] = int(high)
+        elif key == "user":
+            if value.isdigit():
+                filters['telegram_id'] = int(value)
+            else:
+                filters['username'] = value.lstrip("@")
+        else:
+            return None
+    return filters or None
+
+def user_line(user):
+    return f"ID: {user['ID']} | @{user['Username']} | موجودی: {user['Balance']} | وضعیت: {user['Status']}\n"
+
+async def show_user_page(query, sort, cursor=None, backward=False):
+    users, cursors, has_more = storage.page_users(sort, cursor, backward, USERS_PAGE_SIZE)
+    if not users and cursor is None:
+        await query.edit_message_text("کاربری یافت نشد.")
+        return
+    
+    text = f"کاربران (مرتب‌سازی: {USER_SORT_TITLES[sort]}):\n\n"
+    keyboard = []
+    
+    for user in users:
+        text += user_line(user)
+        keyboard.append([InlineKeyboardButton(f"ویرایش {user['Username']}", callback_data=f"edit_user_{user['ID']}")])
+    
+    # A page reached going forward always has rows before it, and vice versa
+    navigation = []
+    if cursors and (has_more if backward else cursor is not None):
+        value, user_id = cursors[0]
+        navigation.append(InlineKeyboardButton("قبلی", callback_data=f"users_{sort}_p_{value}_{user_id}"))
+    if cursors and (cursor is not None if backward else has_more):
+        value, user_id = cursors[-1]
+        navigation.append(InlineKeyboardButton("بعدی", callback_data=f"users_{sort}_n_{value}_{user_id}"))
+    if navigation:
+        keyboard.append(navigation)
+    
+    keyboard.append(USER_SORT_ROW)
+    keyboard.append([InlineKeyboardButton("جستجو", callback_data="search_users")])
+    keyboard.append([InlineKeyboardButton("برگشت", callback_data="admin_back")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+async def admin_start_menu(query):
+    await query.edit_message_text(admin_header(), reply_markup=ADMIN_MENU)
 
 async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
@@ -330,24 +561,38 @@ async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
         user_id = context.user_data['editing_user_balance']
         new_balance = int(text)
         
-        users = load_json(USER_DB)
-        for user in users:
-            if user['ID'] == user_id:
-                user['Balance'] = new_balance
-                break
-        save_json(USER_DB, users)
+        user = storage.get_user_by_id(user_id)
+        if user:
+            async with user_lock(user['ID-Telegram']):
+                await storage.set_user_balance(user_id, new_balance)
         
         await update.message.reply_text(f"موجودی کاربر به {new_balance} تومان تغییر یافت.")
         del context.user_data['editing_user_balance']
         
+    # Handle user search
+    elif context.user_data.get('searching_user'):
+        users = storage.search_users(text, USERS_PAGE_SIZE)
+        del context.user_data['searching_user']
+        
+        if not users:
+            await update.message.reply_text("کاربری یافت نشد.")
+            return
+        
+        reply_text = "نتایج جستجو:\n\n"
+        keyboard = []
+        for user in users:
+            reply_text += user_line(user)
+            keyboard.append([InlineKeyboardButton(f"ویرایش {user['Username']}", callback_data=f"edit_user_{user['ID']}")])
+        keyboard.append([InlineKeyboardButton("برگشت", callback_data="admin_users")])
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        await update.message.reply_text(reply_text, reply_markup=reply_markup)
+        
     # Handle win rate change
     elif context.user_data.get('changing_win_rate') and text.isdigit():
         win_rate = int(text)
         if 0 <= win_rate <= 100:
-            logic = load_json(LOGIC_DB)
-            logic[0]['win'] = win_rate
-            logic[0]['lose'] = 100 - win_rate
-            save_json(LOGIC_DB, logic)
+            await storage.set_logic(win_rate, 100 - win_rate, storage.get_logic()['random'])
             
             await update.message.reply_text(f"درصد برد به {win_rate}% تغییر یافت.")
         else:
@@ -359,25 +604,41 @@ async def admin_message_handler(update: Update, context: ContextTypes.DEFAULT_TY
     elif context.user_data.get('changing_lose_rate') and text.isdigit():
         lose_rate = int(text)
         if 0 <= lose_rate <= 100:
-            logic = load_json(LOGIC_DB)
-            logic[0]['lose'] = lose_rate
-            logic[0]['win'] = 100 - lose_rate
-            save_json(LOGIC_DB, logic)
+            await storage.set_logic(100 - lose_rate, lose_rate, storage.get_logic()['random'])
             
             await update.message.reply_text(f"درصد باخت به {lose_rate}% تغییر یافت.")
         else:
             await update.message.reply_text("لطفا عددی بین 0 تا 100 وارد کنید.")
         
         del context.user_data['changing_lose_rate']
-
-def main():
-    application = Application.builder().token(BOT_TOKEN).build()
-    
-    application.add_handler(CommandHandler("admin", admin_start))
-    application.add_handler(CallbackQueryHandler(admin_button_handler))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, admin_message_handler))
-    
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
-
-if __name__ == "__main__":
-    main()
+        
+    # Handle a bulk review filter: preview what it matches
+    elif context.user_data.get('filtering_requests'):
+        table = context.user_data.pop('filtering_requests')
+        requests = REQUEST_TABLES[table]
+        filters = parse_request_filter(text)
+        back = [InlineKeyboardButton("برگشت", callback_data=f"admin_{table}")]
+        
+        if filters is None:
+            await update.message.reply_text("فیلتر نامعتبر است.\n\n" + REQUEST_FILTER_HELP, reply_markup=InlineKeyboardMarkup([back]))
+            return
+        
+        storage.sync_requests()
+        matched = requests["find"](**filters)
+        if not matched:
+            await update.message.reply_text(f"درخواست {requests['title']} در انتظاری با این فیلتر یافت نشد.", reply_markup=InlineKeyboardMarkup([back]))
+            return
+        
+        context.user_data['request_filter'] = {"table": table, "request_ids": [request['ID'] for request in matched]}
+        reply_text = f"{len(matched)} درخواست {requests['title']} با این فیلتر:\n"
+        reply_text += f"مجموع مبلغ: {sum(request['amount'] for request in matched)} تومان | کاربران: {len({request['ID-Telegram'] for request in matched})}\n\n"
+        for request in matched[:REQUESTS_PAGE_SIZE * 2]:
+            reply_text += request_line(request)
+        if len(matched) > REQUESTS_PAGE_SIZE * 2:
+            reply_text += f"... و {len(matched) - REQUESTS_PAGE_SIZE * 2} درخواست دیگر\n"
+        
+        keyboard = [
+            [InlineKeyboardButton(f"{title} همه", callback_data=f"bulk_{table}_{status}_filter") for status, title in REVIEW_TITLES.items()],
+            back
+        ]
+        await update.message.reply_text(reply_text, reply_markup=InlineKeyboardMarkup(keyboard))
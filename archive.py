@@ -0,0 +1,169 @@
+import json
+import logging
+import os
+import shutil
+import time
+from datetime import date
+
+import numpy as np
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+# Old games move from the games table into column chunks under here
+ARCHIVE_DIR = os.environ.get('TOPTAS_ARCHIVE', 'archive')
+# Only games older than this are archived; it must exceed the longest
+# leaderboard window, which is rebuilt from unarchived games only
+ARCHIVE_AFTER_DAYS = 30
+ARCHIVE_MIN_ROWS = 50000
+CHUNK_ROWS = 250000
+
+# Column name -> dtype. Usernames, statuses and bet types are stored as
+# codes into per-chunk dictionaries; dates as seconds since the epoch of
+# their naive local time.
+COLUMNS = {
+    "id": np.int64,
+    "telegram_id": np.int64,
+    "username": np.int32,
+    "bet": np.int64,
+    "status": np.int8,
+    "time": np.int64,
+    "profit": np.int64,
+    "bet_type": np.int8,
+}
+ENCODED = {"username": "usernames", "status": "statuses", "bet_type": "bet_types"}
+
+class Chunk:
+    # One archived ID range. Columns are memory-mapped on first use, so a
+    # scan only pages in the columns it touches.
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.first_id = meta['first_id']
+        self.last_id = meta['last_id']
+        self.rows = meta['rows']
+        self.usernames = meta['usernames']
+        self.statuses = meta['statuses']
+        self.bet_types = meta['bet_types']
+        self._columns = {}
+
+    def column(self, name):
+        if name not in self._columns:
+            self._columns[name] = np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode='r')
+        return self._columns[name]
+
+    def dates(self, start=0, stop=None):
+        return np.datetime_as_string(self.column("time")[start:stop].astype('datetime64[s]'))
+
+    def records(self, batch_size=10000):
+        for start in range(0, self.rows, batch_size):
+            stop = min(start + batch_size, self.rows)
+            columns = {name: self.column(name)[start:stop].tolist() for name in COLUMNS if name != "time"}
+            dates = self.dates(start, stop).tolist()
+            for i in range(stop - start):
+                yield {
+                    "ID": columns["id"][i],
+                    "ID-Telegram": columns["telegram_id"][i],
+                    "Username": self.usernames[columns["username"][i]],
+                    "bet": columns["bet"][i],
+                    "status": self.statuses[columns["status"][i]],
+                    "date": dates[i],
+                    "profit": columns["profit"][i],
+                    "bet_type": self.bet_types[columns["bet_type"][i]]
+                }
+
+    def user_totals(self):
+        # (telegram_id, username, profit, volume, wins) per user in the chunk
+        telegram_ids, inverse = np.unique(self.column("telegram_id"), return_inverse=True)
+        profit = np.bincount(inverse, weights=self.column("profit"), minlength=len(telegram_ids))
+        volume = np.bincount(inverse, weights=self.column("bet"), minlength=len(telegram_ids))
+        win_code = self.statuses.index("win") if "win" in self.statuses else -1
+        wins = np.bincount(inverse, weights=self.column("status") == win_code, minlength=len(telegram_ids))
+        last = np.zeros(len(telegram_ids), np.int64)
+        np.maximum.at(last, inverse, np.arange(self.rows))
+        usernames = self.column("username")[last]
+        for i, telegram_id in enumerate(telegram_ids.tolist()):
+            yield telegram_id, self.usernames[usernames[i]], int(profit[i]), int(volume[i]), int(wins[i])
+
+def _chunk_name(first_id, last_id):
+    return os.path.join(ARCHIVE_DIR, f"chunk-{first_id:012d}-{last_id:012d}")
+
+def chunks():
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    names = sorted(n for n in os.listdir(ARCHIVE_DIR) if n.startswith("chunk-") and not n.endswith(".tmp"))
+    return [Chunk(os.path.join(ARCHIVE_DIR, n)) for n in names]
+
+def max_id():
+    archived = chunks()
+    return archived[-1].last_id if archived else 0
+
+def iter_games():
+    for chunk in chunks():
+        yield from chunk.records()
+
+def _encode(values):
+    dictionary = {}
+    codes = [dictionary.setdefault(value, len(dictionary)) for value in values]
+    return codes, list(dictionary)
+
+def _write_chunk(rows):
+    # rows are (id, telegram_id, username, bet, status, date, profit, bet_type)
+    first_id, last_id = rows[0][0], rows[-1][0]
+    final = _chunk_name(first_id, last_id)
+    path = final + ".tmp"
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+    ids, telegram_ids, usernames, bets, statuses, dates, profits, bet_types = zip(*rows)
+    meta = {"first_id": first_id, "last_id": last_id, "rows": len(rows)}
+    columns = {
+        "id": ids,
+        "telegram_id": telegram_ids,
+        "bet": bets,
+        "time": np.array([d[:19] for d in dates], dtype='datetime64[s]').astype(np.int64),
+        "profit": profits,
+    }
+    for name, values in (("username", usernames), ("status", statuses), ("bet_type", bet_types)):
+        columns[name], meta[ENCODED[name]] = _encode(values)
+
+    for name, dtype in COLUMNS.items():
+        with open(os.path.join(path, f"{name}.npy"), 'wb') as f:
+            np.save(f, np.asarray(columns[name], dtype=dtype))
+            f.flush()
+            os.fsync(f.fileno())
+    with open(os.path.join(path, "meta.json"), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path, final)
+    return first_id, last_id
+
+def archive_games():
+    # Moves games older than ARCHIVE_AFTER_DAYS out of the games table, one
+    # chunk at a time. A chunk is complete on disk before its rows are
+    # deleted; rows left behind by a crash in between are deleted on the
+    # next run.
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    archived_to = max_id()
+    if archived_to:
+        storage.delete_games(archived_to)
+
+    cutoff = date.fromordinal(date.today().toordinal() - ARCHIVE_AFTER_DAYS).isoformat()
+    if storage.count_games_before(cutoff) < ARCHIVE_MIN_ROWS:
+        return 0
+
+    moved = 0
+    while True:
+        started = time.perf_counter()
+        rows = storage.games_before(cutoff, CHUNK_ROWS)
+        if len(rows) < ARCHIVE_MIN_ROWS:
+            return moved
+        first_id, last_id = _write_chunk(rows)
+        storage.delete_games(last_id)
+        moved += len(rows)
+        logger.info("Archived games %d-%d (%d rows) in %.1fs", first_id, last_id, len(rows), time.perf_counter() - started)
+        if len(rows) < CHUNK_ROWS:
+            return moved
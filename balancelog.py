@@ -0,0 +1,108 @@
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+
+import shards
+
+logger = logging.getLogger(__name__)
+
+# Write-ahead log of balance-changing operations
+BALANCE_LOG_DIR = shards.local_dir(os.environ.get('TOPTAS_BALANCE_LOG', 'balance-log'))
+SEGMENT_MAX_BYTES = 16 * 1024 * 1024
+
+# Entry: body length and CRC32 of the body, then the body itself, a JSON
+# array [seq, op, args]
+_HEADER = struct.Struct("<II")
+
+def _segment_name(directory, first_seq):
+    return os.path.join(directory, f"balance-{first_seq:012d}.log")
+
+def _read_segment(path):
+    entries = []
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset < len(data):
+        if offset + _HEADER.size > len(data):
+            logger.warning("Torn entry header at the end of %s", path)
+            break
+        length, checksum = _HEADER.unpack_from(data, offset)
+        body = data[offset + _HEADER.size:offset + _HEADER.size + length]
+        if len(body) < length or zlib.crc32(body) != checksum:
+            # A torn or damaged write: nothing after it can be trusted
+            logger.warning("Bad balance log entry at offset %d of %s", offset, path)
+            break
+        entries.append(json.loads(body))
+        offset += _HEADER.size + length
+    return entries
+
+class BalanceLog:
+    # Every balance change is appended here before it touches the in-memory
+    # balances. The database records the highest sequence number its group
+    # commits have applied; on startup only the entries past it are
+    # replayed, and segments the database has fully caught up with are
+    # deleted as commits land.
+    def __init__(self, directory=None):
+        self.directory = directory or BALANCE_LOG_DIR
+        self.next_seq = 1
+        self._lock = threading.Lock()
+        self._segments = []  # (first seq, path), oldest first
+        self._file = None
+
+    def open(self, applied_seq):
+        # Returns the entries the database has not applied yet, oldest first
+        os.makedirs(self.directory, exist_ok=True)
+        names = sorted(n for n in os.listdir(self.directory) if n.startswith("balance-") and n.endswith(".log"))
+        pending = []
+        last_seq = applied_seq
+        for name in names:
+            path = os.path.join(self.directory, name)
+            self._segments.append((int(name[len("balance-"):-len(".log")]), path))
+            for seq, op, args in _read_segment(path):
+                last_seq = max(last_seq, seq)
+                if seq > applied_seq:
+                    pending.append((seq, op, args))
+        self.next_seq = last_seq + 1
+        self._open_segment()
+        return pending
+
+    def _open_segment(self):
+        if self._file is not None:
+            self._file.close()
+        path = _segment_name(self.directory, self.next_seq)
+        self._file = open(path, 'ab')
+        # After an idle run the last segment is empty and named for next_seq
+        # already: append to it rather than listing it twice
+        if not self._segments or self._segments[-1][1] != path:
+            self._segments.append((self.next_seq, path))
+
+    def append(self, op, *args):
+        with self._lock:
+            seq = self.next_seq
+            body = json.dumps([seq, op, args], ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            self._file.write(_HEADER.pack(len(body), zlib.crc32(body)) + body)
+            # Handed to the OS right away, so a crashed process loses nothing
+            self._file.flush()
+            self.next_seq += 1
+            if self._file.tell() >= SEGMENT_MAX_BYTES:
+                self._open_segment()
+            return seq
+
+    def checkpoint(self, applied_seq):
+        # A segment is obsolete once the database has applied everything up
+        # to the first entry of the segment after it
+        with self._lock:
+            while len(self._segments) > 1 and self._segments[1][0] - 1 <= applied_seq:
+                if self._file is not None and self._segments[0][1] == self._file.name:
+                    break  # never the segment being written
+                _, path = self._segments.pop(0)
+                os.remove(path)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
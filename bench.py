@@ -0,0 +1,262 @@
+# Offline load test: replays synthetic updates through the real handlers
+# against a stub bot, without any connection to Telegram.
+#
+#   python bench.py --users 2000 --rounds 3 --latency 0.005 --sizes 0,10000,100000
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+import admin
+import archive
+import balancelog
+import config
+import flood
+import gamelog
+import main
+import sender
+import storage
+
+class StubChatMember:
+    def __init__(self, status):
+        self.status = status
+
+class StubBot:
+    # Every API call sleeps for `latency` seconds and is counted
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    async def _call(self):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def get_chat_member(self, chat_id, user_id):
+        await self._call()
+        return StubChatMember("member")
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        await self._call()
+
+    async def send_dice(self, chat_id, emoji=None):
+        await self._call()
+
+class StubUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = f"user{user_id}"
+        self.first_name = f"User {user_id}"
+
+class StubMessage:
+    def __init__(self, bot, text):
+        self.bot = bot
+        self.text = text
+
+    async def reply_text(self, text, reply_markup=None):
+        await self.bot._call()
+
+    async def reply_dice(self, emoji=None):
+        await self.bot._call()
+
+class StubCallbackQuery:
+    def __init__(self, bot, user, data):
+        self.bot = bot
+        self.from_user = user
+        self.data = data
+
+    async def answer(self):
+        await self.bot._call()
+
+    async def edit_message_text(self, text, reply_markup=None):
+        await self.bot._call()
+
+class StubUpdate:
+    def __init__(self, user, message=None, callback_query=None):
+        self.effective_user = user
+        self.effective_chat = user
+        self.message = message
+        self.callback_query = callback_query
+
+class StubContext:
+    def __init__(self, bot):
+        self.bot = bot
+        self.user_data = {}
+
+class Simulation:
+    def __init__(self, latency):
+        self.bot = StubBot(latency)
+        self.contexts = {}
+        self.timings = {}
+        self.flood_control = flood.FloodControl(exempt=admin.is_admin)
+
+    def context(self, user_id):
+        if user_id not in self.contexts:
+            self.contexts[user_id] = StubContext(self.bot)
+        return self.contexts[user_id]
+
+    async def _timed(self, name, handler, update, context):
+        started = time.perf_counter()
+        await handler(update, context)
+        self.timings.setdefault(name, []).append(time.perf_counter() - started)
+
+    async def command(self, handler, user_id, text):
+        user = StubUser(user_id)
+        update = StubUpdate(user, message=StubMessage(self.bot, text))
+        await self._timed(handler.__name__, handler, update, self.context(user_id))
+
+    async def text(self, user_id, text):
+        user = StubUser(user_id)
+        update = StubUpdate(user, message=StubMessage(self.bot, text))
+        await self._timed("handle_message", main.route_message, update, self.context(user_id))
+
+    async def click(self, handler, user_id, data):
+        user = StubUser(user_id)
+        update = StubUpdate(user, callback_query=StubCallbackQuery(self.bot, user, data))
+        name = f"{handler.__name__}:{data.split('_')[0]}"
+        await self._timed(name, handler, update, self.context(user_id))
+
+    async def player(self, user_id, rounds):
+        await self.command(main.start, user_id, "/start")
+        for _ in range(rounds):
+            await self.click(main.button_handler, user_id, "play")
+            await self.click(main.button_handler, user_id, random.choice(["bet_even", "bet_odd", "bet_3"]))
+            await self.text(user_id, str(random.choice([5000, 10000, 20000])))
+        await self.click(main.button_handler, user_id, "leaderboard")
+        await self.click(main.button_handler, user_id, "deposit")
+        await self.text(user_id, "150000")
+        await self.click(main.button_handler, user_id, "deposit_TRC20")
+        await self.text(user_id, "tx-hash")
+
+    async def spammer(self, user_id, taps):
+        # Taps as fast as the client allows; only what flood control admits
+        # reaches the handler (and the timings)
+        await self.command(main.start, user_id, "/start")
+        for tap in range(taps):
+            user = StubUser(user_id)
+            data = "play" if tap % 2 else "leaderboard"
+            update = StubUpdate(user, callback_query=StubCallbackQuery(self.bot, user, data))
+            await self.flood_control.do_process_update(
+                update, self._timed(f"button_handler:{data}", main.button_handler, update, self.context(user_id))
+            )
+
+    async def admin(self, rounds):
+        for _ in range(rounds):
+            for data in ("admin_users", "users_balance", "admin_deposits", "admin_withdrawals", "admin_logic", "admin_stats_weekly", "admin_back"):
+                await self.click(admin.admin_button_handler, config.get().admin_id, data)
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+def data_size(workdir):
+    total = 0
+    for root, _, files in os.walk(workdir):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+def seed_history(games, users):
+    # Bulk-load past games straight into the games table
+    now = datetime.now().isoformat()
+    batch = []
+    first_id = storage.max_game_id() + 1
+    for game_id in range(first_id, first_id + games):
+        user_id = random.randrange(users) + 1
+        won = random.random() < 0.5
+        batch.append({
+            "ID": game_id, "ID-Telegram": user_id, "Username": f"user{user_id}",
+            "bet": 5000, "status": "win" if won else "lose", "date": now, "profit": 5000 if won else -5000,
+            "bet_type": random.choice(["even", "odd"])
+        })
+        if len(batch) == 10000:
+            storage.add_games(batch)
+            batch = []
+    if batch:
+        storage.add_games(batch)
+
+async def run_phase(users, rounds, latency, spammers, taps):
+    simulation = Simulation(latency)
+    sender.outbox.bot = simulation.bot
+    main.membership_cache.__init__(config.get().required_channels)
+    for user_id in range(1, users + spammers + 1):
+        storage.create_user(user_id, f"user{user_id}")
+        balance = storage.get_user(user_id)['Balance']
+        if balance < 1000000:
+            storage.update_user_balance(user_id, 1000000 - balance, account="adjustment", ref="bench")
+
+    started = time.perf_counter()
+    await asyncio.gather(
+        simulation.admin(rounds * 10),
+        *(simulation.player(user_id, rounds) for user_id in range(1, users + 1)),
+        *(simulation.spammer(user_id, taps) for user_id in range(users + 1, users + spammers + 1))
+    )
+    elapsed = time.perf_counter() - started
+    await sender.outbox.drain()
+    return simulation, elapsed, time.perf_counter() - started
+
+def report(size_label, simulation, elapsed, delivered, workdir):
+    total = sum(len(values) for values in simulation.timings.values())
+    print(f"\n== history: {size_label} games | data on disk: {data_size(workdir) / 1024 / 1024:.1f} MB")
+    print(f"updates: {total} in {elapsed:.2f}s -> {total / elapsed:.0f} updates/s, {simulation.bot.calls} API calls")
+    print(f"outbox: all messages sent after {delivered:.2f}s | {sender.outbox.stats()}")
+    print(f"flood control (spammers only): {simulation.flood_control.stats()}")
+    print(f"{'handler':<36}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, values in sorted(simulation.timings.items()):
+        values.sort()
+        print(f"{name:<36}{len(values):>8}"
+              f"{percentile(values, 0.50) * 1000:>10.2f}{percentile(values, 0.95) * 1000:>10.2f}{percentile(values, 0.99) * 1000:>10.2f}")
+
+async def run_all(args, workdir):
+    sender.outbox.global_bucket = sender.TokenBucket(args.send_rate, args.send_rate)
+    sender.outbox.start(None)
+    for size in (int(s) for s in args.sizes.split(",")):
+        # Reopen the journal so its ID sequence continues after the seeded rows
+        gamelog.close_log()
+        seed_history(max(0, size - storage.max_game_id()), args.users)
+        gamelog.open_log()
+        main.game_stats.__init__()
+        main.load_history()
+        simulation, elapsed, delivered = await run_phase(args.users, args.rounds, args.latency, args.spammers, args.taps)
+        storage.flush()
+        report(size, simulation, elapsed, delivered, workdir)
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Replay synthetic updates through the bot handlers")
+    parser.add_argument("--users", type=int, default=1000, help="concurrent simulated users")
+    parser.add_argument("--rounds", type=int, default=3, help="bets per user")
+    parser.add_argument("--latency", type=float, default=0.005, help="stub Telegram API latency in seconds")
+    parser.add_argument("--sizes", default="0,10000,100000", help="total game history sizes to measure at")
+    parser.add_argument("--send-rate", type=float, default=1000, help="outbox global messages/s (Telegram allows about 30)")
+    parser.add_argument("--spammers", type=int, default=5, help="users hammering buttons alongside the players")
+    parser.add_argument("--taps", type=int, default=200, help="button taps per spammer")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary data directory")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    workdir = tempfile.mkdtemp(prefix="toptas-bench-")
+    try:
+        os.chdir(workdir)
+        gamelog.GAME_LOG_DIR = os.path.join(workdir, "games")
+        archive.ARCHIVE_DIR = os.path.join(workdir, "archive")
+        balancelog.BALANCE_LOG_DIR = os.path.join(workdir, "balance-log")
+        storage.init_db(os.path.join(workdir, "bench.db"))
+        gamelog.open_log()
+        asyncio.run(run_all(args, workdir))
+    finally:
+        gamelog.close_log()
+        storage.close_db()
+        if args.keep:
+            print(f"\ndata kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,106 @@
+import json
+import logging
+import os
+import threading
+import time
+from types import MappingProxyType
+from typing import NamedTuple
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+# Bot settings. config.json (optional) overrides the defaults below and
+# wallet.json holds the deposit addresses. Both are read into one immutable
+# snapshot, replaced whole when either file changes or on /reload; readers
+# only touch memory; the files are stat'ed at most every CHECK_INTERVAL.
+CONFIG_PATH = os.environ.get('TOPTAS_CONFIG', 'config.json')
+CHECK_INTERVAL = float(os.environ.get('TOPTAS_CONFIG_CHECK_INTERVAL', 5))
+DEFAULTS = {
+    "admin_id": 58573285,
+    "required_channels": ["@Topdieshistory", "@Toptasbet"],
+    "min_bet": 5000,
+    "min_deposit": 100000,
+    "min_withdrawal": 500000
+}
+
+class Settings(NamedTuple):
+    admin_id: int
+    required_channels: tuple
+    min_bet: int
+    min_deposit: int
+    min_withdrawal: int
+    wallets: MappingProxyType  # side -> address, empty without wallet.json
+
+_lock = threading.Lock()
+_snapshot = None
+_versions = None
+_next_check = 0.0
+_listeners = []
+
+def _version(path):
+    # A replaced file (new inode) counts as changed even if its mtime did not move
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def _read_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _build():
+    values = dict(DEFAULTS)
+    overrides = _read_json(CONFIG_PATH, {})
+    unknown = sorted(set(overrides) - set(DEFAULTS))
+    if unknown:
+        raise ValueError(f"unknown settings in {CONFIG_PATH}: {', '.join(unknown)}")
+    values.update(overrides)
+    # wallet.json keeps the legacy layout, a one-element array
+    wallets = _read_json(storage.WALLET_DB, [{}])
+    return Settings(
+        admin_id=int(values["admin_id"]),
+        required_channels=tuple(values["required_channels"]),
+        min_bet=int(values["min_bet"]),
+        min_deposit=int(values["min_deposit"]),
+        min_withdrawal=int(values["min_withdrawal"]),
+        wallets=MappingProxyType(dict(wallets[0] if wallets else {}))
+    )
+
+def reload(force=False):
+    # Installs a new snapshot if a file changed (or always, with force) and
+    # returns whether it did. A file that fails to load raises and leaves
+    # the current snapshot in place.
+    global _snapshot, _versions, _next_check
+    with _lock:
+        _next_check = time.monotonic() + CHECK_INTERVAL
+        versions = (_version(CONFIG_PATH), _version(storage.WALLET_DB))
+        if versions == _versions and not force:
+            return False
+        # Remembered before building, so a broken file is not retried at
+        # every check, only once it changes again
+        _versions = versions
+        snapshot = _build()
+        _snapshot = snapshot
+    logger.info("Settings loaded: %s", snapshot._replace(wallets=dict(snapshot.wallets)))
+    for listener in _listeners:
+        listener(snapshot)
+    return True
+
+def get():
+    if time.monotonic() >= _next_check:
+        try:
+            reload()
+        except (OSError, ValueError, TypeError, KeyError, IndexError) as e:
+            if _snapshot is None:
+                raise
+            logger.error("Keeping the current settings: %s", e)
+    return _snapshot
+
+def subscribe(listener):
+    # listener(settings) runs now and after every reload
+    _listeners.append(listener)
+    listener(get())
@@ -0,0 +1,255 @@
+# Streaming import/export for the bot's data, in constant memory.
+#
+#   python datatool.py import [users games deposits withdrawals] [--db toptas.db]
+#   python datatool.py export games --format csv --out games.csv --user 123 --since 2024-01-01
+#   python datatool.py export deposits --source json --status Pending --out pending.jsonl
+#
+# The legacy JSON arrays are parsed one element at a time (jsonstream.py).
+# Both commands can be interrupted and picked up again: import keeps its
+# byte offset per file in the database, committed with each batch, and
+# export keeps its position next to the output file (--resume).
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import archive
+import jsonstream
+import storage
+
+BATCH_SIZE = 5000
+PROGRESS_INTERVAL = 0.5
+
+PROGRESS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS import_progress (
+    source TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL,
+    records INTEGER NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# Column the --min-amount/--max-amount filters apply to
+AMOUNT_COLUMNS = {"users": "balance", "games": "bet", "deposits": "amount", "withdrawals": "amount"}
+
+class Progress:
+    # One status line on stderr, redrawn at most every PROGRESS_INTERVAL
+    def __init__(self, label, total=None, resumed_at=0):
+        self.label = label
+        self.total = total
+        self.resumed_at = resumed_at
+        self.started = time.monotonic()
+        self.shown = 0.0
+
+    def update(self, records, position=None, force=False):
+        now = time.monotonic()
+        if not force and now - self.shown < PROGRESS_INTERVAL:
+            return
+        self.shown = now
+        line = f"{self.label}: {records} records, {(records - self.resumed_at) / max(now - self.started, 1e-9):.0f}/s"
+        if self.total and position is not None:
+            line += f", {position / self.total:.1%}"
+        sys.stderr.write("\r" + line)
+        sys.stderr.flush()
+
+    def done(self, records, position=None):
+        self.update(records, position, force=True)
+        sys.stderr.write("\n")
+
+# Import
+
+def import_table(conn, table, batch_size, restart):
+    file_path, fields = storage.LEGACY_TABLES[table]
+    if not os.path.exists(file_path):
+        print(f"{table}: {file_path} not found, skipped")
+        return
+    if restart:
+        conn.execute("DELETE FROM import_progress WHERE source = ?", (file_path,))
+    row = conn.execute("SELECT offset, records, done FROM import_progress WHERE source = ?", (file_path,)).fetchone()
+    offset, records, done = row or (0, 0, 0)
+    if done:
+        print(f"{table}: {file_path} already imported ({records} records), use --restart to import it again")
+        return
+    if offset:
+        print(f"{table}: resuming {file_path} at byte {offset} after {records} records")
+
+    insert = f"INSERT OR IGNORE INTO {table} ({storage._columns(fields)}) VALUES ({', '.join('?' for _ in fields)})"
+    progress = Progress(table, os.path.getsize(file_path), records)
+    batch = []
+
+    def commit(position, finished=False):
+        # Rows and the offset after them land in the same transaction, so a
+        # resumed import neither skips nor repeats a record
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(insert, batch)
+        conn.execute(
+            "INSERT OR REPLACE INTO import_progress (source, offset, records, done) VALUES (?, ?, ?, ?)",
+            (file_path, position, records, int(finished))
+        )
+        conn.execute("COMMIT")
+        batch.clear()
+
+    for record, position in jsonstream.iter_array(file_path, offset):
+        batch.append(tuple(record.get(key) for _, key in fields))
+        records += 1
+        if len(batch) >= batch_size:
+            commit(position)
+            progress.update(records, position)
+    commit(os.path.getsize(file_path), finished=True)
+    progress.done(records, os.path.getsize(file_path))
+
+def run_import(args):
+    conn = storage.connect(args.db)
+    conn.executescript(PROGRESS_SCHEMA)
+    try:
+        for table in args.tables or storage.LEGACY_TABLES:
+            import_table(conn, table, args.batch_size, args.restart)
+    finally:
+        conn.close()
+
+# Export
+
+def _db_records(conn, table, position, batch_size):
+    # In ID order; for games the archived chunks come first
+    fields = storage.LEGACY_TABLES[table][1]
+    last_id = position or 0
+    if table == "games":
+        for chunk in archive.chunks():
+            if chunk.last_id <= last_id:
+                continue
+            for record in chunk.records():
+                if record['ID'] > last_id:
+                    yield record, record['ID']
+            last_id = chunk.last_id
+    while True:
+        rows = conn.execute(
+            f"SELECT {storage._columns(fields)} FROM {table} WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield storage._record(row, fields), row[0]
+        last_id = rows[-1][0]
+
+def record_filter(table, args):
+    amount_key = dict(storage.LEGACY_TABLES[table][1])[AMOUNT_COLUMNS[table]]
+
+    def matches(record):
+        if args.user is not None and record.get('ID-Telegram') != args.user:
+            return False
+        if args.status is not None and record.get('status', record.get('Status')) != args.status:
+            return False
+        if args.min_amount is not None and (record.get(amount_key) or 0) < args.min_amount:
+            return False
+        if args.max_amount is not None and (record.get(amount_key) or 0) > args.max_amount:
+            return False
+        # Dates are ISO strings, so a prefix comparison is a date comparison
+        if args.since is not None and (record.get('date') or "") < args.since:
+            return False
+        if args.until is not None and (record.get('date') or "")[:len(args.until)] > args.until:
+            return False
+        return True
+    return matches
+
+def _save_position(progress_path, position, written, size):
+    tmp_path = progress_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"position": position, "written": written, "size": size}, f)
+    os.replace(tmp_path, progress_path)
+
+def run_export(args):
+    table = args.table
+    keys = [key for _, key in storage.LEGACY_TABLES[table][1]]
+    progress_path = args.out + ".progress"
+
+    state = {"position": None, "written": 0, "size": 0}
+    if args.resume and os.path.exists(progress_path):
+        with open(progress_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        print(f"resuming {args.out} after {state['written']} records")
+    # Anything written after the last saved position is written again
+    with open(args.out, 'r+b' if state['size'] else 'wb') as f:
+        f.truncate(state['size'])
+    out = open(args.out, 'a', encoding='utf-8', newline='')
+
+    conn = None
+    if args.source == "json":
+        file_path = storage.LEGACY_TABLES[table][0]
+        records = jsonstream.iter_array(file_path, state['position'] or 0)
+        total = os.path.getsize(file_path)
+    else:
+        conn = sqlite3.connect(args.db)
+        records = _db_records(conn, table, state['position'], args.batch_size)
+        total = None
+
+    writer = csv.DictWriter(out, keys, extrasaction='ignore') if args.format == "csv" else None
+    if writer is not None and not state['size']:
+        writer.writeheader()
+
+    matches = record_filter(table, args)
+    written = state['written']
+    progress = Progress(f"{table} -> {args.out}", total, written)
+    scanned = 0
+    try:
+        for record, position in records:
+            if matches(record):
+                if writer is not None:
+                    writer.writerow(record)
+                else:
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                written += 1
+            scanned += 1
+            if scanned % args.batch_size == 0:
+                # The output is on disk before the position that covers it
+                out.flush()
+                os.fsync(out.fileno())
+                _save_position(progress_path, position, written, os.fstat(out.fileno()).st_size)
+                progress.update(written, position if total else None)
+        out.flush()
+        os.fsync(out.fileno())
+    finally:
+        out.close()
+        if conn is not None:
+            conn.close()
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
+    progress.done(written, total)
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream the bot's JSON data files into SQLite or out to CSV/JSONL")
+    parser.add_argument("--db", default=storage.DB_PATH, help="SQLite database (default: %(default)s)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="records per transaction / checkpoint")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    importer = commands.add_parser("import", help="import the legacy JSON arrays into the database")
+    importer.add_argument("tables", nargs="*", metavar="table", help=f"{', '.join(storage.LEGACY_TABLES)} (default: all)")
+    importer.add_argument("--restart", action="store_true", help="ignore saved progress and start from the beginning")
+
+    exporter = commands.add_parser("export", help="export a filtered slice as CSV or JSON Lines")
+    exporter.add_argument("table", choices=list(storage.LEGACY_TABLES))
+    exporter.add_argument("--out", required=True, help="output file")
+    exporter.add_argument("--format", choices=("csv", "jsonl"), default="jsonl")
+    exporter.add_argument("--source", choices=("db", "json"), default="db", help="database (with archived games) or legacy JSON file")
+    exporter.add_argument("--resume", action="store_true", help="continue an interrupted export of --out")
+    exporter.add_argument("--user", type=int, help="Telegram ID")
+    exporter.add_argument("--status", help="e.g. Pending, Accept, win")
+    exporter.add_argument("--min-amount", type=int)
+    exporter.add_argument("--max-amount", type=int)
+    exporter.add_argument("--since", help="first date, YYYY-MM-DD (games)")
+    exporter.add_argument("--until", help="last date, YYYY-MM-DD (games)")
+
+    args = parser.parse_args()
+    unknown = [table for table in getattr(args, "tables", ()) if table not in storage.LEGACY_TABLES]
+    if unknown:
+        parser.error(f"unknown table: {', '.join(unknown)}")
+    if args.command == "import":
+        run_import(args)
+    else:
+        run_export(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+from sender import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Per user: a steady rate of updates with short bursts on top
+USER_RATE = float(os.environ.get('FLOOD_USER_RATE', 2))
+USER_BURST = int(os.environ.get('FLOOD_USER_BURST', 8))
+# The same button or text again within this many seconds is a double send
+DEDUP_WINDOW = 1.5
+# Updates handled at once across all users; beyond that new ones are shed
+MAX_CONCURRENT = int(os.environ.get('FLOOD_MAX_CONCURRENT', 256))
+# Users tracked at once; the least recently seen are forgotten first
+MAX_TRACKED_USERS = 50000
+
+class _Sender:
+    __slots__ = ("bucket", "last_key", "last_at")
+
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.last_key = None
+        self.last_at = 0.0
+
+def _update_key(update):
+    # What the update asks for, for spotting repeats; None = not controlled
+    if update.callback_query is not None:
+        return "callback", update.callback_query.data
+    if update.message is not None:
+        return "message", update.message.text
+    return None
+
+class FloodControl(BaseUpdateProcessor):
+    # Admission control in front of every handler (it is the application's
+    # update processor). Messages and button taps from one user are
+    # rate-limited by a token bucket, exact repeats within DEDUP_WINDOW are
+    # dropped, and nothing new is admitted while MAX_CONCURRENT updates are
+    # in flight. A dropped update costs a dict lookup: no storage access, no
+    # API call (a dropped tap is not even answered). Other updates, such as
+    # membership changes, always go through.
+    def __init__(self, max_concurrent=MAX_CONCURRENT, rate=USER_RATE, burst=USER_BURST,
+                 max_users=MAX_TRACKED_USERS, exempt=None):
+        # The base class queues updates beyond its limit; with room for twice
+        # the cap it never has to, and shedding happens here instead
+        super().__init__(max_concurrent * 2)
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.exempt = exempt  # Telegram ID -> bool, for users never limited
+        self.inflight = 0
+        self.counts = {"admitted": 0, "duplicate": 0, "rate_limited": 0, "busy": 0}
+        self._senders = OrderedDict()  # telegram_id -> _Sender, least recently seen first
+
+    def admit(self, update):
+        # Returns the reason to drop the update, or None once it is admitted;
+        # an admitted update must be followed by done()
+        key = _update_key(update)
+        user = update.effective_user
+        if key is None or user is None or (self.exempt is not None and self.exempt(user.id)):
+            self.inflight += 1
+            return None
+
+        now = time.monotonic()
+        sender = self._senders.get(user.id)
+        if sender is None:
+            sender = self._senders[user.id] = _Sender(self.rate, self.burst)
+            if len(self._senders) > self.max_users:
+                self._senders.popitem(last=False)
+        else:
+            self._senders.move_to_end(user.id)
+
+        if key == sender.last_key and now - sender.last_at < DEDUP_WINDOW:
+            reason = "duplicate"
+        elif self.inflight >= self.max_concurrent:
+            reason = "busy"
+        elif sender.bucket.wait_time(now) > 0:
+            reason = "rate_limited"
+        else:
+            reason = None
+            sender.bucket.take()
+            sender.last_key = key
+            sender.last_at = now
+            self.inflight += 1
+
+        result = reason or "admitted"
+        self.counts[result] += 1
+        metrics.increment("flood", result)
+        return reason
+
+    def done(self):
+        self.inflight -= 1
+
+    def stats(self):
+        return dict(self.counts, inflight=self.inflight, tracked_users=len(self._senders))
+
+    async def do_process_update(self, update, coroutine):
+        if self.admit(update) is not None:
+            coroutine.close()
+            return
+        try:
+            await coroutine
+        finally:
+            self.done()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import archive
+import shards
+import storage
+
+logger = logging.getLogger(__name__)
+
+# Append-only game journal (JSON Lines), split into segments
+GAME_LOG_DIR = shards.local_dir(os.environ.get('TOPTAS_GAME_LOG', 'games'))
+SEGMENT_MAX_BYTES = 4 * 1024 * 1024
+SEGMENT_MAX_AGE = 3600
+COMPACT_INTERVAL = 60
+ARCHIVE_INTERVAL = 3600
+
+_lock = threading.Lock()
+_segment = None
+_segment_path = None
+_segment_opened = 0
+_next_id = 1
+_compactor = None
+_stop = threading.Event()
+# ISO day -> [games, volume] of games still in the journal, which the
+# daily_volume table does not count yet
+_journal_volume = {}
+
+def _count_journal(games, sign):
+    for game in games:
+        entry = _journal_volume.setdefault(game['date'][:10], [0, 0])
+        entry[0] += sign
+        entry[1] += sign * game['bet']
+
+def journal_volume(day):
+    with _lock:
+        return tuple(_journal_volume.get(day, (0, 0)))
+
+def _segment_name(first_id):
+    return os.path.join(GAME_LOG_DIR, f"games-{first_id:012d}.jsonl")
+
+def _segments():
+    names = sorted(n for n in os.listdir(GAME_LOG_DIR) if n.startswith("games-") and n.endswith(".jsonl"))
+    return [os.path.join(GAME_LOG_DIR, n) for n in names]
+
+def _read_segment(path):
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A torn last line from a crash mid-append
+                logger.warning("Skipping damaged line in %s", path)
+    return records
+
+def _last_id(path):
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 4096))
+        for line in reversed(f.read().splitlines()):
+            try:
+                return json.loads(line)['ID']
+            except (ValueError, KeyError):
+                continue
+    return 0
+
+def _open_segment():
+    global _segment, _segment_path, _segment_opened
+    _segment_path = _segment_name(_next_id)
+    _segment = open(_segment_path, 'a', encoding='utf-8')
+    _segment_opened = time.monotonic()
+
+def _rotate_if_needed():
+    if _segment.tell() >= SEGMENT_MAX_BYTES or time.monotonic() - _segment_opened >= SEGMENT_MAX_AGE:
+        _segment.close()
+        _open_segment()
+
+def open_log():
+    global _next_id
+    os.makedirs(GAME_LOG_DIR, exist_ok=True)
+    with _lock:
+        last = max(storage.max_game_id(), archive.max_id())
+        segments = _segments()
+        if segments:
+            last = max(last, _last_id(segments[-1]))
+        _next_id = shards.next_id(last)
+        _journal_volume.clear()
+        for path in segments:
+            _count_journal(_read_segment(path), 1)
+        _open_segment()
+
+def reserve_id():
+    # The ID of a game before it is appended (its balance change is posted
+    # to the ledger first). Append it before the next await, so the journal
+    # stays in ID order; an ID that is never used only leaves a gap.
+    global _next_id
+    with _lock:
+        game_id = _next_id
+        _next_id = shards.next_id(_next_id)
+        return game_id
+
+def append_game(telegram_id, username, bet, status, date, profit, bet_type=None, game_id=None):
+    global _next_id
+    with _lock:
+        if game_id is None:
+            game_id = _next_id
+            _next_id = shards.next_id(_next_id)
+        record = {
+            "ID": game_id,
+            "ID-Telegram": telegram_id,
+            "Username": username,
+            "bet": bet,
+            "status": status,
+            "date": date,
+            "profit": profit,
+            "bet_type": bet_type
+        }
+        _segment.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n")
+        _segment.flush()
+        _count_journal((record,), 1)
+        _rotate_if_needed()
+    return record
+
+def iter_games(archived=True):
+    # Archived history first, then the games table, then whatever is still
+    # in the journal. Rows already archived but not yet deleted are skipped.
+    archived_to = archive.max_id()
+    if archived:
+        yield from archive.iter_games()
+    yield from storage.iter_games(archived_to)
+    with _lock:
+        if _segment is not None:
+            _segment.flush()
+        segments = _segments()
+    for path in segments:
+        yield from _read_segment(path)
+
+def compact():
+    global _next_id
+    # Move closed segments into the games table, one transaction per segment
+    with _lock:
+        closed = [path for path in _segments() if path != _segment_path]
+    for path in closed:
+        games = _read_segment(path)
+        storage.add_games(games)
+        with _lock:
+            _count_journal(games, -1)
+        os.remove(path)
+    if shards.SHARD_COUNT > 1:
+        # Keep up with the other shards' IDs, so game IDs still grow with
+        # time across shards and the archiver's ID cut-off stays valid
+        resume_at = shards.next_id(storage.max_game_id())
+        with _lock:
+            _next_id = max(_next_id, resume_at)
+    return len(closed)
+
+def _compact_loop():
+    archived_at = time.monotonic()
+    while not _stop.wait(COMPACT_INTERVAL):
+        try:
+            with _lock:
+                _rotate_if_needed()
+            compact()
+            # One archiver for all shards
+            if shards.SHARD == 0 and time.monotonic() - archived_at >= ARCHIVE_INTERVAL:
+                archived_at = time.monotonic()
+                archive.archive_games()
+        except Exception:
+            logger.exception("Game log compaction failed")
+
+def start_compactor():
+    global _compactor
+    _stop.clear()
+    _compactor = threading.Thread(target=_compact_loop, name="gamelog-compactor", daemon=True)
+    _compactor.start()
+
+def close_log():
+    global _segment, _segment_path, _compactor
+    _stop.set()
+    if _compactor is not None:
+        _compactor.join()
+        _compactor = None
+    with _lock:
+        if _segment is not None:
+            _segment.close()
+            _segment = None
+            _segment_path = None
+    compact()
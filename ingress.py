@@ -0,0 +1,320 @@
+# Webhook front end: one HTTP listener takes the updates Telegram pushes and
+# hands each one to the worker process that owns its user (see shards.py).
+# A user's updates are always handled by the same process, in order; the
+# workers share nothing but the database.
+#
+#   python ingress.py serve --workers 4 --port 8443 --url https://bot.example.com/telegram
+#   python ingress.py serve --workers 2 --offline --record updates.jsonl
+#   python ingress.py replay updates.jsonl --target http://127.0.0.1:8443/telegram
+#
+# --offline answers the workers' Bot API calls locally, so recorded traffic
+# can be replayed through the real handlers without touching Telegram.
+
+import argparse
+import asyncio
+import hmac
+import importlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import signal
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram.request import BaseRequest
+
+import shards
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = os.environ.get('TOPTAS_WEBHOOK_SECRET')
+MAX_BODY_BYTES = 1 << 20
+# Updates waiting per worker; when a worker falls this far behind, Telegram
+# gets a 503 and delivers the update again later
+QUEUE_SIZE = 10000
+QUEUE_TIMEOUT = 1.0
+WATCH_INTERVAL = 1.0
+
+def update_user(data):
+    # The Telegram ID an update belongs to, or None
+    for kind, value in data.items():
+        if not isinstance(value, dict):
+            continue
+        if kind in ("chat_member", "my_chat_member"):
+            return value.get("new_chat_member", {}).get("user", {}).get("id")
+        if "from" in value:
+            return value["from"].get("id")
+    return None
+
+# Workers
+
+class OfflineRequest(BaseRequest):
+    # Stands in for the Bot API: every call succeeds with a plausible result
+    def __init__(self):
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, params, **extra):
+        return dict({
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": params.get("chat_id", 0), "type": "private"},
+            "text": params.get("text")
+        }, **extra)
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        params = request_data.parameters if request_data is not None else {}
+        api_method = url.rsplit("/", 1)[-1]
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Top-Tas", "username": "toptas_offline_bot"}
+        elif api_method == "getChatMember":
+            result = {"status": "member", "user": {"id": params.get("user_id", 0), "is_bot": False, "first_name": "offline"}}
+        elif api_method in ("sendMessage", "editMessageText"):
+            result = self._message(params)
+        elif api_method == "sendDice":
+            result = self._message(params, dice={"emoji": params.get("emoji", "🎲"), "value": random.randint(1, 6)})
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode('utf-8')
+
+async def _run_worker(updates, offline):
+    import gamelog
+    import main
+    import storage
+    from telegram import Update
+
+    # No updater: updates arrive on `updates` and go straight into the
+    # application's queue
+    application = main.build_application(OfflineRequest() if offline else None)
+    try:
+        await application.initialize()
+        await application.start()
+        await application.post_init(application)
+        logger.info("Shard %d/%d ready", shards.SHARD, shards.SHARD_COUNT)
+        while (body := await asyncio.to_thread(updates.get)) is not None:
+            try:
+                update = Update.de_json(json.loads(body), application.bot)
+            except Exception:
+                logger.exception("Dropping an update that could not be decoded")
+                continue
+            await application.update_queue.put(update)
+        await application.stop()
+        await application.post_stop(application)
+    finally:
+        await application.shutdown()
+        gamelog.close_log()
+        storage.close_db()
+
+def worker(shard, count, updates, offline):
+    # Runs in a fresh (spawned) process; the shard settings must be in
+    # place before any bot module is imported
+    os.environ['TOPTAS_SHARD'] = str(shard)
+    os.environ['TOPTAS_SHARDS'] = str(count)
+    # This module (and so shards.py) was imported before they were set
+    importlib.reload(shards)
+    if offline:
+        os.environ.setdefault('YOUR_BOT_TOKEN', "0:offline")
+    # Ctrl+C reaches the whole process group; the front end stops the
+    # workers itself, after the queues are drained
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_run_worker(updates, offline))
+
+# Front end
+
+class Ingress:
+    def __init__(self, workers, offline=False, record=None, secret=WEBHOOK_SECRET):
+        self.count = workers
+        self.offline = offline
+        self.secret = secret
+        self.record = open(record, 'ab') if record else None
+        self._record_lock = threading.Lock()
+        self._context = multiprocessing.get_context("spawn")
+        self.queues = [self._context.Queue(QUEUE_SIZE) for _ in range(workers)]
+        self.processes = [None] * workers
+        self.routed = [0] * workers
+        self.rejected = 0
+        self._stopping = threading.Event()
+
+    def _start_worker(self, shard):
+        process = self._context.Process(
+            target=worker, args=(shard, self.count, self.queues[shard], self.offline),
+            name=f"toptas-shard-{shard}"
+        )
+        process.start()
+        self.processes[shard] = process
+
+    def start(self):
+        for shard in range(self.count):
+            self._start_worker(shard)
+        threading.Thread(target=self._watch, name="ingress-watch", daemon=True).start()
+
+    def _watch(self):
+        # A worker that dies is started again; its queue keeps what arrived
+        # in the meantime
+        while not self._stopping.wait(WATCH_INTERVAL):
+            for shard, process in enumerate(self.processes):
+                if not process.is_alive() and not self._stopping.is_set():
+                    logger.error("Shard %d exited with code %s, restarting it", shard, process.exitcode)
+                    self._start_worker(shard)
+
+    def authorized(self, headers):
+        if self.secret is None:
+            return True
+        token = headers.get("X-Telegram-Bot-Api-Secret-Token") or ""
+        return hmac.compare_digest(token.encode('utf-8'), self.secret.encode('utf-8'))
+
+    def dispatch(self, body):
+        # Returns the HTTP status for Telegram
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400
+        if not isinstance(data, dict):
+            return 400
+        telegram_id = update_user(data)
+        shard = shards.shard_of(telegram_id, self.count) if isinstance(telegram_id, int) else 0
+        try:
+            self.queues[shard].put(body, timeout=QUEUE_TIMEOUT)
+        except queue.Full:
+            self.rejected += 1
+            return 503
+        self.routed[shard] += 1
+        if self.record is not None:
+            with self._record_lock:
+                self.record.write(body.rstrip(b"\n") + b"\n")
+                self.record.flush()
+        return 200
+
+    def stop(self):
+        # Workers finish what is already queued before they exit
+        self._stopping.set()
+        for updates in self.queues:
+            updates.put(None)
+        for process in self.processes:
+            process.join()
+        if self.record is not None:
+            self.record.close()
+        logger.info("Routed %s updates per shard, %d rejected", self.routed, self.rejected)
+
+def _handler(ingress, path):
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def _reply(self, status):
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_POST(self):
+            if self.path != path:
+                self._reply(404)
+                return
+            if not ingress.authorized(self.headers):
+                self._reply(403)
+                return
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > MAX_BODY_BYTES:
+                self._reply(413)
+                return
+            self._reply(ingress.dispatch(self.rfile.read(length)))
+
+        def log_message(self, format, *args):
+            pass
+    return WebhookHandler
+
+def set_webhook(url, secret, max_connections):
+    # Registers the public URL with Telegram (polling stops working until
+    # deleteWebhook is called)
+    import main
+    payload = {"url": url, "allowed_updates": ["message", "callback_query", "chat_member"], "max_connections": max_connections}
+    if secret is not None:
+        payload["secret_token"] = secret
+    request = urllib.request.Request(
+        f"https://api.telegram.org/bot{main.BOT_TOKEN}/setWebhook",
+        data=json.dumps(payload).encode('utf-8'), headers={"Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        logger.info("setWebhook: %s", response.read().decode('utf-8'))
+
+def run_serve(args):
+    ingress = Ingress(args.workers, args.offline, args.record, args.secret)
+    if args.url and not args.offline:
+        set_webhook(args.url, args.secret, args.max_connections)
+    ingress.start()
+    server = ThreadingHTTPServer((args.host, args.port), _handler(ingress, args.path))
+    logger.info("Webhook listening on http://%s:%d%s with %d shards", args.host, args.port, args.path, args.workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        ingress.stop()
+
+# Replay
+
+def run_replay(args):
+    # Posts recorded updates (one JSON object per line) to a running front end
+    sent = failed = 0
+    started = time.perf_counter()
+    with open(args.file, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            request = urllib.request.Request(args.target, data=line, headers={"Content-Type": "application/json"})
+            if args.secret is not None:
+                request.add_header("X-Telegram-Bot-Api-Secret-Token", args.secret)
+            try:
+                with urllib.request.urlopen(request, timeout=30):
+                    sent += 1
+            except OSError as e:
+                failed += 1
+                logger.warning("Update %d not accepted: %s", sent + failed, e)
+            if args.rate:
+                time.sleep(1 / args.rate)
+    elapsed = time.perf_counter() - started
+    print(f"{sent} updates sent, {failed} failed, in {elapsed:.2f}s ({sent / max(elapsed, 1e-9):.0f}/s)")
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Webhook front end with one worker process per shard of users")
+    parser.add_argument("--secret", default=WEBHOOK_SECRET, help="X-Telegram-Bot-Api-Secret-Token value (default: $TOPTAS_WEBHOOK_SECRET)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="receive webhook updates and run the workers")
+    serve.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes / shards (default: %(default)s)")
+    serve.add_argument("--host", default="0.0.0.0")
+    serve.add_argument("--port", type=int, default=8443)
+    serve.add_argument("--path", default=WEBHOOK_PATH)
+    serve.add_argument("--url", help="public webhook URL to register with Telegram")
+    serve.add_argument("--max-connections", type=int, default=100, help="parallel connections Telegram may open")
+    serve.add_argument("--offline", action="store_true", help="answer Bot API calls locally instead of calling Telegram")
+    serve.add_argument("--record", help="append every accepted update to this JSONL file")
+
+    replay = commands.add_parser("replay", help="post recorded updates to a running front end")
+    replay.add_argument("file", help="JSONL file written by serve --record")
+    replay.add_argument("--target", default=f"http://127.0.0.1:8443{WEBHOOK_PATH}")
+    replay.add_argument("--rate", type=float, help="updates per second (default: as fast as accepted)")
+
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    if args.command == "serve":
+        run_serve(args)
+    else:
+        run_replay(args)
+
+if __name__ == "__main__":
+    main_cli()
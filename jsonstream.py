@@ -0,0 +1,89 @@
+import codecs
+import json
+
+# Incremental reader for the legacy JSON array files (user.json, game.json,
+# ...): elements are decoded one at a time from fixed-size chunks, so memory
+# stays flat however large the file is.
+CHUNK_SIZE = 1 << 20
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\r\n"
+_DELIMITERS = _WHITESPACE + ",]}"
+
+class _Reader:
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ""
+        self.pos = 0
+        self.offset = f.tell()  # byte offset of buf[pos] in the file
+        self.eof = False
+
+    def _fill(self):
+        data = self.f.read(self.chunk_size)
+        self.eof = not data
+        self.buf = self.buf[self.pos:] + self.utf8.decode(data, final=self.eof)
+        self.pos = 0
+
+    def peek(self):
+        # Next non-whitespace character, or None at the end of the file
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+                self.offset += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return None
+            self._fill()
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} at byte {self.offset}, found {found!r}")
+        self.pos += 1
+        self.offset += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+                # A number cut by the chunk boundary ("12" of "12.5") also
+                # parses, so a value only counts once a delimiter follows it
+                if self.eof or (end < len(self.buf) and self.buf[end] in _DELIMITERS):
+                    break
+            except json.JSONDecodeError as e:
+                if self.eof:
+                    raise ValueError(f"Bad JSON value at byte {self.offset}: {e.msg}") from None
+            self._fill()
+        self.offset += len(self.buf[self.pos:end].encode('utf-8'))
+        self.pos = end
+        return value
+
+def iter_array(path, offset=0, chunk_size=CHUNK_SIZE):
+    # Yields (element, byte offset just past it) for each element of the
+    # top-level array in `path`. Passing a yielded offset back in resumes
+    # right after that element. An empty file counts as an empty array.
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        if offset == 0 and f.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
+            f.seek(0)
+        reader = _Reader(f, chunk_size)
+        if offset == 0:
+            if reader.peek() is None:
+                return
+            reader.expect('[')
+            if reader.peek() == ']':
+                return
+        elif reader.peek() == ']':
+            return
+        else:
+            reader.expect(',')
+
+        while True:
+            yield reader.value(), reader.offset
+            if reader.peek() == ']':
+                return
+            reader.expect(',')
@@ -0,0 +1,157 @@
+from bisect import bisect_left, bisect_right, insort
+from datetime import date, datetime
+
+# Window name -> length in days (None = all time)
+WINDOWS = {"daily": 1, "weekly": 7, "all": None}
+
+def _day(record):
+    return datetime.fromisoformat(record['date']).date().toordinal()
+
+class _Ranking:
+    # Sorted keys split into runs of at most 2 * LOAD. A bisect over each
+    # run's first key finds the run, so an insert or delete shifts one run
+    # instead of the whole ranking; rank-of-key adds up the run lengths
+    # before it.
+    LOAD = 500
+
+    def __init__(self):
+        self._runs = []
+        self._firsts = []  # first key of each run
+
+    def _run_of(self, key):
+        return max(bisect_right(self._firsts, key) - 1, 0)
+
+    def add(self, key):
+        if not self._runs:
+            self._runs.append([key])
+            self._firsts.append(key)
+            return
+        i = self._run_of(key)
+        run = self._runs[i]
+        insort(run, key)
+        self._firsts[i] = run[0]
+        if len(run) > 2 * self.LOAD:
+            self._runs.insert(i + 1, run[self.LOAD:])
+            self._firsts.insert(i + 1, run[self.LOAD])
+            del run[self.LOAD:]
+
+    def remove(self, key):
+        i = self._run_of(key)
+        run = self._runs[i]
+        del run[bisect_left(run, key)]
+        if run:
+            self._firsts[i] = run[0]
+        else:
+            del self._runs[i]
+            del self._firsts[i]
+
+    def index(self, key):
+        i = self._run_of(key)
+        return sum(len(run) for run in self._runs[:i]) + bisect_left(self._runs[i], key)
+
+    def first(self, n):
+        keys = []
+        for run in self._runs:
+            if len(keys) >= n:
+                break
+            keys += run[:n - len(keys)]
+        return keys
+
+class _Window:
+    # Per-user totals for one time window. Users are ranked by
+    # (-profit, telegram_id) keys, so top-N is a prefix and rank-of-user is
+    # the index of a key. Windowed totals are also bucketed by day, and a bucket's
+    # contributions are subtracted when it falls out of the window.
+    def __init__(self, span_days):
+        self.span_days = span_days
+        self.totals = {}  # telegram_id -> [profit, volume, wins]
+        self.ranking = _Ranking()
+        self.buckets = {}  # day -> {telegram_id: [profit, volume, wins]}
+
+    def _apply(self, telegram_id, profit, volume, wins):
+        entry = self.totals.get(telegram_id)
+        if entry is None:
+            entry = self.totals[telegram_id] = [0, 0, 0]
+        else:
+            self.ranking.remove((-entry[0], telegram_id))
+
+        entry[0] += profit
+        entry[1] += volume
+        entry[2] += wins
+        if entry[1] == 0:
+            del self.totals[telegram_id]
+        else:
+            self.ranking.add((-entry[0], telegram_id))
+
+    def add(self, day, telegram_id, profit, volume, wins):
+        if self.span_days is not None:
+            bucket = self.buckets.setdefault(day, {})
+            contribution = bucket.setdefault(telegram_id, [0, 0, 0])
+            contribution[0] += profit
+            contribution[1] += volume
+            contribution[2] += wins
+        self._apply(telegram_id, profit, volume, wins)
+
+    def expire(self, today):
+        if self.span_days is None:
+            return
+        for day in [d for d in self.buckets if d <= today - self.span_days]:
+            for telegram_id, (profit, volume, wins) in self.buckets.pop(day).items():
+                self._apply(telegram_id, -profit, -volume, -wins)
+
+class Leaderboard:
+    def __init__(self):
+        self.windows = {name: _Window(span) for name, span in WINDOWS.items()}
+        self.usernames = {}
+        self._today = None
+
+    def _roll(self, today):
+        if today != self._today:
+            self._today = today
+            for window in self.windows.values():
+                window.expire(today)
+
+    def record(self, game):
+        day = _day(game)
+        self._roll(max(day, self._today or day))
+        telegram_id = game['ID-Telegram']
+        self.usernames[telegram_id] = game['Username']
+        win = 1 if game['status'] == "win" else 0
+        for window in self.windows.values():
+            if window.span_days is None or day > self._today - window.span_days:
+                window.add(day, telegram_id, game['profit'], game['bet'], win)
+
+    def rebuild(self, games, history=()):
+        # history: per-user (telegram_id, username, profit, volume, wins)
+        # totals of games older than every windowed view
+        self.__init__()
+        all_time = self.windows["all"]
+        for telegram_id, username, profit, volume, wins in history:
+            self.usernames[telegram_id] = username
+            all_time.add(None, telegram_id, profit, volume, wins)
+        for game in games:
+            self.record(game)
+        self._roll(date.today().toordinal())
+
+    def top(self, window_name, n=10):
+        self._roll(date.today().toordinal())
+        window = self.windows[window_name]
+        return [self._entry(window, telegram_id) for _, telegram_id in window.ranking.first(n)]
+
+    def rank_of(self, window_name, telegram_id):
+        self._roll(date.today().toordinal())
+        window = self.windows[window_name]
+        entry = window.totals.get(telegram_id)
+        if entry is None:
+            return None, None
+        return window.ranking.index((-entry[0], telegram_id)) + 1, self._entry(window, telegram_id)
+
+    def _entry(self, window, telegram_id):
+        profit, volume, wins = window.totals[telegram_id]
+        return {
+            "ID-Telegram": telegram_id,
+            "Username": self.usernames.get(telegram_id, "Unknown"),
+            "profit": profit,
+            "volume": volume,
+            "wins": wins
+        }
@@ -0,0 +1,183 @@
+# Incremental reconciliation of user balances against the ledger.
+#
+#   python ledger.py [--db toptas.db]            check the entries added since the last run
+#   python ledger.py --show 12345                a user's balance, ledger total and latest entries
+#   python ledger.py --restart                   forget the checkpoint and check the whole ledger
+#
+# Each run only reads ledger entries past the checkpoint the previous run
+# left: their sums are added to the per-user and per-account totals kept
+# here, and every user they touched is compared with users.balance. The
+# sum of all balances (the counters table) is compared with the ledger
+# total as well, which catches a balance changed without any entry.
+# Balance changes and their entries commit together, so within one
+# transaction the two always agree. Meant to run nightly (cron).
+
+import argparse
+import sys
+import time
+
+import storage
+
+BATCH_SIZE = 50000
+
+RECONCILE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ledger_checkpoint (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    last_id INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    checked_at INTEGER NOT NULL
+);
+-- Ledger totals up to the checkpoint, per user and per counter-account
+CREATE TABLE IF NOT EXISTS ledger_user_totals (
+    telegram_id INTEGER PRIMARY KEY,
+    total INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ledger_account_totals (
+    account TEXT PRIMARY KEY,
+    total INTEGER NOT NULL
+);
+-- Users whose balance disagreed with the ledger at their last check
+CREATE TABLE IF NOT EXISTS ledger_mismatches (
+    telegram_id INTEGER PRIMARY KEY,
+    balance INTEGER,
+    ledger INTEGER NOT NULL,
+    found_at INTEGER NOT NULL
+);
+"""
+
+def _restart(conn):
+    conn.execute("BEGIN IMMEDIATE")
+    for table in ("ledger_checkpoint", "ledger_user_totals", "ledger_account_totals", "ledger_mismatches"):
+        conn.execute(f"DELETE FROM {table}")
+    conn.execute("COMMIT")
+
+def _add_batch(conn, last_id, upto):
+    # Folds entries (last_id, upto] into the totals; returns the users touched
+    users = conn.execute(
+        "SELECT telegram_id, SUM(amount) FROM ledger WHERE id > ? AND id <= ? GROUP BY telegram_id", (last_id, upto)
+    ).fetchall()
+    conn.executemany(
+        "INSERT INTO ledger_user_totals (telegram_id, total) VALUES (?, ?) "
+        "ON CONFLICT (telegram_id) DO UPDATE SET total = total + excluded.total", users
+    )
+    conn.execute(
+        "INSERT INTO ledger_account_totals (account, total) "
+        "SELECT account, -SUM(amount) FROM ledger WHERE id > ? AND id <= ? GROUP BY account "
+        "ON CONFLICT (account) DO UPDATE SET total = total + excluded.total", (last_id, upto)
+    )
+    return users
+
+def _check_users(conn, telegram_ids, now):
+    # Compares the given users' balances with their ledger totals; returns
+    # the mismatches (telegram_id, balance or None if the user is gone, ledger)
+    mismatches = []
+    telegram_ids = list(telegram_ids)
+    for start in range(0, len(telegram_ids), 500):
+        chunk = telegram_ids[start:start + 500]
+        mismatches += conn.execute(
+            "SELECT t.telegram_id, u.balance, t.total FROM ledger_user_totals t "
+            "LEFT JOIN users u ON u.telegram_id = t.telegram_id "
+            f"WHERE t.telegram_id IN ({', '.join('?' for _ in chunk)}) AND u.balance IS NOT t.total",
+            chunk
+        ).fetchall()
+        conn.execute(f"DELETE FROM ledger_mismatches WHERE telegram_id IN ({', '.join('?' for _ in chunk)})", chunk)
+    conn.executemany(
+        "INSERT INTO ledger_mismatches (telegram_id, balance, ledger, found_at) VALUES (?, ?, ?, ?)",
+        [(telegram_id, balance, total, now) for telegram_id, balance, total in mismatches]
+    )
+    return mismatches
+
+def reconcile(conn, batch_size=BATCH_SIZE, progress=None):
+    # Returns a report dict. Batches before the last only add up entries;
+    # the last one, which reaches the head of the ledger, also compares the
+    # balances while it holds the write lock, so no change can slip between
+    # the totals and the balances.
+    conn.executescript(RECONCILE_SCHEMA)
+    row = conn.execute("SELECT last_id, total FROM ledger_checkpoint WHERE id = 1").fetchone()
+    last_id, total = row or (0, 0)
+    started_at = last_id
+    touched = set()
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            head = conn.execute("SELECT COALESCE(MAX(id), 0) FROM ledger").fetchone()[0]
+            upto = min(head, last_id + batch_size)
+            users = _add_batch(conn, last_id, upto)
+            touched.update(telegram_id for telegram_id, _ in users)
+            total += sum(amount for _, amount in users)
+            now = int(time.time())
+            final = upto == head
+            if final:
+                mismatches = _check_users(conn, touched, now)
+                balances = conn.execute("SELECT value FROM counters WHERE name = 'balance'").fetchone()
+                accounts = dict(conn.execute("SELECT account, total FROM ledger_account_totals"))
+            conn.execute(
+                "INSERT OR REPLACE INTO ledger_checkpoint (id, last_id, total, checked_at) VALUES (1, ?, ?, ?)",
+                (upto, total, now)
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        last_id = upto
+        if progress is not None:
+            progress(last_id, head)
+        if final:
+            break
+    return {
+        "entries": last_id - started_at,
+        "checkpoint": last_id,
+        "users_checked": len(touched),
+        "mismatches": mismatches,
+        "ledger_total": total,
+        "balance_total": balances[0] if balances else None,
+        "accounts": accounts
+    }
+
+def show_user(conn, telegram_id, limit=20):
+    balance = conn.execute("SELECT balance FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
+    total = conn.execute("SELECT COALESCE(SUM(amount), 0) FROM ledger WHERE telegram_id = ?", (telegram_id,)).fetchone()[0]
+    print(f"user {telegram_id}: balance {balance[0] if balance else '-'}, ledger {total}")
+    rows = conn.execute(
+        "SELECT id, datetime(created, 'unixepoch'), account, amount, ref FROM ledger WHERE telegram_id = ? ORDER BY id DESC LIMIT ?",
+        (telegram_id, limit)
+    ).fetchall()
+    for entry_id, created, account, amount, ref in rows:
+        print(f"  #{entry_id} {created} {account:<12}{amount:>14} {ref or ''}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconcile user balances against the ledger since the last checkpoint")
+    parser.add_argument("--db", default=storage.DB_PATH, help="SQLite database (default: %(default)s)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="entries per transaction")
+    parser.add_argument("--restart", action="store_true", help="drop the checkpoint and reconcile the whole ledger")
+    parser.add_argument("--show", type=int, metavar="TELEGRAM_ID", help="print one user's latest entries instead")
+    args = parser.parse_args()
+
+    conn = storage.connect(args.db)
+    try:
+        if args.show is not None:
+            show_user(conn, args.show)
+            return
+        if args.restart:
+            conn.executescript(RECONCILE_SCHEMA)
+            _restart(conn)
+        started = time.perf_counter()
+        report = reconcile(conn, args.batch_size, lambda done, head: sys.stderr.write(f"\rentry {done}/{head}"))
+        sys.stderr.write("\n")
+    finally:
+        conn.close()
+
+    print(f"{report['entries']} new entries up to #{report['checkpoint']}, "
+          f"{report['users_checked']} users checked in {time.perf_counter() - started:.2f}s")
+    for account, total in sorted(report['accounts'].items()):
+        print(f"  {account:<12}{total:>16}")
+    print(f"ledger total {report['ledger_total']}, sum of balances {report['balance_total']}")
+    ok = not report['mismatches'] and report['ledger_total'] == report['balance_total']
+    for telegram_id, balance, total in report['mismatches']:
+        print(f"MISMATCH user {telegram_id}: balance {balance}, ledger {total}")
+    if report['ledger_total'] != report['balance_total']:
+        print("MISMATCH: the sum of balances differs from the ledger total")
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
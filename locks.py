@@ -0,0 +1,20 @@
+import asyncio
+from contextlib import AsyncExitStack, asynccontextmanager
+
+# Sharded per-user locks: a fixed pool, so memory does not grow with users
+LOCK_SHARDS = 256
+
+_locks = [asyncio.Lock() for _ in range(LOCK_SHARDS)]
+
+def user_lock(telegram_id):
+    return _locks[hash(telegram_id) % LOCK_SHARDS]
+
+@asynccontextmanager
+async def user_locks(telegram_ids):
+    # Holds the locks of several users at once (bulk admin actions). Each
+    # shard is taken once and in shard order, so two bulk actions cannot
+    # deadlock each other.
+    async with AsyncExitStack() as stack:
+        for shard in sorted({hash(telegram_id) % LOCK_SHARDS for telegram_id in telegram_ids}):
+            await stack.enter_async_context(_locks[shard])
+        yield
@@ -1,128 +1,125 @@
-
+import asyncio
 import logging
-import json
 import os
 import random
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import Application, ChatMemberHandler, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+
+import admin
+import archive
+import config
+import gamelog
+import metrics
+import shards
+import storage
+from flood import FloodControl
+from locks import user_lock
+from leaderboard import Leaderboard
+from membership import MembershipCache
+from router import CallbackRouter
+from sender import outbox
+from sessions import SessionPersistence
+from stats import game_stats
 
 # Bot token from environment
 BOT_TOKEN = os.environ.get('YOUR_BOT_TOKEN')
 
-# Required channels
-REQUIRED_CHANNELS = ["@Topdieshistory", "@Toptasbet"]
-
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# JSON file paths
-USER_DB = "user.json"
-GAME_DB = "game.json"
-DEPOSIT_DB = "deposit.json"
-WITHDRAWAL_DB = "withdrawal.json"
-LOGIC_DB = "logic.json"
-WALLET_DB = "wallet.json"
-
-# Initialize JSON files
-def init_json_files():
-    files = {
-        USER_DB: [],
-        GAME_DB: [],
-        DEPOSIT_DB: [],
-        WITHDRAWAL_DB: [],
-        LOGIC_DB: [{"win": 50, "lose": 50, "random": True}],
-        WALLET_DB: [{"TRC20": "890qya3ymf8oqkzfgqa9HKDSU89QWFU8", "POL": "werj9yxf78wgo7frgwiarfsjdufgfnxvidb"}]
-    }
-    
-    for file_path, default_data in files.items():
-        if not os.path.exists(file_path):
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(default_data, f, ensure_ascii=False, indent=2)
+# Leaderboard, updated as games are recorded
+leaderboard = Leaderboard()
+LEADERBOARD_TITLES = {"daily": "امروز", "weekly": "این هفته", "all": "همه زمان‌ها"}
 
-def load_json(file_path):
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return []
-
-def save_json(file_path, data):
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-def get_user(user_id):
-    users = load_json(USER_DB)
-    for user in users:
-        if user.get('ID-Telegram') == user_id:
-            return user
-    return None
-
-def create_user(user_id, username):
-    users = load_json(USER_DB)
-    new_id = len(users) + 1
-    new_user = {
-        "ID": new_id,
-        "ID-Telegram": user_id,
-        "Username": username,
-        "Balance": 0,
-        "Status": "Active",
-        "Description": "New User"
-    }
-    users.append(new_user)
-    save_json(USER_DB, users)
-    return new_user
-
-def update_user_balance(user_id, amount):
-    users = load_json(USER_DB)
-    for user in users:
-        if user.get('ID-Telegram') == user_id:
-            user['Balance'] += amount
-            save_json(USER_DB, users)
-            return user['Balance']
-    return None
+# Membership cache (all channels are queried concurrently on a miss)
+membership_cache = MembershipCache(config.get().required_channels)
+MEMBERSHIP_STATS_EVERY = 1000
 
 async def check_membership(context, user_id):
-    for channel in REQUIRED_CHANNELS:
-        try:
-            member = await context.bot.get_chat_member(channel, user_id)
-            if member.status in ['left', 'kicked']:
-                return False
-        except:
-            return False
-    return True
+    is_member = await membership_cache.check(context.bot, user_id)
+    
+    lookups = membership_cache.hits + membership_cache.misses
+    if lookups % MEMBERSHIP_STATS_EVERY == 0:
+        logger.info("Membership cache stats: %s", membership_cache.stats())
+    return is_member
+
+async def chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Join/leave in a required channel: drop the cached answer for that user
+    membership_cache.invalidate(update.chat_member.new_chat_member.user.id)
+
+# Keyboards are built once; the channel list is rebuilt when settings change
+JOIN_CHANNELS = None
+
+def apply_settings(settings):
+    global JOIN_CHANNELS
+    membership_cache.set_channels(settings.required_channels)
+    JOIN_CHANNELS = InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"Join {channel}", url=f"https://t.me/{channel.lstrip('@')}")]
+        for channel in settings.required_channels
+    ])
+
+config.subscribe(apply_settings)
+
+MAIN_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("شروع بازی", callback_data="play")],
+    [InlineKeyboardButton("واریز", callback_data="deposit"), 
+     InlineKeyboardButton("برداشت", callback_data="withdrawal")],
+    [InlineKeyboardButton("رتبه", callback_data="leaderboard"), 
+     InlineKeyboardButton("راهنما", callback_data="guide")],
+    [InlineKeyboardButton("پشتیبانی", callback_data="support")]
+])
+BET_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("2x زوج", callback_data="bet_even"), 
+     InlineKeyboardButton("2x فرد", callback_data="bet_odd")],
+    [InlineKeyboardButton("1 6x", callback_data="bet_1"), 
+     InlineKeyboardButton("2 6x", callback_data="bet_2")],
+    [InlineKeyboardButton("3 6x", callback_data="bet_3"), 
+     InlineKeyboardButton("4 6x", callback_data="bet_4")],
+    [InlineKeyboardButton("5 6x", callback_data="bet_5"), 
+     InlineKeyboardButton("6 6x", callback_data="bet_6")]
+])
+BACK_MENU = InlineKeyboardMarkup([[InlineKeyboardButton("برگشت", callback_data="back")]])
+DEPOSIT_METHODS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("USDT-POL", callback_data="deposit_POL"),
+     InlineKeyboardButton("USDT-TRC20", callback_data="deposit_TRC20")],
+    [InlineKeyboardButton("Utopia voucher", callback_data="deposit_Utopia")],
+    [InlineKeyboardButton("برگشت", callback_data="back")]
+])
+WITHDRAWAL_METHODS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("USDT-POL", callback_data="withdrawal_POL"),
+     InlineKeyboardButton("USDT-TRC20", callback_data="withdrawal_TRC20")],
+    [InlineKeyboardButton("Utopia voucher", callback_data="withdrawal_Utopia")],
+    [InlineKeyboardButton("برگشت", callback_data="back")]
+])
+LEADERBOARD_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton(title, callback_data=f"leaderboard_{name}") for name, title in LEADERBOARD_TITLES.items()],
+    [InlineKeyboardButton("برگشت", callback_data="back")]
+])
+SUPPORT_MENU = InlineKeyboardMarkup([[InlineKeyboardButton("پشتیبانی", url="https://t.me/TopTasSupportBot")]])
+
+# User-side callbacks; handlers get (query, context, *parsed payload)
+callbacks = CallbackRouter()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
     if not await check_membership(context, user.id):
-        keyboard = [[InlineKeyboardButton("Join @Topdieshistory", url="https://t.me/Topdieshistory")],
-                   [InlineKeyboardButton("Join @Toptasbet", url="https://t.me/Toptasbet")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
             "برای استفاده از ربات باید عضو کانال‌های زیر باشید:",
-            reply_markup=reply_markup
+            reply_markup=JOIN_CHANNELS
         )
         return
 
-    db_user = get_user(user.id)
+    db_user = storage.get_user(user.id)
     if not db_user:
-        db_user = create_user(user.id, user.username or "Unknown")
-
-    keyboard = [
-        [InlineKeyboardButton("شروع بازی", callback_data="play")],
-        [InlineKeyboardButton("واریز", callback_data="deposit"), 
-         InlineKeyboardButton("برداشت", callback_data="withdrawal")],
-        [InlineKeyboardButton("رتبه", callback_data="leaderboard"), 
-         InlineKeyboardButton("راهنما", callback_data="guide")],
-        [InlineKeyboardButton("پشتیبانی", callback_data="support")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+        db_user = storage.create_user(user.id, user.username or "Unknown")
+    storage.touch_user(user.id)
     
     await update.message.reply_text(
         f"سلام {user.first_name}!\nموجودی شما: {db_user['Balance']} تومان",
-        reply_markup=reply_markup
+        reply_markup=MAIN_MENU
     )
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -132,101 +129,103 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id
     
     if not await check_membership(context, user_id):
-        keyboard = [[InlineKeyboardButton("Join @Topdieshistory", url="https://t.me/Topdieshistory")],
-                   [InlineKeyboardButton("Join @Toptasbet", url="https://t.me/Toptasbet")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text(
             "برای استفاده از ربات باید عضو کانال‌های زیر باشید:",
-            reply_markup=reply_markup
+            reply_markup=JOIN_CHANNELS
         )
         return
+    
+    storage.touch_user(user_id)
+    await callbacks.dispatch(query, context)
 
-    if query.data == "play":
-        keyboard = [
-            [InlineKeyboardButton("2x زوج", callback_data="bet_even"), 
-             InlineKeyboardButton("2x فرد", callback_data="bet_odd")],
-            [InlineKeyboardButton("1 6x", callback_data="bet_1"), 
-             InlineKeyboardButton("2 6x", callback_data="bet_2")],
-            [InlineKeyboardButton("3 6x", callback_data="bet_3"), 
-             InlineKeyboardButton("4 6x", callback_data="bet_4")],
-            [InlineKeyboardButton("5 6x", callback_data="bet_5"), 
-             InlineKeyboardButton("6 6x", callback_data="bet_6")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("آپشنت چیه؟؟؟", reply_markup=reply_markup)
-        
-    elif query.data.startswith("bet_"):
-        context.user_data['bet_type'] = query.data.split("_")[1]
-        await query.edit_message_text("مبلغ شرط خود را وارد کنید (حداقل 5000 تومان):")
-        
-    elif query.data == "deposit":
-        await query.edit_message_text(
-            "چقدر باشه؟؟\nبیشتر از 100,000 هزار تومان باشه :)",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("برگشت", callback_data="back")]])
-        )
-        context.user_data['awaiting_deposit_amount'] = True
-        
-    elif query.data == "withdrawal":
+@callbacks.route("play")
+async def on_play(query, context):
+    await query.edit_message_text("آپشنت چیه؟؟؟", reply_markup=BET_MENU)
+
+@callbacks.route("bet_")
+async def on_bet(query, context, bet_type):
+    context.user_data['bet_type'] = bet_type
+    await query.edit_message_text(f"مبلغ شرط خود را وارد کنید (حداقل {config.get().min_bet} تومان):")
+
+@callbacks.route("deposit")
+async def on_deposit(query, context):
+    await query.edit_message_text(
+        f"چقدر باشه؟؟\nبیشتر از {config.get().min_deposit:,} هزار تومان باشه :)",
+        reply_markup=BACK_MENU
+    )
+    context.user_data['awaiting_deposit_amount'] = True
+
+@callbacks.route("withdrawal")
+async def on_withdrawal(query, context):
+    await query.edit_message_text(
+        f"چقدر باشه؟؟\nبیشتر از {config.get().min_withdrawal:,} هزار تومان باشه :)",
+        reply_markup=BACK_MENU
+    )
+    context.user_data['awaiting_withdrawal_amount'] = True
+
+@callbacks.route("deposit_")
+async def on_deposit_method(query, context, method):
+    # wallet.json is part of the settings snapshot; the table is the fallback
+    wallet_data = config.get().wallets or storage.get_wallets()
+    
+    if method in ["TRC20", "POL"]:
+        address = wallet_data.get(method, "Address not found")
         await query.edit_message_text(
-            "چقدر باشه؟؟\nبیشتر از 500,000 هزار تومان باشه :)",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("برگشت", callback_data="back")]])
+            f"آدرس کیف پول {method}:\n{address}\n\nلطفا اسکرین‌شات، هش تراکنش و لینک تراکنش را ارسال کنید."
         )
-        context.user_data['awaiting_withdrawal_amount'] = True
-        
-    elif query.data.startswith("deposit_"):
-        method = query.data.split("_")[1]
-        wallet_data = load_json(WALLET_DB)[0]
-        
-        if method in ["TRC20", "POL"]:
-            address = wallet_data.get(method, "Address not found")
-            await query.edit_message_text(
-                f"آدرس کیف پول {method}:\n{address}\n\nلطفا اسکرین‌شات، هش تراکنش و لینک تراکنش را ارسال کنید."
-            )
-        else:  # Utopia
-            await query.edit_message_text("لطفا کد فعال‌ساز واچر را ارسال کنید.")
-            
-        context.user_data['deposit_method'] = method
-        context.user_data['awaiting_deposit_info'] = True
-        
-    elif query.data.startswith("withdrawal_"):
-        method = query.data.split("_")[1]
+    else:  # Utopia
+        await query.edit_message_text("لطفا کد فعال‌ساز واچر را ارسال کنید.")
         
-        if method in ["TRC20", "POL"]:
-            await query.edit_message_text(f"آدرس کیف پول {method} خود را ارسال کنید:")
-        else:  # Utopia
-            await query.edit_message_text("درخواست شما برای ادمین ارسال شد.")
-            
-        context.user_data['withdrawal_method'] = method
-        context.user_data['awaiting_withdrawal_info'] = True
-        
-    elif query.data == "leaderboard":
-        await query.edit_message_text("رتبه‌بندی بروزرسانی شد!")
-        
-    elif query.data == "guide":
-        await query.edit_message_text("راهنما بروزرسانی شد!")
-        
-    elif query.data == "support":
-        keyboard = [[InlineKeyboardButton("پشتیبانی", url="https://t.me/TopTasSupportBot")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            "برای ارتباط با پشتیبانی از آیدی زیر استفاده کنید\n@TopTasSupportBot",
-            reply_markup=reply_markup
-        )
+    context.user_data['deposit_method'] = method
+    context.user_data['awaiting_deposit_info'] = True
+
+@callbacks.route("withdrawal_")
+async def on_withdrawal_method(query, context, method):
+    if method in ["TRC20", "POL"]:
+        await query.edit_message_text(f"آدرس کیف پول {method} خود را ارسال کنید:")
+    else:  # Utopia
+        await query.edit_message_text("درخواست شما برای ادمین ارسال شد.")
         
-    elif query.data == "back":
-        await start_menu(query)
+    context.user_data['withdrawal_method'] = method
+    context.user_data['awaiting_withdrawal_info'] = True
+
+@callbacks.route("leaderboard")
+@callbacks.route("leaderboard_")
+async def on_leaderboard(query, context, window="daily"):
+    if window not in LEADERBOARD_TITLES:
+        return
+    await query.edit_message_text(leaderboard_text(window, query.from_user.id), reply_markup=LEADERBOARD_MENU)
+
+@callbacks.route("guide")
+async def on_guide(query, context):
+    await query.edit_message_text("راهنما بروزرسانی شد!")
+
+@callbacks.route("support")
+async def on_support(query, context):
+    await query.edit_message_text(
+        "برای ارتباط با پشتیبانی از آیدی زیر استفاده کنید\n@TopTasSupportBot",
+        reply_markup=SUPPORT_MENU
+    )
+
+@callbacks.route("back")
+async def on_back(query, context):
+    await start_menu(query)
+
+def leaderboard_text(window, user_id):
+    text = f"رتبه‌بندی ({LEADERBOARD_TITLES[window]}):\n\n"
+    entries = leaderboard.top(window, 10)
+    if not entries:
+        text += "هنوز بازی‌ای ثبت نشده است.\n"
+    for rank, entry in enumerate(entries, 1):
+        text += f"{rank}. @{entry['Username']} | سود: {entry['profit']} | حجم: {entry['volume']} | برد: {entry['wins']}\n"
+    
+    rank, entry = leaderboard.rank_of(window, user_id)
+    if rank:
+        text += f"\nرتبه شما: {rank} | سود: {entry['profit']}"
+    return text
 
 async def start_menu(query):
-    keyboard = [
-        [InlineKeyboardButton("شروع بازی", callback_data="play")],
-        [InlineKeyboardButton("واریز", callback_data="deposit"), 
-         InlineKeyboardButton("برداشت", callback_data="withdrawal")],
-        [InlineKeyboardButton("رتبه", callback_data="leaderboard"), 
-         InlineKeyboardButton("راهنما", callback_data="guide")],
-        [InlineKeyboardButton("پشتیبانی", callback_data="support")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("منوی اصلی:", reply_markup=reply_markup)
+    await query.edit_message_text("منوی اصلی:", reply_markup=MAIN_MENU)
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -236,16 +235,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("لطفا ابتدا عضو کانال‌های مورد نیاز شوید.")
         return
     
+    storage.touch_user(user_id)
+    
     # Handle bet amount
     if 'bet_type' in context.user_data and text.isdigit():
         bet_amount = int(text)
-        if bet_amount < 5000:
-            await update.message.reply_text("حداقل مبلغ شرط 5000 تومان است.")
-            return
-            
-        user = get_user(user_id)
-        if user['Balance'] < bet_amount:
-            await update.message.reply_text("موجودی شما کافی نیست.")
+        min_bet = config.get().min_bet
+        if bet_amount < min_bet:
+            await update.message.reply_text(f"حداقل مبلغ شرط {min_bet} تومان است.")
             return
             
         # Play game
@@ -265,48 +262,52 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             win = True
             multiplier = 6
             
+        profit = bet_amount * multiplier - bet_amount if win else -bet_amount
+        
+        async with user_lock(user_id):
+            # The balance must still cover the bet when the result is applied;
+            # its ledger entry points at the game recorded right after
+            game_id = gamelog.reserve_id()
+            new_balance = storage.update_user_balance(user_id, profit, required=bet_amount, ref=f"game:{game_id}")
+            if new_balance is not None:
+                # Save game record
+                game = gamelog.append_game(
+                    user_id,
+                    update.effective_user.username or "Unknown",
+                    bet_amount,
+                    "win" if win else "lose",
+                    datetime.now().isoformat(),
+                    profit,
+                    bet_type,
+                    game_id
+                )
+                leaderboard.record(game)
+                game_stats.record(game)
+            
+        if new_balance is None:
+            await update.message.reply_text("موجودی شما کافی نیست.")
+            return
+            
         if win:
-            profit = bet_amount * multiplier - bet_amount
-            update_user_balance(user_id, profit)
             result_text = f"🎉 برنده شدید!\nعدد: {dice_result}\nسود: {profit} تومان"
         else:
-            update_user_balance(user_id, -bet_amount)
             result_text = f"😞 باختید!\nعدد: {dice_result}\nضرر: {bet_amount} تومان"
-            
-        # Save game record
-        games = load_json(GAME_DB)
-        new_game = {
-            "ID": len(games) + 1,
-            "ID-Telegram": user_id,
-            "Username": update.effective_user.username or "Unknown",
-            "bet": bet_amount,
-            "status": "win" if win else "lose",
-            "date": datetime.now().isoformat(),
-            "profit": profit if win else -bet_amount
-        }
-        games.append(new_game)
-        save_json(GAME_DB, games)
         
-        await update.message.reply_dice("🎲")
-        await update.message.reply_text(result_text)
+        # Results go through the outbox so bet bursts stay within flood limits
+        outbox.send_dice(update.effective_chat.id, "🎲")
+        outbox.send_text(update.effective_chat.id, result_text)
         
         del context.user_data['bet_type']
         
     # Handle deposit amount
     elif context.user_data.get('awaiting_deposit_amount') and text.isdigit():
         amount = int(text)
-        if amount < 100000:
-            await update.message.reply_text("حداقل مبلغ واریز 100,000 تومان است.")
+        min_deposit = config.get().min_deposit
+        if amount < min_deposit:
+            await update.message.reply_text(f"حداقل مبلغ واریز {min_deposit:,} تومان است.")
             return
             
-        keyboard = [
-            [InlineKeyboardButton("USDT-POL", callback_data="deposit_POL"),
-             InlineKeyboardButton("USDT-TRC20", callback_data="deposit_TRC20")],
-            [InlineKeyboardButton("Utopia voucher", callback_data="deposit_Utopia")],
-            [InlineKeyboardButton("برگشت", callback_data="back")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("روش واریز را انتخاب کنید:", reply_markup=reply_markup)
+        await update.message.reply_text("روش واریز را انتخاب کنید:", reply_markup=DEPOSIT_METHODS)
         
         context.user_data['deposit_amount'] = amount
         del context.user_data['awaiting_deposit_amount']
@@ -314,41 +315,30 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Handle withdrawal amount
     elif context.user_data.get('awaiting_withdrawal_amount') and text.isdigit():
         amount = int(text)
-        if amount < 500000:
-            await update.message.reply_text("حداقل مبلغ برداشت 500,000 تومان است.")
+        min_withdrawal = config.get().min_withdrawal
+        if amount < min_withdrawal:
+            await update.message.reply_text(f"حداقل مبلغ برداشت {min_withdrawal:,} تومان است.")
             return
             
-        user = get_user(user_id)
+        user = storage.get_user(user_id)
         if user['Balance'] < amount:
             await update.message.reply_text("موجودی شما کافی نیست.")
             return
             
-        keyboard = [
-            [InlineKeyboardButton("USDT-POL", callback_data="withdrawal_POL"),
-             InlineKeyboardButton("USDT-TRC20", callback_data="withdrawal_TRC20")],
-            [InlineKeyboardButton("Utopia voucher", callback_data="withdrawal_Utopia")],
-            [InlineKeyboardButton("برگشت", callback_data="back")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("روش برداشت را انتخاب کنید:", reply_markup=reply_markup)
+        await update.message.reply_text("روش برداشت را انتخاب کنید:", reply_markup=WITHDRAWAL_METHODS)
         
         context.user_data['withdrawal_amount'] = amount
         del context.user_data['awaiting_withdrawal_amount']
         
     # Handle deposit info
     elif context.user_data.get('awaiting_deposit_info'):
-        deposits = load_json(DEPOSIT_DB)
-        new_deposit = {
-            "ID": len(deposits) + 1,
-            "ID-Telegram": user_id,
-            "Username": update.effective_user.username or "Unknown",
-            "amount": context.user_data.get('deposit_amount', 0),
-            "side": context.user_data.get('deposit_method', ''),
-            "information": text,
-            "status": "Pending"
-        }
-        deposits.append(new_deposit)
-        save_json(DEPOSIT_DB, deposits)
+        storage.add_deposit(
+            user_id,
+            update.effective_user.username or "Unknown",
+            context.user_data.get('deposit_amount', 0),
+            context.user_data.get('deposit_method', ''),
+            text
+        )
         
         await update.message.reply_text("درخواست واریز شما ثبت شد و در انتظار بررسی است.")
         
@@ -358,38 +348,151 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     # Handle withdrawal info
     elif context.user_data.get('awaiting_withdrawal_info'):
-        withdrawals = load_json(WITHDRAWAL_DB)
-        new_withdrawal = {
-            "ID": len(withdrawals) + 1,
-            "ID-Telegram": user_id,
-            "Username": update.effective_user.username or "Unknown",
-            "amount": context.user_data.get('withdrawal_amount', 0),
-            "side": context.user_data.get('withdrawal_method', ''),
-            "wallet-code": text,
-            "status": "Pending"
-        }
-        withdrawals.append(new_withdrawal)
-        save_json(WITHDRAWAL_DB, withdrawals)
-        
-        # Deduct balance
-        update_user_balance(user_id, -context.user_data.get('withdrawal_amount', 0))
+        # Deduct balance and record the request in one transaction
+        async with user_lock(user_id):
+            withdrawal_id = await storage.add_withdrawal(
+                user_id,
+                update.effective_user.username or "Unknown",
+                context.user_data.get('withdrawal_amount', 0),
+                context.user_data.get('withdrawal_method', ''),
+                text
+            )
         
-        await update.message.reply_text("درخواست برداشت شما ثبت شد و از موجودی شما کسر گردید.")
+        if withdrawal_id is None:
+            await update.message.reply_text("موجودی شما کافی نیست.")
+        else:
+            await update.message.reply_text("درخواست برداشت شما ثبت شد و از موجودی شما کسر گردید.")
         
         del context.user_data['awaiting_withdrawal_info']
         del context.user_data['withdrawal_amount']
         del context.user_data['withdrawal_method']
 
-def main():
-    init_json_files()
-    
-    application = Application.builder().token(BOT_TOKEN).build()
+async def route_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # One text handler for both sides: an admin mid-way through an admin
+    # flow gets admin_message_handler, everyone else the user flows
+    if admin.awaiting_admin_input(update.effective_user.id, context.user_data):
+        await admin.admin_message_handler(update, context)
+    else:
+        await handle_message(update, context)
+
+# Text-state branches of handle_message, for per-branch latency
+MESSAGE_STATES = ('bet_type', 'awaiting_deposit_amount', 'awaiting_withdrawal_amount',
+                  'awaiting_deposit_info', 'awaiting_withdrawal_info')
+
+def message_state(update, context):
+    if admin.awaiting_admin_input(update.effective_user.id, context.user_data):
+        return next(key for key in admin.ADMIN_INPUT_KEYS if context.user_data.get(key))
+    return next((key for key in MESSAGE_STATES if context.user_data.get(key)), "idle")
+
+# Sharded mode: newest game seen from each other shard, and how often to
+# look for more of them and for credits made to our users elsewhere
+shard_cursors = {}
+FOLLOW_GAMES_INTERVAL = 5.0
+BALANCE_FEED_INTERVAL = 0.5
+
+def _seen(games):
+    for game in games:
+        shard = shards.id_shard(game['ID'])
+        if shard in shard_cursors:
+            shard_cursors[shard] = max(shard_cursors[shard], game['ID'])
+        yield game
+
+def load_history():
+    # Archived chunks are read column-wise; newer games are read once and
+    # feed both the leaderboard and the stats projection
+    chunks = archive.chunks()
+    for chunk in chunks:
+        game_stats.add_chunk(chunk)
+    archived_to = max((chunk.last_id for chunk in chunks), default=0)
+    shard_cursors.clear()
+    shard_cursors.update((shard, archived_to) for shard in range(shards.SHARD_COUNT) if shard != shards.SHARD)
+    history = (totals for chunk in chunks for totals in chunk.user_totals())
+    leaderboard.rebuild(game_stats.collect(_seen(gamelog.iter_games(archived=False))), history)
+
+async def follow_games():
+    # Other shards' games reach the games table when their journal is
+    # compacted; from there they go into our leaderboard and stats
+    while True:
+        await asyncio.sleep(FOLLOW_GAMES_INTERVAL)
+        for shard in shard_cursors:
+            while games := storage.games_of_shard(shard, shard_cursors[shard]):
+                for game in games:
+                    leaderboard.record(game)
+                    game_stats.record(game)
+                shard_cursors[shard] = games[-1]['ID']
+        storage.sync_requests()
+
+async def follow_balance_feed():
+    while True:
+        await asyncio.sleep(BALANCE_FEED_INTERVAL)
+        storage.apply_balance_feed()
+
+# Endless loops; Application.stop() waits for its own create_task tasks,
+# so these are plain asyncio tasks, cancelled in post_stop
+_background = []
+
+async def post_init(application):
+    _background.append(asyncio.create_task(metrics.monitor_event_loop()))
+    if shards.SHARD_COUNT > 1:
+        _background.append(asyncio.create_task(follow_games()))
+        _background.append(asyncio.create_task(follow_balance_feed()))
+    outbox.start(application.bot)
+
+async def post_stop(application):
+    while _background:
+        _background.pop().cancel()
+    # Runs while the bot's HTTP client is still open, so queued messages
+    # can still go out
+    await outbox.stop()
+
+def build_application(request=None):
+    # Shared by polling (main below) and the webhook workers (ingress.py),
+    # which pass their own request object
+    storage.init_db()
+    gamelog.open_log()
+    load_history()
+    gamelog.start_compactor()
     
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CallbackQueryHandler(button_handler))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    # Updates are processed concurrently behind flood control; per-user
+    # locks keep balances safe. Flow state in user_data is persisted, so it
+    # survives restarts.
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(FloodControl(exempt=admin.is_admin))
+        .request(request or metrics.TimedRequest())
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .persistence(SessionPersistence())
+        .build()
+    )
+    metrics.start_server()
     
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Every handler is timed; callbacks by route, text by state branch
+    application.add_handler(CommandHandler("start", metrics.instrument(start, "start")))
+    application.add_handler(CommandHandler("admin", metrics.instrument(admin.admin_start, "admin_start")))
+    application.add_handler(CommandHandler("reload", metrics.instrument(admin.reload_settings, "reload_settings")))
+    application.add_handler(CallbackQueryHandler(
+        metrics.instrument(admin.admin_button_handler, "admin_button_handler", admin.callbacks.label),
+        pattern=admin.callbacks.matches
+    ))
+    application.add_handler(CallbackQueryHandler(
+        metrics.instrument(button_handler, "button_handler", callbacks.label)
+    ))
+    application.add_handler(MessageHandler(
+        filters.TEXT & ~filters.COMMAND,
+        metrics.instrument(route_message, "handle_message", message_state)
+    ))
+    application.add_handler(ChatMemberHandler(chat_member_update, ChatMemberHandler.CHAT_MEMBER))
+    return application
+
+def main():
+    application = build_application()
+    try:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    finally:
+        gamelog.close_log()
+        storage.close_db()
 
 if __name__ == "__main__":
     main()
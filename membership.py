@@ -0,0 +1,73 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+# Cache settings (seconds / entries)
+POSITIVE_TTL = int(os.environ.get('MEMBERSHIP_POSITIVE_TTL', 300))
+NEGATIVE_TTL = int(os.environ.get('MEMBERSHIP_NEGATIVE_TTL', 15))
+MAX_ENTRIES = int(os.environ.get('MEMBERSHIP_MAX_ENTRIES', 50000))
+
+class MembershipCache:
+    def __init__(self, channels, positive_ttl=POSITIVE_TTL, negative_ttl=NEGATIVE_TTL, max_entries=MAX_ENTRIES):
+        self.channels = list(channels)
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # user_id -> (is_member, expires_at)
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        self._entries.move_to_end(user_id)
+        return entry[0]
+
+    def put(self, user_id, is_member):
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        self._entries[user_id] = (is_member, time.monotonic() + ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+
+    def set_channels(self, channels):
+        # Cached answers were for the old list
+        if list(channels) != self.channels:
+            self.channels = list(channels)
+            self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._entries),
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+    async def _is_channel_member(self, bot, channel, user_id):
+        try:
+            member = await bot.get_chat_member(channel, user_id)
+        except Exception:
+            return False
+        return member.status not in ['left', 'kicked']
+
+    async def check(self, bot, user_id):
+        cached = self.get(user_id)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        self.misses += 1
+        results = await asyncio.gather(*(self._is_channel_member(bot, channel, user_id) for channel in self.channels))
+        is_member = all(results)
+        self.put(user_id, is_member)
+        return is_member
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram.request import HTTPXRequest
+
+import shards
+
+logger = logging.getLogger(__name__)
+
+# Scrape endpoint (Prometheus text format), bound to localhost only; webhook
+# shards listen on consecutive ports
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9108)) + shards.SHARD
+
+# Bucket upper bounds in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Callback data comes from clients, so label values per metric are capped
+MAX_LABELS = 200
+EVENT_LOOP_INTERVAL = 0.5
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+_histograms = {}  # metric name -> {label value: Histogram}
+_counters = {}  # metric name -> {label value: count}
+_lock = threading.Lock()
+
+def observe(name, label, seconds):
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        histogram = series.get(label)
+        if histogram is None:
+            if len(series) >= MAX_LABELS:
+                label = "other"
+            histogram = series.setdefault(label, Histogram())
+        histogram.observe(seconds)
+
+def increment(name, label, amount=1):
+    with _lock:
+        series = _counters.setdefault(name, {})
+        if label not in series and len(series) >= MAX_LABELS:
+            label = "other"
+        series[label] = series.get(label, 0) + amount
+
+class timer:
+    def __init__(self, name, label):
+        self.name = name
+        self.label = label
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, self.label, time.perf_counter() - self.started)
+        return False
+
+def instrument(handler, name, label=None):
+    @wraps(handler)
+    async def wrapper(update, context):
+        value = label(update, context) if label else name
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        finally:
+            observe(f"handler:{name}", value, time.perf_counter() - started)
+    return wrapper
+
+class TimedRequest(HTTPXRequest):
+    # Times every Bot API call, labelled by method (getChatMember, ...)
+    async def do_request(self, url, method, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            observe("telegram_api", url.rsplit("/", 1)[-1], time.perf_counter() - started)
+
+async def monitor_event_loop(interval=EVENT_LOOP_INTERVAL):
+    # A sleep that wakes up late means the loop was blocked for the difference
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        observe("event_loop_lag", "lag", max(0.0, time.perf_counter() - started - interval))
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+LABEL_NAMES = {"handler": "type", "telegram_api": "method", "storage": "op", "outbox": "lane", "flood": "result"}
+
+def render():
+    with _lock:
+        snapshot = {name: {label: (list(h.counts), h.total, h.count) for label, h in series.items()}
+                    for name, series in _histograms.items()}
+        counters = {name: dict(series) for name, series in _counters.items()}
+
+    metrics = {}  # metric name -> sample lines
+    for name, series in sorted(snapshot.items()):
+        kind, _, handler = name.partition(":")
+        metric = f"toptas_{kind}_seconds"
+        label_name = LABEL_NAMES.get(kind, "name")
+        lines = metrics.setdefault(metric, [])
+        for label, (counts, total, count) in sorted(series.items()):
+            labels = f'{label_name}="{_escape(label)}"'
+            if handler:
+                labels = f'handler="{handler}",' + labels
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS, counts):
+                cumulative += bucket_count
+                lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"{metric}_sum{{{labels}}} {total}")
+            lines.append(f"{metric}_count{{{labels}}} {count}")
+
+    output = []
+    for metric, lines in metrics.items():
+        output.append(f"# TYPE {metric} histogram")
+        output.extend(lines)
+    for name, series in sorted(counters.items()):
+        metric = f"toptas_{name}_total"
+        output.append(f"# TYPE {metric} counter")
+        label_name = LABEL_NAMES.get(name, "name")
+        for label, count in sorted(series.items()):
+            output.append(f'{metric}{{{label_name}="{_escape(label)}"}} {count}')
+    return "\n".join(output) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Metrics available on http://%s:%d/metrics", host, port)
+    return server
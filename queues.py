@@ -0,0 +1,65 @@
+from bisect import bisect_right
+
+class RequestQueue:
+    # Pending deposit/withdrawal requests, oldest first. Requests are kept by
+    # ID while pending; resolved ones only count towards their status and are
+    # read back from the database when needed.
+    def __init__(self):
+        self.pending = {}  # id -> record
+        self.order = []  # pending ids, ascending (= oldest first)
+        self.counts = {"Pending": 0, "Accept": 0, "Reject": 0}
+        self.max_id = 0
+
+    def add(self, record):
+        request_id = record['ID']
+        self.max_id = max(self.max_id, request_id)
+        self.counts[record['status']] = self.counts.get(record['status'], 0) + 1
+        if record['status'] != 'Pending':
+            return
+        self.pending[request_id] = record
+        if self.order and request_id < self.order[-1]:
+            self.order.insert(bisect_right(self.order, request_id), request_id)
+        else:
+            self.order.append(request_id)
+
+    def remove(self, request_id):
+        record = self.pending.pop(request_id, None)
+        if record is not None:
+            del self.order[bisect_right(self.order, request_id) - 1]
+            self.counts['Pending'] -= 1
+        return record
+
+    def resolve(self, request_id, status):
+        record = self.remove(request_id)
+        if record is not None:
+            record['status'] = status
+            self.counts[status] = self.counts.get(status, 0) + 1
+        return record
+
+    def get(self, request_id):
+        return self.pending.get(request_id)
+
+    def page(self, after_id=0, limit=5):
+        start = bisect_right(self.order, after_id)
+        return [self.pending[request_id] for request_id in self.order[start:start + limit]]
+
+    def match(self, side=None, min_amount=None, max_amount=None, telegram_id=None, username=None):
+        # Pending requests passing every filter that is given, oldest first
+        matched = []
+        for request_id in self.order:
+            record = self.pending[request_id]
+            if side is not None and (record['side'] or "").lower() != side.lower():
+                continue
+            if min_amount is not None and record['amount'] < min_amount:
+                continue
+            if max_amount is not None and record['amount'] > max_amount:
+                continue
+            if telegram_id is not None and record['ID-Telegram'] != telegram_id:
+                continue
+            if username is not None and (record['Username'] or "").lower() != username.lower():
+                continue
+            matched.append(record)
+        return matched
+
+    def has_after(self, request_id):
+        return bool(self.order) and self.order[-1] > request_id
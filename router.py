@@ -0,0 +1,60 @@
+from functools import lru_cache
+
+# Resolved callback data kept per router. One click is looked up by the
+# handler pattern, the metrics label and dispatch; only the first parses it.
+RESOLVE_CACHE_SIZE = 4096
+
+class CallbackRouter:
+    # Maps callback data to handlers. A route is either the exact data
+    # ("play") or a prefix ending in "_" ("accept_deposit_") whose remaining
+    # "_"-separated fields are parsed once by the route's converters and
+    # passed to the handler. Lookup is a dict hit per "_" in the data, so
+    # it does not grow with the number of routes.
+    def __init__(self):
+        self.routes = {}
+        self.resolve = lru_cache(maxsize=RESOLVE_CACHE_SIZE)(self._resolve)
+
+    def route(self, key, *converters):
+        def decorator(handler):
+            self.routes[key] = (handler, converters)
+            self.resolve.cache_clear()
+            return handler
+        return decorator
+
+    def _resolve(self, data):
+        route = self.routes.get(data)
+        if route is not None:
+            return data, route[0], ()
+
+        end = len(data)
+        while True:
+            end = data.rfind("_", 0, end)
+            if end < 0:
+                return None, None, ()
+            key = data[:end + 1]
+            route = self.routes.get(key)
+            if route is not None:
+                break
+
+        handler, converters = route
+        fields = data[end + 1:].split("_")
+        try:
+            args = tuple(convert(field) for convert, field in zip(converters, fields)) + tuple(fields[len(converters):])
+        except ValueError:
+            return None, None, ()
+        return key, handler, args
+
+    def matches(self, data):
+        return self.resolve(data)[1] is not None
+
+    def label(self, update, context):
+        # Route key for metrics: "accept_deposit_12" -> "accept_deposit_*"
+        key = self.resolve(update.callback_query.data)[0]
+        if key is None:
+            return "unknown"
+        return key + "*" if key.endswith("_") else key
+
+    async def dispatch(self, query, context):
+        _, handler, args = self.resolve(query.data)
+        if handler is not None:
+            await handler(query, context, *args)
@@ -0,0 +1,252 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from datetime import timedelta
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+import metrics
+import shards
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages/s overall and about one per second in a
+# single chat, with short bursts tolerated. Webhook shards split the global
+# rate between them; a chat only ever sends from its own shard.
+GLOBAL_RATE = float(os.environ.get('OUTBOX_GLOBAL_RATE', 30)) / shards.SHARD_COUNT
+CHAT_RATE = float(os.environ.get('OUTBOX_CHAT_RATE', 1))
+CHAT_BURST = 3
+MAX_ATTEMPTS = 3
+MAX_TEXT_LENGTH = 4096
+
+# Idle chats keep their bucket so a chat cannot burst again right away;
+# full buckets are dropped once there are this many chats
+MAX_IDLE_CHATS = 10000
+PRUNE_INTERVAL = 60
+
+# Lanes, highest priority first
+PAYOUT = 0
+REPLY = 1
+BROADCAST = 2
+LANE_NAMES = ("payout", "reply", "broadcast")
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        # Seconds until a token is available (0 if one is available now)
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class _Message:
+    __slots__ = ("method", "text", "kwargs", "priority", "queued", "attempts")
+
+    def __init__(self, method, text, kwargs, priority):
+        self.method = method
+        self.text = text
+        self.kwargs = kwargs
+        self.priority = priority
+        self.queued = time.monotonic()
+        self.attempts = 0
+
+class _Chat:
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.messages = deque()  # FIFO, so replies keep their order
+        self.priority = None  # lane of the chat's current heap entry
+        self.blocked_until = 0.0  # set by RetryAfter
+        self.sending = False
+
+class Outbox:
+    # Outgoing messages wait here and are sent within the global and
+    # per-chat limits. Chats with a pending payout go before plain replies,
+    # and replies before broadcasts. A chat has at most one send in flight;
+    # plain texts that piled up for it meanwhile are merged into one message.
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, chat_burst=CHAT_BURST):
+        self.global_bucket = TokenBucket(global_rate, max(1, global_rate))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.bot = None
+        self.sent = 0
+        self.merged = 0
+        self.retried = 0
+        self.dropped = 0
+        self._chats = {}
+        self._ready = []  # (lane, seq, chat_id)
+        self._delayed = []  # (ready_at, lane, seq, chat_id), rate limited chats
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._inflight = set()
+        self._task = None
+        self._pruned_at = time.monotonic()
+
+    def start(self, bot):
+        self.bot = bot
+        self._task = asyncio.create_task(self._run())
+
+    def send_text(self, chat_id, text, priority=REPLY, reply_markup=None):
+        self._enqueue(chat_id, _Message("text", text, {"reply_markup": reply_markup}, priority))
+
+    def send_dice(self, chat_id, emoji, priority=REPLY):
+        self._enqueue(chat_id, _Message("dice", None, {"emoji": emoji}, priority))
+
+    def pending(self):
+        return sum(len(chat.messages) for chat in self._chats.values()) + len(self._inflight)
+
+    def stats(self):
+        return {"pending": self.pending(), "sent": self.sent, "merged": self.merged,
+                "retried": self.retried, "dropped": self.dropped, "chats": len(self._chats)}
+
+    def _enqueue(self, chat_id, message):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat(self.chat_rate, self.chat_burst)
+        chat.messages.append(message)
+        self._schedule(chat_id, chat, message.priority)
+
+    def _schedule(self, chat_id, chat, priority):
+        # An in-flight chat is rescheduled when its send finishes; a higher
+        # lane supersedes the chat's existing entry, which is then skipped
+        if chat.sending or (chat.priority is not None and chat.priority <= priority):
+            return
+        chat.priority = priority
+        heapq.heappush(self._ready, (priority, next(self._seq), chat_id))
+        self._wakeup.set()
+
+    def _next_message(self, chat):
+        message = chat.messages.popleft()
+        if message.method != "text":
+            return message
+        # Only the last merged text may carry a keyboard
+        while (message.kwargs["reply_markup"] is None and chat.messages and chat.messages[0].method == "text"
+               and len(message.text) + len(chat.messages[0].text) + 2 <= MAX_TEXT_LENGTH):
+            following = chat.messages.popleft()
+            message.text += "\n\n" + following.text
+            message.kwargs = following.kwargs
+            message.priority = min(message.priority, following.priority)
+            self.merged += 1
+        return message
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, priority, seq, chat_id = heapq.heappop(self._delayed)
+                heapq.heappush(self._ready, (priority, seq, chat_id))
+
+            if not self._ready:
+                self._wakeup.clear()
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            priority, seq, chat_id = self._ready[0]
+            chat = self._chats.get(chat_id)
+            if chat is None or chat.sending or chat.priority != priority or not chat.messages:
+                heapq.heappop(self._ready)
+                continue
+
+            # A rate limited chat waits aside instead of holding up the others
+            wait = max(chat.blocked_until - now, chat.bucket.wait_time(now))
+            if wait > 0:
+                heapq.heappop(self._ready)
+                heapq.heappush(self._delayed, (now + wait, priority, seq, chat_id))
+                continue
+
+            wait = self.global_bucket.wait_time(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            heapq.heappop(self._ready)
+            self.global_bucket.take()
+            chat.bucket.take()
+            chat.priority = None
+            chat.sending = True
+            task = asyncio.create_task(self._deliver(chat_id, chat, self._next_message(chat)))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _deliver(self, chat_id, chat, message):
+        try:
+            if message.method == "dice":
+                await self.bot.send_dice(chat_id, **message.kwargs)
+            else:
+                await self.bot.send_message(chat_id, message.text, **message.kwargs)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            logger.warning("Flood limit hit for chat %s, retrying in %ss", chat_id, retry_after)
+            chat.blocked_until = time.monotonic() + retry_after
+            chat.messages.appendleft(message)
+            self.retried += 1
+        except (BadRequest, Forbidden) as e:
+            # Blocked the bot, deleted account, ...: retrying will not help
+            logger.info("Dropping message to chat %s: %s", chat_id, e)
+            self.dropped += 1
+        except NetworkError as e:
+            message.attempts += 1
+            if message.attempts < MAX_ATTEMPTS:
+                chat.blocked_until = time.monotonic() + message.attempts
+                chat.messages.appendleft(message)
+                self.retried += 1
+            else:
+                logger.warning("Dropping message to chat %s after %d attempts: %s", chat_id, message.attempts, e)
+                self.dropped += 1
+        except Exception:
+            logger.exception("Sending to chat %s failed", chat_id)
+            self.dropped += 1
+        else:
+            self.sent += 1
+            metrics.observe("outbox", LANE_NAMES[message.priority], time.monotonic() - message.queued)
+        finally:
+            chat.sending = False
+            if chat.messages:
+                self._schedule(chat_id, chat, min(m.priority for m in chat.messages))
+            elif len(self._chats) > MAX_IDLE_CHATS:
+                self._prune()
+
+    def _prune(self):
+        now = time.monotonic()
+        if now - self._pruned_at < PRUNE_INTERVAL:
+            return
+        self._pruned_at = now
+        idle = [chat_id for chat_id, chat in self._chats.items()
+                if not chat.messages and not chat.sending and chat.blocked_until <= now
+                and chat.bucket.wait_time(now) == 0 and chat.bucket.tokens >= chat.bucket.burst]
+        for chat_id in idle:
+            del self._chats[chat_id]
+
+    async def drain(self, timeout=None):
+        # Wait until everything queued so far has been sent (or given up on)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending() and (deadline is None or time.monotonic() < deadline):
+            await asyncio.sleep(0.05)
+
+    async def stop(self, timeout=10):
+        await self.drain(timeout)
+        if self._task is not None:
+            self._task.cancel()
+        if self.pending():
+            logger.warning("Outbox stopped with %d messages unsent", self.pending())
+
+# Shared by the user and admin handlers
+outbox = Outbox()
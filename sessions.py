@@ -0,0 +1,157 @@
+import asyncio
+import copy
+import json
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import storage
+
+# How often the application hands changed user_data over (seconds)
+SESSION_UPDATE_INTERVAL = 5
+
+# context.user_data keys, grouped by the flow that sets them. A flow expires
+# as a whole once none of its keys has changed for its TTL, so an abandoned
+# flow never leaves half of its keys behind.
+FLOWS = {
+    "bet": ('bet_type',),
+    "deposit": ('awaiting_deposit_amount', 'deposit_amount', 'deposit_method', 'awaiting_deposit_info'),
+    "withdrawal": ('awaiting_withdrawal_amount', 'withdrawal_amount', 'withdrawal_method', 'awaiting_withdrawal_info'),
+    "admin": ('editing_user_balance', 'searching_user', 'changing_win_rate', 'changing_lose_rate',
+              'filtering_requests', 'request_filter', 'selected_deposits', 'selected_withdrawals'),
+}
+FLOW_TTL = {"bet": 3600, "deposit": 86400, "withdrawal": 86400, "admin": 1800}
+DEFAULT_FLOW = "other"
+DEFAULT_TTL = 86400
+KEY_FLOWS = {key: flow for flow, keys in FLOWS.items() for key in keys}
+
+# Boolean flags are packed into the state column, one bit each; every other
+# value goes into the fields JSON
+FLAGS = ('awaiting_deposit_amount', 'awaiting_deposit_info', 'awaiting_withdrawal_amount',
+         'awaiting_withdrawal_info', 'searching_user', 'changing_win_rate', 'changing_lose_rate')
+FLAG_BITS = {key: 1 << i for i, key in enumerate(FLAGS)}
+
+_MISSING = object()
+
+def encode(data):
+    state = 0
+    fields = {}
+    for key, value in data.items():
+        bit = FLAG_BITS.get(key)
+        if bit is not None and value is True:
+            state |= bit
+        else:
+            fields[key] = value
+    return state, json.dumps(fields, separators=(",", ":"))
+
+def decode(state, fields):
+    data = json.loads(fields)
+    for key, bit in FLAG_BITS.items():
+        if state & bit:
+            data[key] = True
+    return data
+
+class SessionPersistence(BasePersistence):
+    # Persists context.user_data (the awaiting_* state machine) to the
+    # sessions table, one small row per user with something in flight.
+    # Only users whose data changed since the last run are written, and the
+    # writes go through the write-behind queue.
+    def __init__(self, update_interval=SESSION_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        # Deep copies: handlers change lists in user_data in place
+        self._saved = {}  # user_id -> data as last written
+        self._expiry = {}  # user_id -> {flow: expires at}
+
+    async def get_user_data(self):
+        now = int(time.time())
+        storage.purge_sessions(now)
+        user_data = {}
+        for user_id, state, fields, flows in storage.load_sessions(now):
+            data = decode(state, fields)
+            expiry = json.loads(flows)
+            self._expire(data, expiry, now)
+            if data:
+                user_data[user_id] = data
+                self._saved[user_id] = copy.deepcopy(data)
+                self._expiry[user_id] = expiry
+        return user_data
+
+    async def refresh_user_data(self, user_id, user_data):
+        # Runs before every handler, so abandoned flows disappear on the spot
+        expiry = self._expiry.get(user_id)
+        if expiry:
+            self._expire(user_data, expiry, time.time())
+
+    def _expire(self, data, expiry, now):
+        for flow in [flow for flow, expires in expiry.items() if expires <= now]:
+            del expiry[flow]
+            for key in [key for key in data if KEY_FLOWS.get(key, DEFAULT_FLOW) == flow]:
+                del data[key]
+
+    async def update_user_data(self, user_id, data):
+        saved = self._saved.get(user_id, {})
+        if data == saved:
+            return
+        if not data:
+            self._saved.pop(user_id, None)
+            self._expiry.pop(user_id, None)
+            storage.delete_session(user_id)
+            return
+
+        now = int(time.time())
+        expiry = self._expiry.setdefault(user_id, {})
+        changed = {key for key in data.keys() | saved.keys() if data.get(key, _MISSING) != saved.get(key, _MISSING)}
+        for flow in {KEY_FLOWS.get(key, DEFAULT_FLOW) for key in changed}:
+            expiry[flow] = now + FLOW_TTL.get(flow, DEFAULT_TTL)
+        live = {KEY_FLOWS.get(key, DEFAULT_FLOW) for key in data}
+        for flow in [flow for flow in expiry if flow not in live]:
+            del expiry[flow]
+
+        self._saved[user_id] = copy.deepcopy(data)
+        state, fields = encode(data)
+        storage.save_session(user_id, state, fields, json.dumps(expiry, separators=(",", ":")), max(expiry.values()))
+
+    async def drop_user_data(self, user_id):
+        self._saved.pop(user_id, None)
+        self._expiry.pop(user_id, None)
+        storage.delete_session(user_id)
+
+    async def flush(self):
+        await asyncio.to_thread(storage.flush)
+
+    # Only user_data is stored
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
@@ -0,0 +1,26 @@
+import os
+
+# Webhook mode (ingress.py) runs SHARD_COUNT worker processes over the same
+# database; each owns the users whose Telegram ID hashes to it. With the
+# default of one shard everything below is a no-op.
+SHARD = int(os.environ.get('TOPTAS_SHARD', 0))
+SHARD_COUNT = int(os.environ.get('TOPTAS_SHARDS', 1))
+
+def shard_of(telegram_id, count=None):
+    return telegram_id % (count or SHARD_COUNT)
+
+def owns(telegram_id):
+    return shard_of(telegram_id) == SHARD
+
+def next_id(after):
+    # IDs are striped across shards (shard k hands out k+1, k+1+N, ...), so
+    # processes never pick the same ID for users, games or requests
+    candidate = after + 1
+    return candidate + (SHARD - (candidate - 1)) % SHARD_COUNT
+
+def id_shard(record_id):
+    return (record_id - 1) % SHARD_COUNT
+
+def local_dir(path):
+    # Per-process files (game journal, balance log) get a directory per shard
+    return path if SHARD_COUNT == 1 else os.path.join(path, f"shard-{SHARD}")
@@ -0,0 +1,176 @@
+import numpy as np
+from datetime import date
+
+# Bet kinds, stored as small ints in the projection
+BET_KINDS = ("even", "odd", "number", "unknown")
+_KIND_CODES = {"even": 0, "odd": 1}
+_NUMBER_KIND = 2
+_UNKNOWN_KIND = 3
+
+# Window name -> length in days (None = all time), as in leaderboard.py
+WINDOWS = {"daily": 1, "weekly": 7, "all": None}
+DAY = 86400
+# Queued games are converted once this many pile up, even with no report
+MAX_PENDING = 100000
+
+def _kind(bet_type):
+    if bet_type is None:
+        return _UNKNOWN_KIND
+    if bet_type.isdigit():
+        return _NUMBER_KIND
+    return _KIND_CODES.get(bet_type, _UNKNOWN_KIND)
+
+def _local_seconds(day_ordinal):
+    # Dates are naive local ISO strings, stored as seconds since 1970-01-01 "local"
+    return (day_ordinal - date(1970, 1, 1).toordinal()) * DAY
+
+class GameStats:
+    # Columnar projection of the game history: one NumPy array per field,
+    # grown by doubling. Recording a game only queues the dict; queued games
+    # are converted in bulk the next time a report is asked for. Rows are
+    # kept in date order, so a time window is a searchsorted slice; they
+    # mostly arrive that way, but other shards' games come in late.
+    def __init__(self, capacity=1 << 16):
+        self.size = 0
+        self.user = np.empty(capacity, np.int32)  # dense index into user_ids
+        self.bet = np.empty(capacity, np.int64)
+        self.profit = np.empty(capacity, np.int64)
+        self.won = np.empty(capacity, np.bool_)
+        self.kind = np.empty(capacity, np.int8)
+        self.time = np.empty(capacity, np.int64)
+        self.user_ids = []  # dense index -> telegram_id
+        self.usernames = []  # dense index -> latest username
+        self._user_index = {}  # telegram_id -> dense index
+        self._pending = []
+
+    def record(self, game):
+        self._pending.append(game)
+        if len(self._pending) >= MAX_PENDING:
+            self.refresh()
+
+    def collect(self, games):
+        # Records every game while passing it on, so one pass over the
+        # history can feed other views too
+        for game in games:
+            self._pending.append(game)
+            if len(self._pending) >= MAX_PENDING:
+                self.refresh()
+            yield game
+
+    def add_chunk(self, chunk):
+        # Appends an archived chunk (archive.Chunk) column-wise, without
+        # building a dict per game; chunks must come before newer games
+        self.refresh()
+        telegram_ids, inverse = np.unique(chunk.column("telegram_id"), return_inverse=True)
+        last = np.zeros(len(telegram_ids), np.int64)
+        np.maximum.at(last, inverse, np.arange(chunk.rows))
+        usernames = chunk.column("username")[last]
+        dense = np.array([self._index(telegram_id, chunk.usernames[usernames[i]])
+                          for i, telegram_id in enumerate(telegram_ids.tolist())], np.int32)
+
+        win_code = chunk.statuses.index("win") if "win" in chunk.statuses else -1
+        kinds = np.array([_kind(bet_type) for bet_type in chunk.bet_types], np.int8)
+        start, end = self.size, self.size + chunk.rows
+        self._grow(end)
+        self.user[start:end] = dense[inverse]
+        self.bet[start:end] = chunk.column("bet")
+        self.profit[start:end] = chunk.column("profit")
+        self.won[start:end] = chunk.column("status") == win_code
+        self.kind[start:end] = kinds[chunk.column("bet_type")]
+        self.time[start:end] = chunk.column("time")
+        self.size = end
+        self._sort_tail(start)
+
+    def _grow(self, needed):
+        capacity = len(self.bet)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name in ("user", "bet", "profit", "won", "kind", "time"):
+            column = getattr(self, name)
+            grown = np.empty(capacity, column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+
+    def _index(self, telegram_id, username):
+        index = self._user_index.get(telegram_id)
+        if index is None:
+            index = self._user_index[telegram_id] = len(self.user_ids)
+            self.user_ids.append(telegram_id)
+            self.usernames.append(username)
+        else:
+            self.usernames[index] = username
+        return index
+
+    def refresh(self):
+        games, self._pending = self._pending, []
+        if not games:
+            return
+        start, end = self.size, self.size + len(games)
+        self._grow(end)
+        self.user[start:end] = [self._index(g['ID-Telegram'], g['Username']) for g in games]
+        self.bet[start:end] = [g['bet'] for g in games]
+        self.profit[start:end] = [g['profit'] for g in games]
+        self.won[start:end] = [g['status'] == "win" for g in games]
+        self.kind[start:end] = [_kind(g.get('bet_type')) for g in games]
+        self.time[start:end] = np.array([g['date'][:19] for g in games], dtype='datetime64[s]').astype(np.int64)
+        self.size = end
+        self._sort_tail(start)
+
+    def _sort_tail(self, start):
+        # Restores date order after rows were appended at start; only the
+        # rows from the first one newer than the oldest appended are moved
+        time = self.time[:self.size]
+        tail = time[max(start - 1, 0):]
+        if np.all(tail[1:] >= tail[:-1]):
+            return
+        lo = int(np.searchsorted(time[:start], time[start:].min(), side='right'))
+        order = np.argsort(time[lo:], kind='stable') + lo
+        for name in ("user", "bet", "profit", "won", "kind", "time"):
+            column = getattr(self, name)
+            column[lo:self.size] = column[order]
+
+    def _window(self, window, today):
+        days = WINDOWS[window]
+        if days is None:
+            return 0, _local_seconds(today + 1)
+        begin = _local_seconds(today - days + 1)
+        return int(np.searchsorted(self.time[:self.size], begin)), begin
+
+    def report(self, window, top=5, today=None):
+        self.refresh()
+        today = today or date.today().toordinal()
+        start, begin = self._window(window, today)
+        user = self.user[start:self.size]
+        bet = self.bet[start:self.size]
+        profit = self.profit[start:self.size]
+        won = self.won[start:self.size]
+        kind = self.kind[start:self.size]
+
+        report = {
+            "games": len(bet),
+            "players": int(np.count_nonzero(np.bincount(user, minlength=len(self.user_ids)))) if len(user) else 0,
+            "volume": int(bet.sum()),
+            "house": -int(profit.sum()),
+            "win_rate": float(won.mean() * 100) if len(won) else 0.0,
+            "volume_by_kind": dict(zip(BET_KINDS, np.bincount(kind, weights=bet, minlength=len(BET_KINDS)).astype(np.int64).tolist())),
+            "daily_house": [],
+            "top_losers": []
+        }
+
+        if WINDOWS[window] is not None and WINDOWS[window] > 1:
+            day = (self.time[start:self.size] - begin) // DAY
+            house = -np.bincount(day, weights=profit, minlength=WINDOWS[window])[:WINDOWS[window]].astype(np.int64)
+            first = today - WINDOWS[window] + 1
+            report["daily_house"] = [(date.fromordinal(first + i).isoformat(), int(value)) for i, value in enumerate(house)]
+
+        if len(user):
+            totals = np.bincount(user, weights=profit, minlength=len(self.user_ids))
+            losers = np.argpartition(totals, top)[:top] if len(totals) > top else np.arange(len(totals))
+            losers = losers[np.argsort(totals[losers], kind='stable')]
+            report["top_losers"] = [(self.usernames[i], -int(totals[i])) for i in losers if totals[i] < 0]
+        return report
+
+# Shared by the bet handler (record) and the admin panel (report)
+game_stats = GameStats()
@@ -0,0 +1,909 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import jsonstream
+import metrics
+import shards
+from balancelog import BalanceLog
+from queues import RequestQueue
+from writer import LEDGER_INSERT, WriteBehindQueue
+
+logger = logging.getLogger(__name__)
+
+# Database file
+DB_PATH = os.environ.get('TOPTAS_DB', 'toptas.db')
+
+# Legacy JSON files, imported once into an empty database
+USER_DB = "user.json"
+GAME_DB = "game.json"
+DEPOSIT_DB = "deposit.json"
+WITHDRAWAL_DB = "withdrawal.json"
+LOGIC_DB = "logic.json"
+WALLET_DB = "wallet.json"
+
+DEFAULT_LOGIC = {"win": 50, "lose": 50, "random": True}
+DEFAULT_WALLETS = {"TRC20": "890qya3ymf8oqkzfgqa9HKDSU89QWFU8", "POL": "werj9yxf78wgo7frgwiarfsjdufgfnxvidb"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    telegram_id INTEGER NOT NULL UNIQUE,
+    username TEXT,
+    balance INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'Active',
+    description TEXT,
+    last_active INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS games (
+    id INTEGER PRIMARY KEY,
+    telegram_id INTEGER NOT NULL,
+    username TEXT,
+    bet INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    date TEXT NOT NULL,
+    profit INTEGER NOT NULL,
+    bet_type TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_games_user ON games(telegram_id, id);
+CREATE INDEX IF NOT EXISTS idx_games_date ON games(date);
+
+CREATE TABLE IF NOT EXISTS deposits (
+    id INTEGER PRIMARY KEY,
+    telegram_id INTEGER NOT NULL,
+    username TEXT,
+    amount INTEGER NOT NULL,
+    side TEXT,
+    information TEXT,
+    status TEXT NOT NULL DEFAULT 'Pending'
+);
+CREATE INDEX IF NOT EXISTS idx_deposits_status ON deposits(status, id);
+CREATE INDEX IF NOT EXISTS idx_deposits_user ON deposits(telegram_id);
+
+CREATE TABLE IF NOT EXISTS withdrawals (
+    id INTEGER PRIMARY KEY,
+    telegram_id INTEGER NOT NULL,
+    username TEXT,
+    amount INTEGER NOT NULL,
+    side TEXT,
+    wallet_code TEXT,
+    status TEXT NOT NULL DEFAULT 'Pending'
+);
+CREATE INDEX IF NOT EXISTS idx_withdrawals_status ON withdrawals(status, id);
+CREATE INDEX IF NOT EXISTS idx_withdrawals_user ON withdrawals(telegram_id);
+
+CREATE TABLE IF NOT EXISTS logic (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    win INTEGER NOT NULL,
+    lose INTEGER NOT NULL,
+    random INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS wallets (
+    side TEXT PRIMARY KEY,
+    address TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    telegram_id INTEGER PRIMARY KEY,
+    state INTEGER NOT NULL,
+    fields TEXT NOT NULL,
+    flows TEXT NOT NULL,
+    expires INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires);
+
+-- One row per shard (id = shard + 1)
+CREATE TABLE IF NOT EXISTS balance_log_state (
+    id INTEGER PRIMARY KEY,
+    applied_seq INTEGER NOT NULL
+);
+
+-- Balance changes made on behalf of another shard's user, for that shard
+-- to apply to its resident copy
+CREATE TABLE IF NOT EXISTS balance_feed (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    shard INTEGER NOT NULL,
+    telegram_id INTEGER NOT NULL,
+    amount INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_balance_feed_shard ON balance_feed(shard, id);
+
+-- Running totals for the admin panel header, kept by the triggers below in
+-- the same transaction as the change (whichever process or tool makes it).
+-- daily_volume counts games as they enter the table; archiving does not
+-- take them out.
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS daily_volume (
+    day TEXT PRIMARY KEY,
+    games INTEGER NOT NULL,
+    volume INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS count_user_insert AFTER INSERT ON users BEGIN
+    UPDATE counters SET value = value + 1 WHERE name = 'users';
+    UPDATE counters SET value = value + NEW.balance WHERE name = 'balance';
+END;
+CREATE TRIGGER IF NOT EXISTS count_user_delete AFTER DELETE ON users BEGIN
+    UPDATE counters SET value = value - 1 WHERE name = 'users';
+    UPDATE counters SET value = value - OLD.balance WHERE name = 'balance';
+END;
+CREATE TRIGGER IF NOT EXISTS count_user_balance AFTER UPDATE OF balance ON users
+WHEN NEW.balance != OLD.balance BEGIN
+    UPDATE counters SET value = value + NEW.balance - OLD.balance WHERE name = 'balance';
+END;
+CREATE TRIGGER IF NOT EXISTS count_deposit_insert AFTER INSERT ON deposits WHEN NEW.status = 'Pending' BEGIN
+    UPDATE counters SET value = value + 1 WHERE name = 'pending_deposits';
+END;
+CREATE TRIGGER IF NOT EXISTS count_deposit_delete AFTER DELETE ON deposits WHEN OLD.status = 'Pending' BEGIN
+    UPDATE counters SET value = value - 1 WHERE name = 'pending_deposits';
+END;
+CREATE TRIGGER IF NOT EXISTS count_deposit_status AFTER UPDATE OF status ON deposits BEGIN
+    UPDATE counters SET value = value + (NEW.status = 'Pending') - (OLD.status = 'Pending') WHERE name = 'pending_deposits';
+END;
+CREATE TRIGGER IF NOT EXISTS count_withdrawal_insert AFTER INSERT ON withdrawals WHEN NEW.status = 'Pending' BEGIN
+    UPDATE counters SET value = value + 1 WHERE name = 'pending_withdrawals';
+END;
+CREATE TRIGGER IF NOT EXISTS count_withdrawal_delete AFTER DELETE ON withdrawals WHEN OLD.status = 'Pending' BEGIN
+    UPDATE counters SET value = value - 1 WHERE name = 'pending_withdrawals';
+END;
+CREATE TRIGGER IF NOT EXISTS count_withdrawal_status AFTER UPDATE OF status ON withdrawals BEGIN
+    UPDATE counters SET value = value + (NEW.status = 'Pending') - (OLD.status = 'Pending') WHERE name = 'pending_withdrawals';
+END;
+-- Double-entry ledger: every balance movement moves `amount` from a
+-- counter-account (house, deposits, withdrawals, adjustment, opening) to
+-- the user, in the same transaction as the balance change. ref points at
+-- the row behind it ("game:12", "deposits:7", ...). ledger.py reconciles
+-- balances against it.
+CREATE TABLE IF NOT EXISTS ledger (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id INTEGER NOT NULL,
+    account TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    ref TEXT,
+    created INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+);
+CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger(telegram_id, id);
+-- Users arriving with a balance (legacy migration, datatool import)
+CREATE TRIGGER IF NOT EXISTS ledger_opening_balance AFTER INSERT ON users WHEN NEW.balance != 0 BEGIN
+    INSERT INTO ledger (telegram_id, account, amount, ref) VALUES (NEW.telegram_id, 'opening', NEW.balance, NULL);
+END;
+
+CREATE TRIGGER IF NOT EXISTS count_game_insert AFTER INSERT ON games BEGIN
+    INSERT INTO daily_volume (day, games, volume) VALUES (substr(NEW.date, 1, 10), 1, NEW.bet)
+    ON CONFLICT (day) DO UPDATE SET games = games + 1, volume = volume + excluded.volume;
+END;
+"""
+
+# Column name -> record key used by the handlers
+USER_FIELDS = [("id", "ID"), ("telegram_id", "ID-Telegram"), ("username", "Username"),
+               ("balance", "Balance"), ("status", "Status"), ("description", "Description")]
+GAME_FIELDS = [("id", "ID"), ("telegram_id", "ID-Telegram"), ("username", "Username"),
+               ("bet", "bet"), ("status", "status"), ("date", "date"), ("profit", "profit"),
+               ("bet_type", "bet_type")]
+DEPOSIT_FIELDS = [("id", "ID"), ("telegram_id", "ID-Telegram"), ("username", "Username"),
+                  ("amount", "amount"), ("side", "side"), ("information", "information"), ("status", "status")]
+WITHDRAWAL_FIELDS = [("id", "ID"), ("telegram_id", "ID-Telegram"), ("username", "Username"),
+                     ("amount", "amount"), ("side", "side"), ("wallet_code", "wallet-code"), ("status", "status")]
+
+# Table -> legacy JSON array file and its fields
+LEGACY_TABLES = {
+    "users": (USER_DB, USER_FIELDS),
+    "games": (GAME_DB, GAME_FIELDS),
+    "deposits": (DEPOSIT_DB, DEPOSIT_FIELDS),
+    "withdrawals": (WITHDRAWAL_DB, WITHDRAWAL_FIELDS)
+}
+
+_conn = None
+_lock = threading.RLock()
+_writer = None
+_balance_log = None
+_LOG_STATE_ID = shards.SHARD + 1
+_feed_cursor = 0
+
+# Resident user index, keyed by Telegram ID and by internal ID. Both maps
+# point at the same record, so a write-through updates both at once.
+_users_by_telegram = {}
+_users_by_id = {}
+_next_user_id = 1
+
+def _columns(fields):
+    return ", ".join(column for column, _ in fields)
+
+def _record(row, fields):
+    if row is None:
+        return None
+    return {key: row[i] for i, (_, key) in enumerate(fields)}
+
+def _load_legacy(file_path):
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return []
+
+def _iter_legacy(file_path):
+    # Streams the records of a legacy array file instead of loading it whole;
+    # a damaged file is imported up to the damage
+    try:
+        for record, _ in jsonstream.iter_array(file_path):
+            yield record
+    except FileNotFoundError:
+        return
+    except ValueError as e:
+        logger.warning("Stopped importing %s: %s", file_path, e)
+
+def _insert_records(table, fields, records):
+    placeholders = ", ".join("?" for _ in fields)
+    _conn.executemany(
+        f"INSERT OR IGNORE INTO {table} ({_columns(fields)}) VALUES ({placeholders})",
+        (tuple(record.get(key) for _, key in fields) for record in records)
+    )
+
+def _upgrade_schema(conn):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(users)")]
+    if "last_active" not in columns:
+        conn.execute("ALTER TABLE users ADD COLUMN last_active INTEGER NOT NULL DEFAULT 0")
+    if "bet_type" not in [row[1] for row in conn.execute("PRAGMA table_info(games)")]:
+        conn.execute("ALTER TABLE games ADD COLUMN bet_type TEXT")
+    # Indexes behind the admin user browser (keyset pages and prefix search)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_balance ON users(balance, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_active ON users(last_active, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_telegram_text ON users(CAST(telegram_id AS TEXT))")
+    conn.execute("INSERT OR IGNORE INTO balance_log_state (id, applied_seq) VALUES (?, 0)", (_LOG_STATE_ID,))
+    if conn.execute("SELECT 1 FROM counters LIMIT 1").fetchone() is None:
+        _rebuild_counters(conn)
+    if conn.execute("SELECT 1 FROM ledger LIMIT 1").fetchone() is None:
+        # Balances from before the ledger existed become opening entries
+        conn.execute("INSERT INTO ledger (telegram_id, account, amount, ref) "
+                     "SELECT telegram_id, 'opening', balance, NULL FROM users WHERE balance != 0")
+
+def _rebuild_counters(conn):
+    # Recounts everything from the tables. Days whose games are all archived
+    # are no longer in the games table and keep their daily_volume rows.
+    conn.execute("DELETE FROM counters")
+    conn.execute(
+        "INSERT INTO counters (name, value) "
+        "SELECT 'users', COUNT(*) FROM users UNION ALL "
+        "SELECT 'balance', COALESCE(SUM(balance), 0) FROM users UNION ALL "
+        "SELECT 'pending_deposits', COUNT(*) FROM deposits WHERE status = 'Pending' UNION ALL "
+        "SELECT 'pending_withdrawals', COUNT(*) FROM withdrawals WHERE status = 'Pending'"
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO daily_volume (day, games, volume) "
+        "SELECT substr(date, 1, 10), COUNT(*), SUM(bet) FROM games GROUP BY substr(date, 1, 10)"
+    )
+
+def _migrate_legacy():
+    for table, (file_path, fields) in LEGACY_TABLES.items():
+        if _conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is None:
+            _insert_records(table, fields, _iter_legacy(file_path))
+
+    if _conn.execute("SELECT 1 FROM logic").fetchone() is None:
+        logic = (_load_legacy(LOGIC_DB) or [DEFAULT_LOGIC])[0]
+        _conn.execute("INSERT INTO logic (id, win, lose, random) VALUES (1, ?, ?, ?)",
+                      (logic['win'], logic['lose'], int(bool(logic['random']))))
+
+    if _conn.execute("SELECT 1 FROM wallets LIMIT 1").fetchone() is None:
+        wallets = (_load_legacy(WALLET_DB) or [DEFAULT_WALLETS])[0]
+        _conn.executemany("INSERT INTO wallets (side, address) VALUES (?, ?)", wallets.items())
+
+def _cache_user(user):
+    _users_by_telegram[user['ID-Telegram']] = user
+    _users_by_id[user['ID']] = user
+    return user
+
+def _load_users():
+    global _next_user_id
+    _users_by_telegram.clear()
+    _users_by_id.clear()
+    for row in _conn.execute(f"SELECT {_columns(USER_FIELDS)} FROM users"):
+        _cache_user(_record(row, USER_FIELDS))
+    _next_user_id = shards.next_id(max(_users_by_id, default=0))
+
+def _replay_balance_log():
+    # Re-apply balance operations that were logged but never committed
+    applied_seq = _conn.execute("SELECT applied_seq FROM balance_log_state WHERE id = ?", (_LOG_STATE_ID,)).fetchone()[0]
+    entries = _balance_log.open(applied_seq)
+    if not entries:
+        return
+    with transaction():
+        for seq, op, args in entries:
+            # As in the writer, an operation that fails is skipped alone
+            _conn.execute("SAVEPOINT replay")
+            try:
+                _BALANCE_OPS[op](*args)(_conn)
+            except sqlite3.Error:
+                logger.exception("Skipping balance log entry %d (%s)", seq, op)
+                _conn.execute("ROLLBACK TO replay")
+            _conn.execute("RELEASE replay")
+        _conn.execute("UPDATE balance_log_state SET applied_seq = ? WHERE id = ?", (entries[-1][0], _LOG_STATE_ID))
+    logger.warning("Replayed %d balance operations from the balance log (seq %d-%d)", len(entries), entries[0][0], entries[-1][0])
+
+def connect(path):
+    # A connection to an up-to-date database; also used by datatool.py
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.executescript(SCHEMA)
+    conn.execute("BEGIN IMMEDIATE")
+    _upgrade_schema(conn)
+    conn.execute("COMMIT")
+    return conn
+
+def init_db(path=None):
+    global _conn, _writer, _balance_log, _feed_cursor
+    with _lock:
+        if _conn is not None:
+            return
+        path = path or DB_PATH
+        _conn = connect(path)
+        with transaction():
+            _migrate_legacy()
+        _balance_log = BalanceLog()
+        _replay_balance_log()
+        with transaction():
+            # Feed rows already in the database are in the balances just loaded
+            _load_users()
+            _feed_cursor = _conn.execute("SELECT COALESCE(MAX(id), 0) FROM balance_feed WHERE shard = ?", (shards.SHARD,)).fetchone()[0]
+            _conn.execute("DELETE FROM balance_feed WHERE shard = ? AND id <= ?", (shards.SHARD, _feed_cursor))
+        _load_queues()
+        _writer = WriteBehindQueue(path, on_commit=_balance_log.checkpoint, log_state_id=_LOG_STATE_ID)
+        _writer.start()
+
+def close_db():
+    # Drain pending writes before closing
+    global _conn, _writer, _balance_log
+    with _lock:
+        if _writer is not None:
+            _writer.drain()
+            _writer = None
+        if _balance_log is not None:
+            _balance_log.close()
+            _balance_log = None
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+        _users_by_telegram.clear()
+        _users_by_id.clear()
+
+class transaction:
+    # BEGIN IMMEDIATE takes the write lock up front so a concurrent writer
+    # (the other bot process) waits instead of failing half way through.
+    def __enter__(self):
+        _lock.acquire()
+        try:
+            _conn.execute("BEGIN IMMEDIATE")
+        except BaseException:
+            _lock.release()
+            raise
+        return _conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            _conn.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        finally:
+            _lock.release()
+        return False
+
+def _fetchone(sql, params=()):
+    with _lock, metrics.timer("storage", "read"):
+        return _conn.execute(sql, params).fetchone()
+
+def _fetchall(sql, params=()):
+    with _lock, metrics.timer("storage", "read"):
+        return _conn.execute(sql, params).fetchall()
+
+# Writes are queued on the write-behind worker. The in-memory state is
+# updated first; money-moving operations are coroutines that return only
+# once their group commit is on disk.
+def _submit(job):
+    return _writer.submit(job)
+
+async def _barrier(job):
+    return await asyncio.wrap_future(_writer.submit(job))
+
+def flush():
+    # Block until everything queued so far is committed
+    _writer.submit(lambda conn: None).result()
+
+# Users (reads are served from the resident index, writes go through to it)
+def get_user(telegram_id):
+    if not shards.owns(telegram_id):
+        return _user_from_db("telegram_id", telegram_id)
+    user = _users_by_telegram.get(telegram_id)
+    return dict(user) if user else None
+
+def get_user_by_id(user_id):
+    user = _users_by_id.get(user_id)
+    if shards.SHARD_COUNT > 1 and (user is None or not shards.owns(user['ID-Telegram'])):
+        return _user_from_db("id", user_id)
+    return dict(user) if user else None
+
+def _user_from_db(column, value):
+    # Users of another shard: this process's copy of them (if any) is not
+    # kept current, so read the database
+    row = _fetchone(f"SELECT {_columns(USER_FIELDS)} FROM users WHERE {column} = ?", (value,))
+    return _record(row, USER_FIELDS)
+
+def create_user(telegram_id, username):
+    global _next_user_id
+    with _lock:
+        if telegram_id in _users_by_telegram:
+            return get_user(telegram_id)
+        user = _cache_user({
+            "ID": _next_user_id,
+            "ID-Telegram": telegram_id,
+            "Username": username,
+            "Balance": 0,
+            "Status": "Active",
+            "Description": "New User"
+        })
+        _next_user_id = shards.next_id(_next_user_id)
+    _submit(lambda conn: conn.execute(
+        "INSERT OR IGNORE INTO users (id, telegram_id, username, balance, status, description) VALUES (?, ?, ?, 0, 'Active', 'New User')",
+        (user['ID'], telegram_id, username)
+    ))
+    return dict(user)
+
+def _apply_balance(telegram_id, amount, required, op):
+    # Compare-and-apply against the resident index: the change only lands if
+    # the balance still covers `required` and never goes negative. `op` is
+    # appended to the balance log first; returns (new balance, log seq).
+    with _lock:
+        user = _users_by_telegram.get(telegram_id)
+        if user is None or user['Balance'] < max(required, -amount, 0):
+            return None, None
+        seq = _balance_log.append(*op)
+        user['Balance'] += amount
+        return user['Balance'], seq
+
+def touch_user(telegram_id):
+    if telegram_id in _users_by_telegram:
+        _writer.add_delta(telegram_id, last_active=int(time.time()))
+
+# Admin user browser: keyset pages over indexed columns. A cursor is the
+# (sort value, id) of the row at the page edge, so each page is one index
+# seek plus `limit` rows, however deep it is.
+USER_SORTS = {
+    "id": ("id", "ASC"),
+    "balance": ("balance", "DESC"),
+    "active": ("last_active", "DESC")
+}
+
+def page_users(sort, cursor=None, backward=False, limit=10):
+    column, order = USER_SORTS[sort]
+    descending = (order == "DESC") != backward
+    comparison = "<" if descending else ">"
+    direction = "DESC" if descending else "ASC"
+
+    where, params = "", []
+    if cursor is not None:
+        where = f"WHERE ({column}, id) {comparison} (?, ?)"
+        params = list(cursor)
+    rows = _fetchall(
+        f"SELECT id, {column} FROM users {where} ORDER BY {column} {direction}, id {direction} LIMIT ?",
+        params + [limit + 1]
+    )
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    users = [user for user in map(get_user_by_id, (row[0] for row in rows)) if user]
+    cursors = [(row[1], row[0]) for row in rows]
+    return users, cursors, has_more
+
+def search_users(query, limit=10):
+    query = query.strip().lstrip("@")
+    if not query:
+        return []
+    if query.isdigit():
+        # Exact internal ID / Telegram ID first, then Telegram ID prefix
+        rows = _fetchall(
+            "SELECT id FROM users WHERE id = ? OR telegram_id = ? "
+            "UNION SELECT id FROM users WHERE CAST(telegram_id AS TEXT) >= ? AND CAST(telegram_id AS TEXT) < ? LIMIT ?",
+            (int(query), int(query), query, query + "\uffff", limit)
+        )
+    else:
+        rows = _fetchall(
+            "SELECT id FROM users WHERE username >= ? AND username < ? ORDER BY username LIMIT ?",
+            (query, query + "\uffff", limit)
+        )
+    return [user for user in map(get_user_by_id, (row[0] for row in rows)) if user]
+
+def update_user_balance(telegram_id, amount, required=0, account="house", ref=None):
+    # Returns the new balance, or None if the user is missing or short of funds
+    with _lock:
+        balance, seq = _apply_balance(telegram_id, amount, required, ("delta", telegram_id, amount, account, ref))
+        if balance is not None:
+            _writer.add_delta(telegram_id, amount, seq=seq, entry=(telegram_id, account, amount, ref))
+    return balance
+
+def _credit_cached(telegram_id, amount):
+    with _lock:
+        if telegram_id in _users_by_telegram:
+            _users_by_telegram[telegram_id]['Balance'] += amount
+
+def _delta_job(telegram_id, amount, account="house", ref=None):
+    # Bets normally reach the database as coalesced deltas; this job is
+    # only used when replaying the balance log
+    def job(conn):
+        conn.execute("UPDATE users SET balance = balance + ? WHERE telegram_id = ?", (amount, telegram_id))
+        conn.execute(LEDGER_INSERT, (telegram_id, account, amount, ref))
+    return job
+
+def _set_balance_job(user_id, balance):
+    # Applied as a delta so the owning shard can be told about it
+    def job(conn):
+        row = conn.execute("SELECT telegram_id, balance FROM users WHERE id = ?", (user_id,)).fetchone()
+        if row is not None and row[1] != balance:
+            _credit(conn, "adjustment", [(row[0], balance - row[1], "admin")])
+    return job
+
+def _credit(conn, account, credits):
+    # credits: [(telegram_id, amount, ledger ref)], each posted against
+    # `account`. A user owned by another shard also gets a balance_feed row,
+    # which that shard applies to its resident copy.
+    conn.executemany("UPDATE users SET balance = balance + ? WHERE telegram_id = ?",
+                     [(amount, telegram_id) for telegram_id, amount, _ in credits])
+    conn.executemany(LEDGER_INSERT, [(telegram_id, account, amount, ref) for telegram_id, amount, ref in credits])
+    if shards.SHARD_COUNT > 1:
+        conn.executemany("INSERT INTO balance_feed (shard, telegram_id, amount) VALUES (?, ?, ?)",
+                         [(shards.shard_of(telegram_id), telegram_id, amount)
+                          for telegram_id, amount, _ in credits if not shards.owns(telegram_id)])
+
+def apply_balance_feed():
+    # Sharded mode: pick up credits other shards made to our users
+    global _feed_cursor
+    rows = _fetchall("SELECT id, telegram_id, amount FROM balance_feed WHERE shard = ? AND id > ? ORDER BY id",
+                     (shards.SHARD, _feed_cursor))
+    if not rows:
+        return 0
+    for _, telegram_id, amount in rows:
+        _credit_cached(telegram_id, amount)
+    _feed_cursor = cursor = rows[-1][0]
+    _submit(lambda conn: conn.execute("DELETE FROM balance_feed WHERE shard = ? AND id <= ?", (shards.SHARD, cursor)))
+    return len(rows)
+
+async def set_user_balance(user_id, balance):
+    with _lock:
+        future = _submit_logged("set_balance", user_id, balance)
+        if user_id in _users_by_id:
+            _users_by_id[user_id]['Balance'] = balance
+    await asyncio.wrap_future(future)
+
+def set_user_status(user_id, status):
+    with _lock:
+        if user_id in _users_by_id:
+            _users_by_id[user_id]['Status'] = status
+    _submit(lambda conn: conn.execute("UPDATE users SET status = ? WHERE id = ?", (status, user_id)))
+
+# Admin panel totals (see the counters table)
+def get_counters():
+    return dict(_fetchall("SELECT name, value FROM counters"))
+
+def get_daily_volume(day):
+    # (games, volume) that have reached the games table for an ISO day
+    row = _fetchone("SELECT games, volume FROM daily_volume WHERE day = ?", (day,))
+    return tuple(row) if row else (0, 0)
+
+async def rebuild_counters():
+    # Runs on the writer, after the writes queued before it
+    await asyncio.wrap_future(_submit(_rebuild_counters))
+
+# Games (new games are appended to gamelog.py and compacted in here)
+def add_games(records):
+    # Called from the compactor thread; waits for its own group commit
+    rows = [tuple(record.get(key) for _, key in GAME_FIELDS) for record in records]
+    placeholders = ", ".join("?" for _ in GAME_FIELDS)
+    _submit(lambda conn: conn.executemany(
+        f"INSERT OR IGNORE INTO games ({_columns(GAME_FIELDS)}) VALUES ({placeholders})", rows
+    )).result()
+
+def _scan(sql, params=()):
+    # Long scans for background threads run on their own connection, so the
+    # shared one (and with it the event loop) is not held up
+    conn = sqlite3.connect(_writer.db_path)
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+def count_games_before(cutoff):
+    return _scan("SELECT COUNT(*) FROM games WHERE date < ?", (cutoff,))[0][0]
+
+def games_before(cutoff, limit):
+    # The oldest games by ID, up to the first one dated on or after cutoff,
+    # so archived games are always an ID prefix of the history
+    rows = _scan(f"SELECT {_columns(GAME_FIELDS)} FROM games ORDER BY id LIMIT ?", (limit,))
+    date_index = [column for column, _ in GAME_FIELDS].index("date")
+    for i, row in enumerate(rows):
+        if row[date_index] >= cutoff:
+            return rows[:i]
+    return rows
+
+def delete_games(up_to_id):
+    # Called from the compactor thread once the games are archived
+    _submit(lambda conn: conn.execute("DELETE FROM games WHERE id <= ?", (up_to_id,))).result()
+
+def max_game_id():
+    return _fetchone("SELECT COALESCE(MAX(id), 0) FROM games")[0]
+
+def games_of_shard(shard, after_id, limit=1000):
+    # Games another shard has compacted into the table since after_id
+    rows = _fetchall(
+        f"SELECT {_columns(GAME_FIELDS)} FROM games WHERE id > ? AND (id - 1) % ? = ? ORDER BY id LIMIT ?",
+        (after_id, shards.SHARD_COUNT, shard, limit)
+    )
+    return [_record(row, GAME_FIELDS) for row in rows]
+
+def iter_games(after_id=0, batch_size=1000):
+    last_id = after_id
+    while True:
+        rows = _fetchall(f"SELECT {_columns(GAME_FIELDS)} FROM games WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size))
+        if not rows:
+            return
+        for row in rows:
+            yield _record(row, GAME_FIELDS)
+        last_id = rows[-1][0]
+
+def _resolve_request(conn, table, request_id, status):
+    # Only a Pending request can be resolved, so a repeated click is a no-op
+    return conn.execute(
+        f"UPDATE {table} SET status = ? WHERE id = ? AND status = 'Pending' RETURNING telegram_id, amount",
+        (status, request_id)
+    ).fetchone()
+
+def _resolve_and_move(table, request_id, status, credit):
+    def job(conn):
+        row = _resolve_request(conn, table, request_id, status)
+        if row is not None and credit:
+            _credit(conn, table, [(row[0], row[1], f"{table}:{request_id}")])
+        return row
+    return job
+
+def _resolve_many(table, request_ids, status, credit):
+    # Bulk review: every status change and credit in one job, so they land
+    # in one commit
+    def job(conn):
+        resolved = []
+        for request_id in request_ids:
+            row = _resolve_request(conn, table, request_id, status)
+            if row is not None:
+                resolved.append((request_id, row[0], row[1]))
+        if credit and resolved:
+            _credit(conn, table, [(telegram_id, amount, f"{table}:{request_id}") for request_id, telegram_id, amount in resolved])
+        return resolved
+    return job
+
+# Pending deposit/withdrawal queues. Requests get their ID here so the
+# queue can be updated before the insert is flushed; sync_requests() picks
+# up rows written by another process.
+REQUEST_FIELDS = {"deposits": DEPOSIT_FIELDS, "withdrawals": WITHDRAWAL_FIELDS}
+deposit_queue = RequestQueue()
+withdrawal_queue = RequestQueue()
+_queues = {"deposits": deposit_queue, "withdrawals": withdrawal_queue}
+
+def _load_queues():
+    for table, queue in _queues.items():
+        fields = REQUEST_FIELDS[table]
+        queue.__init__()
+        for status, count in _conn.execute(f"SELECT status, COUNT(*) FROM {table} WHERE status != 'Pending' GROUP BY status"):
+            queue.counts[status] = count
+        for row in _conn.execute(f"SELECT {_columns(fields)} FROM {table} WHERE status = 'Pending' ORDER BY id"):
+            queue.add(_record(row, fields))
+        queue.max_id = max(queue.max_id, _conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0])
+
+def sync_requests():
+    for table, queue in _queues.items():
+        fields = REQUEST_FIELDS[table]
+        if shards.SHARD_COUNT == 1:
+            rows = _fetchall(f"SELECT {_columns(fields)} FROM {table} WHERE id > ? ORDER BY id", (queue.max_id,))
+        else:
+            # Other shards' IDs interleave with ours and land late, so every
+            # pending row is checked, and requests resolved elsewhere leave
+            # the queue
+            rows = _fetchall(f"SELECT {_columns(fields)} FROM {table} WHERE status = 'Pending' ORDER BY id")
+            pending = list(queue.pending)
+            resolved = _fetchall(
+                f"SELECT id, status FROM {table} WHERE status != 'Pending' AND id IN ({', '.join('?' for _ in pending)})",
+                pending
+            )
+            for request_id, status in resolved:
+                queue.resolve(request_id, status)
+        for row in rows:
+            if row[0] not in queue.pending:
+                queue.add(_record(row, fields))
+
+def _new_request(table, record):
+    return dict(record, ID=shards.next_id(_queues[table].max_id), status='Pending')
+
+def _insert_request_job(table, record):
+    fields = REQUEST_FIELDS[table]
+    placeholders = ", ".join("?" for _ in fields)
+    values = tuple(record[key] for _, key in fields)
+
+    def job(conn):
+        conn.execute(f"INSERT INTO {table} ({_columns(fields)}) VALUES ({placeholders})", values)
+        return record['ID']
+    return job
+
+def _get_request(table, request_id):
+    record = _queues[table].get(request_id)
+    if record is not None:
+        return dict(record)
+    fields = REQUEST_FIELDS[table]
+    row = _fetchone(f"SELECT {_columns(fields)} FROM {table} WHERE id = ?", (request_id,))
+    return _record(row, fields)
+
+async def _resolve(table, request_id, status, credit):
+    row = await asyncio.wrap_future(_submit_logged("resolve", table, request_id, status, credit))
+    if row is None:
+        return None
+    if credit:
+        _credit_cached(row[0], row[1])
+    record = _queues[table].resolve(request_id, status)
+    return dict(record) if record else _get_request(table, request_id)
+
+async def _resolve_all(table, request_ids, status, credit):
+    # Returns the requests that were still pending and are now resolved
+    resolved = await asyncio.wrap_future(_submit_logged("resolve_many", table, list(request_ids), status, credit))
+    records = []
+    for request_id, telegram_id, amount in resolved:
+        if credit:
+            _credit_cached(telegram_id, amount)
+        record = _queues[table].resolve(request_id, status)
+        records.append(dict(record) if record else _get_request(table, request_id))
+    return records
+
+def _find_requests(table, filters):
+    return [dict(record) for record in _queues[table].match(**filters)]
+
+# Deposits
+def add_deposit(telegram_id, username, amount, side, information):
+    with _lock:
+        record = _new_request("deposits", {
+            "ID-Telegram": telegram_id,
+            "Username": username,
+            "amount": amount,
+            "side": side,
+            "information": information
+        })
+        deposit_queue.add(record)
+    _submit(_insert_request_job("deposits", record))
+    return record['ID']
+
+def get_deposit(deposit_id):
+    return _get_request("deposits", deposit_id)
+
+def pending_deposits(after_id=0, limit=5):
+    return [dict(record) for record in deposit_queue.page(after_id, limit)]
+
+async def accept_deposit(deposit_id):
+    # Flip status and credit the user in one durable transaction
+    return await _resolve("deposits", deposit_id, 'Accept', True)
+
+async def reject_deposit(deposit_id):
+    return await _resolve("deposits", deposit_id, 'Reject', False)
+
+async def accept_deposits(deposit_ids):
+    return await _resolve_all("deposits", deposit_ids, 'Accept', True)
+
+async def reject_deposits(deposit_ids):
+    return await _resolve_all("deposits", deposit_ids, 'Reject', False)
+
+def find_deposits(**filters):
+    return _find_requests("deposits", filters)
+
+# Withdrawals
+def _withdraw_job(record):
+    insert = _insert_request_job("withdrawals", record)
+
+    def job(conn):
+        conn.execute("UPDATE users SET balance = balance - ? WHERE telegram_id = ?", (record['amount'], record['ID-Telegram']))
+        conn.execute(LEDGER_INSERT, (record['ID-Telegram'], "withdrawals", -record['amount'], f"withdrawals:{record['ID']}"))
+        return insert(conn)
+    return job
+
+async def add_withdrawal(telegram_id, username, amount, side, wallet_code):
+    # The request is only recorded if the balance deduction goes through
+    with _lock:
+        record = _new_request("withdrawals", {
+            "ID-Telegram": telegram_id,
+            "Username": username,
+            "amount": amount,
+            "side": side,
+            "wallet-code": wallet_code
+        })
+        balance, seq = _apply_balance(telegram_id, -amount, amount, ("withdraw", record))
+        if balance is None:
+            return None
+        withdrawal_queue.add(record)
+        future = _writer.submit(_withdraw_job(record), seq)
+
+    try:
+        return await asyncio.wrap_future(future)
+    except Exception:
+        withdrawal_queue.remove(record['ID'])
+        _credit_cached(telegram_id, amount)
+        raise
+
+def get_withdrawal(withdrawal_id):
+    return _get_request("withdrawals", withdrawal_id)
+
+def pending_withdrawals(after_id=0, limit=5):
+    return [dict(record) for record in withdrawal_queue.page(after_id, limit)]
+
+async def accept_withdrawal(withdrawal_id):
+    return await _resolve("withdrawals", withdrawal_id, 'Accept', False)
+
+async def reject_withdrawal(withdrawal_id):
+    # Flip status and refund the user in one durable transaction
+    return await _resolve("withdrawals", withdrawal_id, 'Reject', True)
+
+async def accept_withdrawals(withdrawal_ids):
+    return await _resolve_all("withdrawals", withdrawal_ids, 'Accept', False)
+
+async def reject_withdrawals(withdrawal_ids):
+    return await _resolve_all("withdrawals", withdrawal_ids, 'Reject', True)
+
+def find_withdrawals(**filters):
+    return _find_requests("withdrawals", filters)
+
+# Conversation state (encoded by sessions.py)
+def load_sessions(now):
+    return _fetchall("SELECT telegram_id, state, fields, flows FROM sessions WHERE expires > ?", (now,))
+
+def save_session(telegram_id, state, fields, flows, expires):
+    _submit(lambda conn: conn.execute(
+        "INSERT INTO sessions (telegram_id, state, fields, flows, expires) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT(telegram_id) DO UPDATE SET state = excluded.state, fields = excluded.fields, "
+        "flows = excluded.flows, expires = excluded.expires",
+        (telegram_id, state, fields, flows, expires)
+    ))
+
+def delete_session(telegram_id):
+    _submit(lambda conn: conn.execute("DELETE FROM sessions WHERE telegram_id = ?", (telegram_id,)))
+
+def purge_sessions(now):
+    _submit(lambda conn: conn.execute("DELETE FROM sessions WHERE expires <= ?", (now,)))
+
+# Balance operations by name, as written to the balance log. Each entry
+# builds the job that applies it, both live and when replaying the log.
+_BALANCE_OPS = {
+    "delta": _delta_job,
+    "set_balance": _set_balance_job,
+    "resolve": _resolve_and_move,
+    "resolve_many": _resolve_many,
+    "withdraw": _withdraw_job
+}
+
+def _submit_logged(op, *args):
+    # Logging and queueing under one lock keeps the log and the write queue
+    # in the same order, so the applied_seq a commit records covers every
+    # earlier entry
+    with _lock:
+        seq = _balance_log.append(op, *args)
+        return _writer.submit(_BALANCE_OPS[op](*args), seq)
+
+# Game logic and wallets
+def get_logic():
+    row = _fetchone("SELECT win, lose, random FROM logic WHERE id = 1")
+    return {"win": row[0], "lose": row[1], "random": bool(row[2])}
+
+async def set_logic(win, lose, random):
+    await _barrier(lambda conn: conn.execute(
+        "UPDATE logic SET win = ?, lose = ?, random = ? WHERE id = 1", (win, lose, int(bool(random)))
+    ))
+
+def get_wallets():
+    return dict(_fetchall("SELECT side, address FROM wallets"))
@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+# Each step runs in its own interpreter, in a scratch directory, so a step
+# can end in a hard exit (a crash: no drain, no close) and the next one
+# starts from whatever reached the disk
+PREAMBLE = """
+import asyncio, os, sys
+sys.path.insert(0, {repo!r})
+import storage
+storage.init_db("toptas.db")
+"""
+
+@pytest.fixture
+def run_bot(tmp_path):
+    def run(*parts):
+        script = PREAMBLE.format(repo=REPO) + "".join(textwrap.dedent(part) for part in parts)
+        result = subprocess.run([sys.executable, "-c", script], cwd=tmp_path, capture_output=True, text=True, timeout=60)
+        assert result.returncode == 0, result.stderr
+        return result.stdout
+    return run
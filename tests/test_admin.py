@@ -0,0 +1,41 @@
+# Bulk review from a filter preview, driven through the admin handlers
+
+BULK = """
+    from types import SimpleNamespace
+    import admin, config
+
+    replies = []
+
+    async def reply(text, reply_markup=None):
+        replies.append(text)
+
+    admin_user = SimpleNamespace(id=config.get().admin_id)
+    context = SimpleNamespace(user_data={})
+    storage.create_user(1, "u1")
+    storage.create_user(2, "u2")
+    first = storage.add_deposit(1, "u1", 1000, "TRC20", "tx1")
+    second = storage.add_deposit(1, "u1", 2000, "TRC20", "tx2")
+
+    context.user_data['filtering_requests'] = "deposits"
+    update = SimpleNamespace(effective_user=admin_user, message=SimpleNamespace(text="side=TRC20", reply_text=reply))
+    asyncio.run(admin.admin_message_handler(update, context))
+    assert replies[-1].startswith("2 ")
+
+    # After the preview: one shown request is reviewed alone, a new one arrives
+    asyncio.run(storage.reject_deposit(first))
+    late = storage.add_deposit(2, "u2", 5000, "TRC20", "tx3")
+
+    query = SimpleNamespace(edit_message_text=reply)
+    asyncio.run(admin.on_bulk_review(query, context, "deposits", "Accept", "filter"))
+    storage.flush()
+    print(replies[-1])
+    print(storage.get_user(1)['Balance'], storage.get_user(2)['Balance'], storage.get_deposit(late)['status'])
+    storage.close_db()
+"""
+
+
+def test_filter_bulk_resolves_only_previewed_requests(run_bot):
+    out = run_bot(BULK).splitlines()
+    assert out[0].startswith("1 ")
+    assert out[-2].endswith(": #1")
+    assert out[-1].split() == ["2000", "0", "Pending"]
@@ -0,0 +1,41 @@
+import os
+
+
+def test_replay_after_idle_restart(run_bot, tmp_path):
+    run_bot("""
+        storage.create_user(1, "u1")
+        storage.close_db()
+    """)
+    # An idle run leaves an empty last segment behind
+    run_bot("storage.close_db()")
+
+    run_bot("""
+        asyncio.run(storage.set_user_balance(storage.get_user(1)['ID'], 1000))
+        storage.flush()
+        assert storage.update_user_balance(1, -400) == 600
+        os._exit(0)  # crash before the delta is committed
+    """)
+    assert os.listdir(tmp_path / "balance-log")
+
+    out = run_bot("""
+        print(storage.get_user(1)['Balance'])
+        storage.close_db()
+    """)
+    assert out.split() == ["600"]
+
+
+def test_checkpoint_keeps_active_segment(tmp_path):
+    from balancelog import BalanceLog
+
+    log = BalanceLog(str(tmp_path))
+    assert log.open(0) == []
+    log.close()
+
+    log = BalanceLog(str(tmp_path))
+    log.open(0)
+    seq = log.append("delta", 1, 5)
+    log.checkpoint(seq)
+    log.append("delta", 1, 7)
+    log.close()
+
+    assert [args for _, _, args in BalanceLog(str(tmp_path)).open(seq)] == [[1, 7]]
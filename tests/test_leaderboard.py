@@ -0,0 +1,38 @@
+import random
+from bisect import bisect_left, insort
+
+from leaderboard import Leaderboard, _Ranking
+
+
+def test_ranking_matches_sorted_list(monkeypatch):
+    monkeypatch.setattr(_Ranking, "LOAD", 4)
+    rng = random.Random(7)
+    ranking, expected = _Ranking(), []
+    for _ in range(5000):
+        if expected and rng.random() < 0.45:
+            key = expected[rng.randrange(len(expected))]
+            ranking.remove(key)
+            expected.remove(key)
+        else:
+            key = (rng.randint(-50, 50), rng.randint(1, 10 ** 6))
+            ranking.add(key)
+            insort(expected, key)
+        if rng.random() < 0.05:
+            assert ranking.first(10) == expected[:10]
+            probe = expected[rng.randrange(len(expected))] if expected else None
+            if probe is not None:
+                assert ranking.index(probe) == bisect_left(expected, probe)
+    assert ranking.first(len(expected) + 1) == expected
+
+
+def test_top_and_rank():
+    board = Leaderboard()
+    games = [(1, 50), (2, -20), (3, 80), (1, 40), (2, 5)]
+    board.rebuild([
+        {'ID-Telegram': telegram_id, 'Username': f"u{telegram_id}", 'profit': profit, 'bet': 10,
+         'status': "win" if profit > 0 else "lose", 'date': "2000-01-01 12:00:00"}
+        for telegram_id, profit in games
+    ])
+    assert [entry["ID-Telegram"] for entry in board.top("all", 2)] == [1, 3]
+    assert board.rank_of("all", 2)[0] == 3
+    assert board.top("daily") == []
@@ -0,0 +1,110 @@
+# Balance paths end to end: each step is a fresh process on the same
+# database, and every test finishes with a ledger reconciliation
+
+PLAY = """
+    user = storage.create_user(1, "u1")
+    storage.create_user(2, "u2")
+    deposit = storage.add_deposit(1, "u1", 5000, "TRC20", "tx")
+    asyncio.run(storage.accept_deposit(deposit))
+    asyncio.run(storage.set_user_balance(storage.get_user(2)['ID'], 800))
+    for amount in (-300, 450, -1200):
+        storage.update_user_balance(1, amount, required=-min(amount, 0), ref="bet")
+    asyncio.run(storage.add_withdrawal(1, "u1", 1000, "TRC20", "wallet"))
+    storage.update_user_balance(2, -100, required=100)
+"""
+
+RECONCILE = """
+    import ledger
+    report = ledger.reconcile(storage.connect("toptas.db"))
+    assert not report["mismatches"], report
+    assert report["ledger_total"] == report["balance_total"], report
+    print(*(user['Balance'] for user in map(storage.get_user, (1, 2)) if user))
+    storage.close_db()
+"""
+
+
+def test_compare_and_apply(run_bot):
+    out = run_bot("""
+        storage.create_user(1, "u1")
+        asyncio.run(storage.set_user_balance(storage.get_user(1)['ID'], 1000))
+        assert storage.update_user_balance(1, -600, required=600) == 400
+        assert storage.update_user_balance(1, -600, required=600) is None
+        assert storage.update_user_balance(1, -500) is None
+        assert storage.update_user_balance(1, 0, required=500) is None
+        assert storage.update_user_balance(99, 100) is None
+        assert asyncio.run(storage.add_withdrawal(1, "u1", 500, "TRC20", "wallet")) is None
+        assert not storage.pending_withdrawals()
+        storage.flush()
+    """, RECONCILE)
+    assert out.split() == ["400"]
+
+
+def test_write_behind_keeps_order(run_bot):
+    # Deltas queued around a job land on the right side of it
+    out = run_bot("""
+        storage.create_user(1, "u1")
+        user_id = storage.get_user(1)['ID']
+        storage.update_user_balance(1, 100)
+        asyncio.run(storage.set_user_balance(user_id, 1000))
+        storage.update_user_balance(1, 5)
+        storage.update_user_balance(1, 7)
+        deposit = storage.add_deposit(1, "u1", 300, "TRC20", "tx")
+        asyncio.run(storage.accept_deposit(deposit))
+        assert asyncio.run(storage.accept_deposit(deposit)) is None
+        storage.update_user_balance(1, -12)
+        storage.close_db()
+    """)
+    assert out == ""
+    out = run_bot("""
+        row = storage.connect("toptas.db").execute("SELECT balance FROM users WHERE telegram_id = 1").fetchone()
+        print(row[0])
+    """, RECONCILE)
+    assert out.split() == ["1300", "1300"]
+
+
+def test_replay_then_reconcile(run_bot):
+    run_bot(PLAY, """
+        os._exit(0)  # crash: the last deltas never reached the database
+    """)
+    out = run_bot(RECONCILE)
+    assert out.split() == ["2950", "700"]
+
+
+def test_failed_batch_is_retried(run_bot):
+    # Another connection holds the write lock past the busy timeout
+    out = run_bot("""
+        import sqlite3, threading, time, writer
+        storage.close_db()
+        writer.BUSY_TIMEOUT_MS = 20
+        writer.RETRY_DELAY = 0.01
+        storage.init_db("toptas.db")
+        other = sqlite3.connect("toptas.db", isolation_level=None, check_same_thread=False)
+        other.execute("BEGIN IMMEDIATE")
+        threading.Timer(0.5, other.execute, ("COMMIT",)).start()
+    """, PLAY, """
+        storage.flush()
+        assert storage._writer.commits and storage._writer._thread.is_alive()
+    """, RECONCILE)
+    assert out.split() == ["2950", "700"]
+
+
+def test_batch_abandoned_at_shutdown_is_replayed(run_bot):
+    out = run_bot("""
+        import sqlite3, writer
+        storage.close_db()
+        writer.BUSY_TIMEOUT_MS = 20
+        writer.RETRY_DELAY = 0.01
+        writer.SHUTDOWN_ATTEMPTS = 3
+        storage.init_db("toptas.db")
+    """, PLAY, """
+        storage.flush()
+        other = sqlite3.connect("toptas.db", isolation_level=None)
+        other.execute("BEGIN IMMEDIATE")
+        storage.update_user_balance(1, 50)
+        storage.update_user_balance(2, -200, required=200)
+        storage.close_db()  # gives up on the last batch
+        print(other.execute("SELECT balance FROM users ORDER BY telegram_id").fetchall())
+    """)
+    assert out.split("\n")[0] == "[(2950,), (700,)]"
+    out = run_bot(RECONCILE)
+    assert out.split() == ["3000", "500"]
@@ -0,0 +1,24 @@
+import asyncio
+from types import SimpleNamespace
+
+from router import CallbackRouter
+
+
+def test_click_is_parsed_once():
+    router = CallbackRouter()
+    parsed, handled = [], []
+
+    def request_id(field):
+        parsed.append(field)
+        return int(field)
+
+    @router.route("accept_deposit_", request_id)
+    async def accept(query, context, deposit_id):
+        handled.append(deposit_id)
+
+    query = SimpleNamespace(data="accept_deposit_12")
+    assert router.matches(query.data)
+    assert router.label(SimpleNamespace(callback_query=query), None) == "accept_deposit_*"
+    asyncio.run(router.dispatch(query, None))
+    assert (parsed, handled) == (["12"], [12])
+    assert not router.matches("accept_deposit_x") and router.label(SimpleNamespace(callback_query=SimpleNamespace(data="nope")), None) == "unknown"
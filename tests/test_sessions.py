@@ -0,0 +1,18 @@
+def test_in_place_change_is_saved(run_bot):
+    out = run_bot("""
+        import time
+        from sessions import SessionPersistence
+
+        persistence = SessionPersistence()
+        data = {"selected_deposits": [1]}
+        asyncio.run(persistence.update_user_data(7, data))
+        first_expiry = persistence._expiry[7]["admin"]
+        time.sleep(1.1)
+        data["selected_deposits"].append(2)
+        asyncio.run(persistence.update_user_data(7, data))
+        assert persistence._expiry[7]["admin"] > first_expiry
+        storage.flush()
+        print(asyncio.run(SessionPersistence().get_user_data()))
+        storage.close_db()
+    """)
+    assert out.strip() == "{7: {'selected_deposits': [1, 2]}}"
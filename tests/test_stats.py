@@ -0,0 +1,35 @@
+from datetime import date
+
+import stats
+from stats import GameStats
+
+def _game(telegram_id, day, profit, bet=100):
+    return {'ID-Telegram': telegram_id, 'Username': f"u{telegram_id}", 'bet': bet, 'profit': profit,
+            'status': "win" if profit > 0 else "lose", 'bet_type': "even", 'date': f"{day}T12:00:00"}
+
+
+def test_late_games_from_other_shards_stay_in_window():
+    stats = GameStats(capacity=4)
+    today = date(2026, 10, 18).toordinal()
+    stats.record(_game(1, "2026-10-18", -100))
+    stats.report("daily", today=today)
+    # Another shard's games reach us after ours, out of date order
+    for game in (_game(2, "2026-10-01", -50), _game(3, "2026-10-17", 30), _game(2, "2026-10-18", -20)):
+        stats.record(game)
+
+    daily = stats.report("daily", today=today)
+    assert (daily["games"], daily["house"], daily["players"]) == (2, 120, 2)
+    weekly = stats.report("weekly", today=today)
+    assert weekly["games"] == 3
+    assert weekly["daily_house"][-2:] == [("2026-10-17", -30), ("2026-10-18", 120)]
+    everything = stats.report("all", today=today)
+    assert (everything["games"], everything["house"]) == (4, 140)
+    assert list(stats.time[:stats.size]) == sorted(stats.time[:stats.size])
+
+
+def test_record_converts_queued_games_in_bulk(monkeypatch):
+    monkeypatch.setattr(stats, "MAX_PENDING", 3)
+    game_stats = GameStats(capacity=2)
+    for day in range(1, 8):
+        game_stats.record(_game(day % 2, f"2026-10-0{day}", -10))
+    assert (game_stats.size, len(game_stats._pending)) == (6, 1)
@@ -0,0 +1,81 @@
+import sqlite3
+import time
+
+import writer
+from writer import WriteBehindQueue
+
+SCHEMA = """
+CREATE TABLE users (telegram_id INTEGER PRIMARY KEY, balance INTEGER NOT NULL, last_active INTEGER);
+CREATE TABLE ledger (id INTEGER PRIMARY KEY, telegram_id INTEGER, account TEXT, amount INTEGER, ref TEXT);
+CREATE TABLE balance_log_state (id INTEGER PRIMARY KEY, applied_seq INTEGER NOT NULL);
+INSERT INTO users VALUES (1, 0, NULL);
+INSERT INTO balance_log_state VALUES (1, 0);
+"""
+
+def _db(tmp_path):
+    path = str(tmp_path / "writer.db")
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    return path, conn
+
+
+def test_batch_retried_while_database_locked(tmp_path, monkeypatch):
+    monkeypatch.setattr(writer, "BUSY_TIMEOUT_MS", 20)
+    monkeypatch.setattr(writer, "RETRY_DELAY", 0.01)
+    path, other = _db(tmp_path)
+    committed = []
+    queue = WriteBehindQueue(path, on_commit=committed.append)
+    queue.start()
+
+    # Another process holds the write lock for longer than the busy timeout
+    other.execute("BEGIN IMMEDIATE")
+    queue.add_delta(1, 100, seq=1, entry=(1, "deposit", 100, None))
+    future = queue.submit(lambda conn: conn.execute("UPDATE users SET balance = balance * 2").rowcount, seq=2)
+    time.sleep(0.3)
+    assert not future.done() and not committed
+    other.execute("COMMIT")
+
+    assert future.result(timeout=5) == 1
+    queue.add_delta(1, 5, seq=3, entry=(1, "deposit", 5, None))
+    queue.drain()
+    assert other.execute("SELECT balance FROM users").fetchone() == (205,)
+    assert other.execute("SELECT COUNT(*) FROM ledger").fetchone() == (2,)
+    assert other.execute("SELECT applied_seq FROM balance_log_state").fetchone() == (3,)
+    assert committed == [2, 3]
+
+
+def test_failed_job_does_not_fail_batch(tmp_path):
+    path, other = _db(tmp_path)
+    queue = WriteBehindQueue(path)
+    queue.start()
+    queue.add_delta(1, 10)
+    failing = queue.submit(lambda conn: conn.execute("INSERT INTO users VALUES (1, 0, NULL)"))
+    queue.add_delta(1, 20)
+    queue.drain()
+    assert isinstance(failing.exception(timeout=5), sqlite3.IntegrityError)
+    assert other.execute("SELECT balance FROM users").fetchone() == (30,)
+
+
+def test_abandoned_batch_keeps_applied_seq(tmp_path, monkeypatch):
+    monkeypatch.setattr(writer, "BUSY_TIMEOUT_MS", 20)
+    monkeypatch.setattr(writer, "RETRY_DELAY", 0.01)
+    monkeypatch.setattr(writer, "SHUTDOWN_ATTEMPTS", 3)
+    path, other = _db(tmp_path)
+    committed = []
+    queue = WriteBehindQueue(path, on_commit=committed.append)
+    queue.start()
+
+    queue.add_delta(1, 100, seq=1, entry=(1, "deposit", 100, None))
+    queue.submit(lambda conn: None, seq=2).result(timeout=5)
+    # The lock is never released: the next batch cannot commit
+    other.execute("BEGIN IMMEDIATE")
+    queue.add_delta(1, 50, seq=3, entry=(1, "deposit", 50, None))
+    future = queue.submit(lambda conn: None, seq=4)
+    queue.drain()
+    other.execute("COMMIT")
+
+    assert isinstance(future.exception(timeout=5), RuntimeError)
+    assert committed == [2]
+    assert other.execute("SELECT balance FROM users").fetchone() == (100,)
+    assert other.execute("SELECT applied_seq FROM balance_log_state").fetchone() == (2,)
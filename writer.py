@@ -0,0 +1,184 @@
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Group commit settings
+GROUP_COMMIT_WINDOW = 0.01
+MAX_BATCH = 1000
+BUSY_TIMEOUT_MS = 5000
+# A batch that fails to commit (the database locked by another process for
+# longer than the busy timeout, a full disk, ...) is retried with backoff
+RETRY_DELAY = 0.05
+MAX_RETRY_DELAY = 5.0
+# Attempts left to a failing batch once the queue is draining; after them
+# the writer gives up rather than hold shutdown forever
+SHUTDOWN_ATTEMPTS = 10
+
+# One ledger entry: (telegram_id, account, amount, ref), see storage.SCHEMA
+LEDGER_INSERT = "INSERT INTO ledger (telegram_id, account, amount, ref) VALUES (?, ?, ?, ?)"
+
+class WriteBehindQueue:
+    # Persists writes on a worker thread with its own connection. Balance
+    # deltas and activity stamps submitted back to back are coalesced per
+    # user; any other write is a job run in submission order. Everything
+    # gathered during one window is committed (and fsynced) together, and
+    # job futures resolve only after that commit, so awaiting one is a
+    # durability barrier. Writes carrying a balance log sequence number move
+    # the applied_seq checkpoint forward in the same commit. Ledger entries
+    # for coalesced deltas are kept one by one and land with them.
+    def __init__(self, db_path, window=GROUP_COMMIT_WINDOW, max_batch=MAX_BATCH, on_commit=None, log_state_id=1):
+        self.db_path = db_path
+        self.window = window
+        self.max_batch = max_batch
+        self.on_commit = on_commit
+        self.log_state_id = log_state_id
+        self.commits = 0
+        self.ops_written = 0
+        self._ops = []  # [kind, payload, future, highest seq]
+        self._open_deltas = None
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def add_delta(self, telegram_id, amount=0, last_active=None, seq=0, entry=None):
+        with self._cond:
+            if self._open_deltas is None:
+                self._open_deltas = ["deltas", ({}, []), None, 0]
+                self._ops.append(self._open_deltas)
+            self._open_deltas[3] = max(self._open_deltas[3], seq)
+            deltas, entries = self._open_deltas[1]
+            if entry is not None:
+                entries.append(entry)
+            delta = deltas.setdefault(telegram_id, [0, None])
+            delta[0] += amount
+            if last_active is not None:
+                delta[1] = last_active
+            self._cond.notify()
+
+    def submit(self, job, seq=0):
+        future = Future()
+        with self._cond:
+            # A job seals the open delta group so later deltas stay after it
+            self._open_deltas = None
+            self._ops.append(["job", job, future, seq])
+            self._cond.notify()
+        return future
+
+    def _take_batch(self):
+        with self._cond:
+            while not self._ops and not self._stopping:
+                self._cond.wait()
+            if not self._ops:
+                return None
+        if not self._stopping:
+            time.sleep(self.window)
+        with self._cond:
+            batch, self._ops = self._ops[:self.max_batch], self._ops[self.max_batch:]
+            if not self._ops:
+                # The open delta group (always last) is in this batch now
+                self._open_deltas = None
+        return batch
+
+    def _write_batch(self, conn, batch):
+        # Returns False if nothing was committed; the batch is then retried
+        # whole, deltas included, before anything queued after it
+        started = time.perf_counter()
+        results = []
+        applied_seq = max(op[3] for op in batch)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for kind, payload, future, _ in batch:
+                if kind == "deltas":
+                    deltas, entries = payload
+                    conn.executemany(
+                        "UPDATE users SET balance = balance + ?, last_active = COALESCE(?, last_active) WHERE telegram_id = ?",
+                        [(amount, last_active, telegram_id) for telegram_id, (amount, last_active) in deltas.items()]
+                    )
+                    conn.executemany(LEDGER_INSERT, entries)
+                    continue
+                conn.execute("SAVEPOINT job")
+                try:
+                    results.append((future, payload(conn), None))
+                    conn.execute("RELEASE job")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    results.append((future, None, e))
+            if applied_seq:
+                conn.execute("UPDATE balance_log_state SET applied_seq = ? WHERE id = ?", (applied_seq, self.log_state_id))
+            conn.execute("COMMIT")
+        except Exception:
+            logger.exception("Group commit of %d writes failed, retrying", len(batch))
+            try:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                logger.exception("Rollback failed")
+            return False
+
+        metrics.observe("storage", "commit", time.perf_counter() - started)
+        self.commits += 1
+        self.ops_written += len(batch)
+        if applied_seq and self.on_commit is not None:
+            try:
+                self.on_commit(applied_seq)
+            except Exception:
+                logger.exception("Commit hook failed")
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        return True
+
+    def _abandon(self, batch):
+        # Stops for good without committing anything more: applied_seq stays
+        # where it was, so the balance log replays these writes at startup
+        with self._cond:
+            batch, self._ops = batch + self._ops, []
+            self._open_deltas = None
+        logger.critical("Write-behind queue stopped with %d writes not committed", len(batch))
+        error = RuntimeError("the write-behind queue stopped before this write was committed")
+        for _, _, future, _ in batch:
+            if future is not None:
+                future.set_exception(error)
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        try:
+            while True:
+                batch = self._take_batch()
+                if batch is None:
+                    return
+                # Nothing queued after a failed batch is written before it,
+                # so applied_seq never passes a write that did not commit
+                attempts = 1
+                delay = RETRY_DELAY
+                while not self._write_batch(conn, batch):
+                    if self._stopping and attempts >= SHUTDOWN_ATTEMPTS:
+                        self._abandon(batch)
+                        return
+                    attempts += 1
+                    time.sleep(delay)
+                    delay = min(delay * 2, MAX_RETRY_DELAY)
+        finally:
+            conn.close()
+
+    def drain(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread.is_alive():
+            self._thread.join()